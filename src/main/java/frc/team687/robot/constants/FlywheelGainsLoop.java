@@ -0,0 +1,50 @@
+
+package frc.team687.robot.constants;
+
+/**
+ * Generated by gains_writer.py, don't edit by hand.
+ * Observer and controller with every matrix product unrolled into primitive doubles, so update doesn't allocate.
+ */
+public class FlywheelGainsLoop {
+
+    private static final double kA_LC_0_0 = 0.8892527713479534;
+    private static final double kB_0_0 = 1.4153150992568042;
+    private static final double kK_0_0 = 0.4886683207948064;
+    private static final double kUMax_0 = 12.0;
+    private static final double kUMin_0 = -12.0;
+
+    public static final int n = 1;
+    public static final int p = 1;
+    public static final int q = 1;
+
+    // Current state estimate and last output, updated in place
+    public final double[] xHat = new double[n];
+    public final double[] u = new double[p];
+
+    public FlywheelGainsLoop(double[] initialState) {
+        this.reset(initialState);
+    }
+
+    public void reset(double[] initialState) {
+        System.arraycopy(initialState, 0, this.xHat, 0, n);
+        java.util.Arrays.fill(this.u, 0.0);
+    }
+
+    // Observer update with the last output and the new measurement y
+    public double[] updateObserver(double[] y) {
+        double nextXHat0 = kA_LC_0_0 * xHat[0] + kB_0_0 * u[0];
+        xHat[0] = nextXHat0;
+        return xHat;
+    }
+
+    // One control loop: observer update, then the clamped control law u = K * (r - xHat). Returns the new output
+    public double[] update(double[] r, double[] y) {
+        this.updateObserver(y);
+        double error0 = r[0] - xHat[0];
+        double output0 = kK_0_0 * error0;
+        output0 = Math.min(Math.max(output0, kUMin_0), kUMax_0);
+        u[0] = output0;
+        return u;
+    }
+
+}
@@ -0,0 +1,62 @@
+
+package frc.team687.robot.constants;
+
+/**
+ * Generated by gains_writer.py, don't edit by hand.
+ * Observer and controller with every matrix product unrolled into primitive doubles, so update doesn't allocate.
+ */
+public class MotorGainsLoop {
+
+    private static final double kA_LC_0_0 = -0.3412548959655859;
+    private static final double kA_LC_0_1 = 0.0042051357658172955;
+    private static final double kA_LC_1_0 = -40.79939059979877;
+    private static final double kA_LC_1_1 = 0.44910274333552347;
+    private static final double kB_0_0 = 0.0023285164193457314;
+    private static final double kB_1_0 = 0.46500387362071127;
+    private static final double kK_0_0 = 0.5804118568397592;
+    private static final double kK_0_1 = 0.13978035346974296;
+    private static final double kL_0_0 = 0.0020574592420687632;
+    private static final double kL_0_1 = 8.820200451664257e-05;
+    private static final double kL_1_0 = 0.06258548133753333;
+    private static final double kL_1_1 = 0.008312845457613656;
+    private static final double kUMax_0 = 12.0;
+    private static final double kUMin_0 = -12.0;
+
+    public static final int n = 2;
+    public static final int p = 1;
+    public static final int q = 2;
+
+    // Current state estimate and last output, updated in place
+    public final double[] xHat = new double[n];
+    public final double[] u = new double[p];
+
+    public MotorGainsLoop(double[] initialState) {
+        this.reset(initialState);
+    }
+
+    public void reset(double[] initialState) {
+        System.arraycopy(initialState, 0, this.xHat, 0, n);
+        java.util.Arrays.fill(this.u, 0.0);
+    }
+
+    // Observer update with the last output and the new measurement y
+    public double[] updateObserver(double[] y) {
+        double nextXHat0 = kA_LC_0_0 * xHat[0] + kA_LC_0_1 * xHat[1] + kB_0_0 * u[0] + kL_0_0 * y[0] + kL_0_1 * y[1];
+        double nextXHat1 = kA_LC_1_0 * xHat[0] + kA_LC_1_1 * xHat[1] + kB_1_0 * u[0] + kL_1_0 * y[0] + kL_1_1 * y[1];
+        xHat[0] = nextXHat0;
+        xHat[1] = nextXHat1;
+        return xHat;
+    }
+
+    // One control loop: observer update, then the clamped control law u = K * (r - xHat). Returns the new output
+    public double[] update(double[] r, double[] y) {
+        this.updateObserver(y);
+        double error0 = r[0] - xHat[0];
+        double error1 = r[1] - xHat[1];
+        double output0 = kK_0_0 * error0 + kK_0_1 * error1;
+        output0 = Math.min(Math.max(output0, kUMin_0), kUMax_0);
+        u[0] = output0;
+        return u;
+    }
+
+}
@@ -0,0 +1,93 @@
+import time
+import numpy as np
+from robot import motor_test
+from utilities.state_space import response_metrics
+from utilities.state_space.ss_sim import StateSpaceControlSim
+
+"""
+Step response metrics of a big batch of noisy motor_test runs, for each of the reference's steps, and the runs ranked
+by how well they track the position (the velocity reference never steps, so its step metrics are all NaN).
+
+First checks the vectorized metrics against working them out one run and one signal at a time.
+"""
+
+RANKING = {'settling_time': 1., 'overshoot': 1., 'integrated_absolute_error': 0.1}
+
+
+def make_sim():
+    gains_list, u_max, u_min = motor_test.create_gains()
+    x_initial = np.asmatrix([[-3.14], [0.]])
+    return StateSpaceControlSim(gains_list, x_hat_initial=x_initial, u_initial=np.zeros((1, 1)), x_initial=x_initial,
+                                r_initial=x_initial, u_max=u_max, u_min=u_min, backend='numpy')
+
+
+def loop_step_metrics(t, y, r, band=0.02):
+    """ Rise time, overshoot and settling time of one signal of one run, the obvious way"""
+
+    step = r[-1] - y[0]
+    if step == 0.:
+        return np.nan, np.nan, np.nan
+    progress = [(value - y[0]) / step for value in y]
+
+    low = next((k for k, value in enumerate(progress) if value >= 0.1), None)
+    high = next((k for k, value in enumerate(progress) if value >= 0.9), None)
+    rise_time = np.nan if low is None or high is None else t[high] - t[low]
+    overshoot = max(max(progress) - 1., 0.)
+
+    settling_time = 0.
+    for k in range(len(progress)):
+        if abs(progress[k] - 1.) > band:
+            settling_time = np.nan if k == len(progress) - 1 else t[k + 1] - t[0]
+    return rise_time, overshoot, settling_time
+
+
+def check_against_loop(result, r, windows, runs=20):
+    """ Largest difference between step_metrics and loop_step_metrics over the first runs of result"""
+
+    difference = 0.
+    for window in windows:
+        metrics = response_metrics.step_metrics(result.t, result.x, r, window)
+        start, stop = window
+        for run in range(runs):
+            for signal in range(result.x.shape[-1]):
+                expected = loop_step_metrics(result.t[start:stop], result.x[run, start:stop, signal],
+                                             r[start:stop, signal])
+                actual = (metrics.rise_time[run, signal], metrics.overshoot[run, signal],
+                          metrics.settling_time[run, signal])
+                assert np.array_equal(np.isnan(expected), np.isnan(actual)), 'NaN metrics disagree with the loop'
+                difference = max(difference, np.nanmax(np.abs(np.subtract(expected, actual)), initial=0.))
+    return difference
+
+
+def main(batch=5000, duration=12., seed=0):
+    sim = make_sim()
+    u_min, u_max = sim.controller.u_min, sim.controller.u_max
+    r = np.stack([np.asarray(motor_test.reference_calculator(t), dtype=float).ravel()
+                  for t in np.arange(start=0., stop=duration, step=sim.plant.current_gains.dt)])
+
+    start = time.perf_counter()
+    result = sim.simulate(duration, motor_test.reference_calculator, batch=batch, seed=seed)
+    print('simulated %d runs in %.2f s' % (batch, time.perf_counter() - start))
+
+    windows = response_metrics.step_windows(r)
+    print('metrics vs a per-run loop, largest difference %.3g' % check_against_loop(result, r, windows))
+
+    for window in windows:
+        start = time.perf_counter()
+        step, inputs = response_metrics.response_metrics(result, r, u_min, u_max, window=window)
+        order, score = response_metrics.rank_runs(step, RANKING, signals=[0])
+        elapsed = time.perf_counter() - start
+
+        print('step at %.2f s: metrics and ranking of %d runs in %.1f ms' % (result.t[window[0]], batch,
+                                                                              elapsed * 1.e3))
+        for name, values in zip(step._fields, step):
+            undefined = np.count_nonzero(np.isnan(values[:, 0]))
+            print('    %-26s median %.4g, worst %.4g, %d undefined' % (name, np.nanmedian(values[:, 0]),
+                                                                      np.nanmax(np.abs(values[:, 0])), undefined))
+        print('    peak |u| median %.2f V, %.0f ms saturated on average, best run %d (score %.4g), worst run %d '
+              '(score %.4g)' % (np.median(inputs.peak), np.mean(inputs.time_saturated) * 1.e3, order[0],
+                                score[order[0]], order[-1], score[order[-1]]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import sys
+import numpy as np
+from robot import motor_test
+from robot.models.motor import create_gains, lqr_weights
+from utilities.state_space import sim_kernels
+from utilities.state_space.state_space_utils import dlqr, discrete_kalman
+from utilities.state_space.sweep import run_sweep
+
+"""
+An overnight-style sweep over the motor_test LQR and Kalman tuning, which can be stopped and restarted at any point.
+
+Each point scales the LQR state weight and the assumed process noise, resynthesizes K and L, and runs a Monte Carlo
+batch of the reference tracking sim in chunks, checkpointing after every chunk. Run it again with the same store to
+pick up where it left off:
+
+    python -m robot.motor_sweep motor_sweep.jsonl
+"""
+
+DURATION = 12.
+CHUNKS = 4
+CHUNK_SIZE = 64
+
+
+def sweep_points():
+    return [{'q_scale': float(q_scale), 'noise_scale': float(noise_scale)}
+            for q_scale in np.logspace(-1, 1, 5)
+            for noise_scale in np.logspace(-1, 1, 3)]
+
+
+def synthesize(point):
+    gains = create_gains()[0].get_gains(0)
+    Q_weight, R_weight = lqr_weights()
+    Q_weight = Q_weight * point['q_scale']
+    Q_noise = gains.Q_noise * point['noise_scale']
+    return gains, Q_weight, R_weight, Q_noise
+
+
+def synthesis_inputs(point):
+    gains, Q_weight, R_weight, Q_noise = synthesize(point)
+    return {'A': gains.A, 'B': gains.B, 'C': gains.C, 'Q_weight': Q_weight, 'R_weight': R_weight,
+            'Q_noise': Q_noise, 'R_noise': gains.R_noise, 'duration': DURATION, 'runs': CHUNKS * CHUNK_SIZE}
+
+
+def evaluate(point, context):
+    gains, Q_weight, R_weight, Q_noise = synthesize(point)
+    gains = gains.replace(K=dlqr(gains.A, gains.B, Q_weight, R_weight),
+                          L=discrete_kalman(gains.A, gains.C, Q_noise, gains.R_noise))
+
+    t = np.arange(start=0., stop=DURATION, step=gains.dt)
+    r = np.stack([np.asarray(motor_test.reference_calculator(time), dtype=float).ravel() for time in t])
+    matrices = sim_kernels.kernel_matrices(gains, gains.u_min, gains.u_max)
+    x_initial = np.array([-3.14, 0.])
+
+    # Running sums, so a resumed point carries on from its last chunk
+    metrics = context.partial or {'chunks': 0, 'squared_error': 0., 'samples': 0, 'max_abs_u': 0.}
+    for _ in range(metrics['chunks'], CHUNKS):
+        process_noise, sensor_noise = sim_kernels.generate_noise(gains, CHUNK_SIZE, len(t), context.rng)
+        x, u, y, x_hat = sim_kernels.run_kernel('numpy', matrices, x_initial, x_initial, np.zeros(1), r, None,
+                                                process_noise, sensor_noise)
+        metrics = {'chunks': metrics['chunks'] + 1,
+                   'squared_error': metrics['squared_error'] + float(np.sum((x[:, :, 0] - r[:, 0]) ** 2)),
+                   'samples': metrics['samples'] + x.shape[0] * x.shape[1],
+                   'max_abs_u': max(metrics['max_abs_u'], float(np.max(np.abs(u))))}
+        context.checkpoint(metrics)
+
+    metrics['rms_position_error'] = np.sqrt(metrics['squared_error'] / metrics['samples'])
+    return metrics
+
+
+def main(store_path='motor_sweep.jsonl'):
+    results = run_sweep(sweep_points(), evaluate, store_path, synthesis_inputs=synthesis_inputs, verbose=True)
+    for point, metrics in results:
+        print('q_scale %7.3f, noise_scale %7.3f: rms position error %.4f rad, max |u| %.2f V'
+              % (point['q_scale'], point['noise_scale'], metrics['rms_position_error'], metrics['max_abs_u']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,238 @@
+import math
+import queue
+import threading
+import time
+import numpy as np
+from robot import motor_test
+from robot.models import motor
+from utilities.state_space import sim_kernels
+from utilities.state_space.memoize import memoize_arrays
+from utilities.state_space.state_space_gains import StateSpaceGains
+from utilities.state_space.state_space_utils import c2d, dlqr, discrete_kalman, feedforward_gains
+
+"""
+Interactive tuner for the motor_test model: sliders for the LQR weights, the noise levels and the moment of inertia,
+with the reference tracking response redrawn as they move.
+
+Every synthesis step is memoized, so moving a slider only redoes the steps downstream of it. Moving an LQR weight
+re-solves dlqr but not c2d or discrete_kalman, and moving the sensor noise only re-solves discrete_kalman. The
+re-synthesis and the simulation (the numpy sim kernel, with the same noise every time) run on a worker thread, which
+waits for the sliders to settle for a moment first, so dragging never queues up a backlog of stale work. TunerModel
+does all the work without any of the UI, so it can be timed and used headlessly.
+"""
+
+# name, label, log10 of the slider range and of the default. The defaults are what create_gains uses
+SLIDERS = [
+    ('q_position', 'Q position weight', -6., 4., math.log10((0.0005 / 1.e-2) ** 2)),
+    ('q_velocity', 'Q velocity weight', -10., 2., math.log10((0.0005 / 5.e0) ** 2)),
+    ('r_voltage', 'R voltage weight', -4., 2., math.log10(1. / 12. ** 2)),
+    ('process_noise', 'Process noise scale', -2., 2., 0.),
+    ('sensor_noise', 'Sensor noise scale', -2., 2., 0.),
+    ('moment_of_inertia', 'Moment of inertia (kg-m^2)', -4., -1., math.log10(motor.MOMENT_OF_INERTIA)),
+]
+
+# How long the sliders have to be still before re-simulating, in seconds
+DEBOUNCE = 0.03
+
+cached_continuous_model = memoize_arrays()(motor.continuous_model)
+cached_c2d = memoize_arrays()(c2d)
+cached_dlqr = memoize_arrays()(dlqr)
+cached_discrete_kalman = memoize_arrays()(discrete_kalman)
+
+
+def default_parameters():
+    return {name: 10. ** default for name, _, _, _, default in SLIDERS}
+
+
+class TunerModel(object):
+    """ Synthesizes gains for a set of tuning parameters and simulates reference tracking with them"""
+
+    def __init__(self, duration=12., dt=0.01, seed=0):
+        self.dt = dt
+        self.t = np.arange(start=0., stop=duration, step=dt)
+        self.r = np.stack([np.asarray(motor_test.reference_calculator(time), dtype=float).ravel()
+                           for time in self.t])
+        self.x_initial = np.array([-3.14, 0.])
+        battery_voltage = motor.MOTOR_TYPE.value[4]
+        self.u_max = np.asmatrix([[battery_voltage]])
+        self.u_min = -self.u_max
+
+        # Unscaled noise, drawn once so only the tuning changes between runs
+        rng = np.random.default_rng(seed)
+        self.standard_process_noise = rng.standard_normal((1, len(self.t), 2))
+        self.standard_sensor_noise = rng.standard_normal((1, len(self.t), 2))
+
+    def synthesize(self, parameters):
+        A, B, C, D, Q_noise, R_noise = cached_continuous_model(parameters['moment_of_inertia'])
+        A_d, B_d, Q_d, R_d = cached_c2d(A, B, self.dt, Q_noise * parameters['process_noise'], R_noise)
+        # R_d is just R / dt, so the sensor noise is scaled afterwards to keep it from invalidating c2d
+        R_d = R_d * parameters['sensor_noise']
+        Q_weight = np.diag([parameters['q_position'], parameters['q_velocity']])
+        R_weight = np.array([[parameters['r_voltage']]])
+        K = cached_dlqr(A_d, B_d, Q_weight, R_weight)
+        L = cached_discrete_kalman(A_d, C, Q_d, R_d)
+        Kff = feedforward_gains(B_d, np.asmatrix(Q_weight), np.asmatrix(R_weight))
+
+        return StateSpaceGains('MotorGains', A_d, B_d, C, D, Q_d, R_d, K, L, Kff, self.u_min, self.u_max, self.dt)
+
+    def simulate(self, gains):
+        # Scaled the same way StateSpacePlant.generate_noise scales its noise
+        process_noise = self.standard_process_noise @ np.asarray(gains.Q_noise).T
+        sensor_noise = self.standard_sensor_noise @ np.asarray(gains.R_noise).T
+        matrices = sim_kernels.kernel_matrices(gains, self.u_min, self.u_max)
+        x, u, y, x_hat = sim_kernels.run_kernel('numpy', matrices, self.x_initial, self.x_initial, np.zeros(1),
+                                                self.r, None, process_noise, sensor_noise)
+        return sim_kernels.SimResult(self.t, x, u, y, x_hat)
+
+    def update(self, parameters):
+        """ Returns the gains, the simulation, and how long synthesis and simulation took in seconds"""
+
+        start = time.perf_counter()
+        gains = self.synthesize(parameters)
+        synthesized = time.perf_counter()
+        result = self.simulate(gains)
+        return gains, result, synthesized - start, time.perf_counter() - synthesized
+
+
+class TunerWorker(threading.Thread):
+    """ Re-synthesizes and re-simulates off the UI thread. submit only records the latest parameters, and the work
+        starts once they've stopped changing for DEBOUNCE seconds, so only the latest ones ever get simulated"""
+
+    def __init__(self, model, results):
+        super().__init__(daemon=True)
+        self.model = model
+        self.results = results
+        self.condition = threading.Condition()
+        self.pending = None
+        self.changed_at = 0.
+
+    def submit(self, parameters):
+        with self.condition:
+            self.pending = dict(parameters)
+            self.changed_at = time.perf_counter()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                # Wait out the debounce, restarting it whenever another change comes in
+                while True:
+                    remaining = self.changed_at + DEBOUNCE - time.perf_counter()
+                    if remaining <= 0.:
+                        break
+                    self.condition.wait(remaining)
+                parameters = self.pending
+                self.pending = None
+
+            submitted = time.perf_counter()
+            try:
+                self.results.put((parameters, self.model.update(parameters), submitted))
+            except (AssertionError, ValueError, np.linalg.LinAlgError) as error:
+                # Some corners of the sliders aren't controllable or observable enough to synthesize
+                self.results.put((parameters, error, submitted))
+
+
+class TunerWindow(object):
+
+    def __init__(self, master, model=None):
+        import tkinter as tk
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+
+        self.master = master
+        self.model = TunerModel() if model is None else model
+        self.results = queue.Queue()
+        self.worker = TunerWorker(self.model, self.results)
+
+        master.title('Motor tuner')
+        controls = tk.Frame(master)
+        controls.pack(side=tk.LEFT, fill=tk.Y)
+
+        self.variables = {}
+        self.value_labels = {}
+        for row, (name, label, low, high, default) in enumerate(SLIDERS):
+            tk.Label(controls, text=label).grid(row=2 * row, column=0, sticky=tk.W)
+            variable = tk.DoubleVar(value=default)
+            tk.Scale(controls, variable=variable, from_=low, to=high, resolution=0.01, orient=tk.HORIZONTAL,
+                     length=240, showvalue=False, command=lambda _: self.changed()).grid(row=2 * row + 1, column=0)
+            value_label = tk.Label(controls, width=10, anchor=tk.E)
+            value_label.grid(row=2 * row + 1, column=1)
+            self.variables[name] = variable
+            self.value_labels[name] = value_label
+
+        self.status = tk.Label(controls, justify=tk.LEFT, anchor=tk.W)
+        self.status.grid(row=2 * len(SLIDERS), column=0, columnspan=2, sticky=tk.W)
+        self.gains_label = tk.Label(controls, justify=tk.LEFT, anchor=tk.W, font=('Courier', 9))
+        self.gains_label.grid(row=2 * len(SLIDERS) + 1, column=0, columnspan=2, sticky=tk.W)
+
+        figure = Figure(figsize=(8, 6))
+        self.position_axes = figure.add_subplot(211)
+        self.voltage_axes = figure.add_subplot(212, sharex=self.position_axes)
+        t = self.model.t
+        self.reference_line, = self.position_axes.plot(t, self.model.r[:, 0], 'k--', label='r')
+        self.position_line, = self.position_axes.plot(t, np.zeros(len(t)), label='theta')
+        self.estimate_line, = self.position_axes.plot(t, np.zeros(len(t)), label='theta_hat')
+        self.voltage_line, = self.voltage_axes.plot(t, np.zeros(len(t)), label='u')
+        self.position_axes.legend(loc='upper left')
+        self.position_axes.set_ylabel('rad')
+        self.voltage_axes.set_ylabel('V')
+        self.voltage_axes.set_xlabel('s')
+
+        self.canvas = FigureCanvasTkAgg(figure, master=master)
+        self.canvas.get_tk_widget().pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
+
+        self.worker.start()
+        self.changed()
+        self.master.after(10, self.poll)
+
+    def parameters(self):
+        return {name: 10. ** variable.get() for name, variable in self.variables.items()}
+
+    def changed(self):
+        parameters = self.parameters()
+        for name, value in parameters.items():
+            self.value_labels[name].config(text='%.3g' % value)
+        self.worker.submit(parameters)
+
+    def poll(self):
+        try:
+            while True:
+                parameters, update, submitted = self.results.get_nowait()
+                self.draw(update, submitted)
+        except queue.Empty:
+            pass
+        self.master.after(10, self.poll)
+
+    def draw(self, update, submitted):
+        if isinstance(update, Exception):
+            self.status.config(text='Synthesis failed: %s' % update)
+            return
+
+        gains, result, synthesis_time, simulation_time = update
+        self.position_line.set_ydata(result.x[0, :, 0])
+        self.estimate_line.set_ydata(result.x_hat[0, :, 0])
+        self.voltage_line.set_ydata(result.u[0, :, 0])
+        for axes in (self.position_axes, self.voltage_axes):
+            axes.relim()
+            axes.autoscale_view()
+        self.canvas.draw_idle()
+
+        self.status.config(text='synthesis %.1f ms, simulation %.1f ms, total %.1f ms'
+                                % (synthesis_time * 1.e3, simulation_time * 1.e3,
+                                   (time.perf_counter() - submitted) * 1.e3))
+        self.gains_label.config(text='K = %s\nL = %s' % (np.array2string(np.asarray(gains.K), precision=4),
+                                                       np.array2string(np.asarray(gains.L), precision=4)))
+
+
+def main():
+    import tkinter as tk
+
+    master = tk.Tk()
+    TunerWindow(master)
+    master.mainloop()
+
+
+if __name__ == '__main__':
+    main()
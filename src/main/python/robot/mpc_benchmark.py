@@ -0,0 +1,58 @@
+import time
+import numpy as np
+from robot import motor_test
+from utilities.state_space.mpc_controller import MPCController
+from utilities.state_space.ss_sim import StateSpaceControlSim
+
+"""
+Measures how long MPCController takes per tick on the motor_test model, to make sure it fits in the control loop.
+The whole sim is run, but only the controller's share of each tick is timed.
+"""
+
+
+def benchmark(duration=20., horizon=20, max_iterations=50):
+    gains_list, u_max, u_min = motor_test.create_gains()
+    gains = gains_list.get_gains(0)
+    Q_weight, R_weight = motor_test.lqr_weights()
+
+    x_initial = np.asmatrix([
+        [-3.14],
+        [0.]
+    ])
+    u_initial = np.zeros((1, 1))
+
+    controller = MPCController(gains_list, u_initial=u_initial, r_initial=x_initial, u_max=u_max, u_min=u_min,
+                               Q_weight=Q_weight, R_weight=R_weight, horizon=horizon, max_iterations=max_iterations)
+    sim = StateSpaceControlSim(gains, x_hat_initial=x_initial, u_initial=u_initial, x_initial=x_initial,
+                               r_initial=x_initial, u_max=u_max, u_min=u_min, controller=controller)
+
+    # Time the controller by wrapping its update, so the plant and observer don't count against it
+    tick_times = []
+    iterations = []
+    bounded_update = controller.bounded_update
+
+    def timed_update(r, x_hat):
+        start = time.perf_counter()
+        u = bounded_update(r, x_hat)
+        tick_times.append(time.perf_counter() - start)
+        iterations.append(controller.iterations)
+        return u
+
+    controller.bounded_update = timed_update
+
+    for t in np.arange(start=0., stop=duration, step=gains.dt):
+        sim.update(motor_test.reference_calculator(t))
+
+    tick_times = np.array(tick_times) * 1.e3
+    budget = gains.dt * 1.e3
+    print('MPC horizon %d, at most %d iterations, %d ticks' % (horizon, max_iterations, len(tick_times)))
+    print('mean %.3f ms, p99 %.3f ms, max %.3f ms, loop budget %.1f ms'
+          % (tick_times.mean(), np.percentile(tick_times, 99), tick_times.max(), budget))
+    print('mean %.1f iterations, max %d iterations' % (np.mean(iterations), np.max(iterations)))
+    print('Fits in the loop' if tick_times.max() < budget else 'Does NOT fit in the loop')
+
+    return tick_times
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,118 @@
+import time
+import numpy as np
+from robot import motor_test
+from robot.models import motor
+from utilities.state_space import multirate_sim
+from utilities.state_space.multirate_sim import MultiRateSim, sensor_group
+from utilities.state_space.ss_sim import StateSpaceControlSim
+from utilities.state_space.state_space_controller import StateSpaceController
+from utilities.state_space.state_space_gains import GainsList, StateSpaceGains
+from utilities.state_space.state_space_observer import SquareRootKalmanObserver, StateSpaceObserver, \
+    check_missing_sensors
+from utilities.state_space.state_space_plant import StateSpacePlant
+from utilities.state_space.state_space_utils import c2d, dlqr, discrete_kalman, feedforward_gains
+
+"""
+The motor under a multi-rate schedule: the plant integrated at 1 ms, the encoder position read every 10 ms and the
+velocity only every 20 ms (5 ms out of phase), with the observer and controller at 10 ms.
+
+First checks that with everything at one rate and the noise off it's the same loop as StateSpaceControlSim, and that
+jumping the plant from event to event gives the same answer as stepping it every substep, and that the square root
+filter skips a stale sensor exactly.
+"""
+
+X_INITIAL = np.array([-3.14, 0.])
+
+
+def control_gains(dt):
+    """ The motor gains discretized at dt"""
+
+    A, B, C, D, Q_noise, R_noise = motor.continuous_model()
+    A_d, B_d, Q_d, R_d = c2d(A, B, dt, Q_noise, R_noise)
+    Q_weight, R_weight = motor.lqr_weights()
+    K = dlqr(A_d, B_d, Q_weight, R_weight)
+    L = discrete_kalman(A_d, C, Q_d, R_d)
+    Kff = feedforward_gains(B_d, Q_weight, R_weight)
+    u_max = np.asmatrix([[motor.MOTOR_TYPE.value[4]]])
+    return StateSpaceGains('MotorGains', A_d, B_d, C, D, Q_d, R_d, K, L, Kff, -u_max, u_max, dt)
+
+
+def make_sim(substep, control_period, sensor_groups, noise=True, observer=None, seed=0, mark_stale=False):
+    gains = control_gains(control_period * substep)
+    x_initial = np.asmatrix(X_INITIAL).T
+    if observer is None:
+        observer = StateSpaceObserver(GainsList(gains), x_initial)
+    controller = StateSpaceController(GainsList(gains), np.zeros((1, 1)), x_initial, gains.u_max, gains.u_min)
+    return MultiRateSim(motor.continuous_model(), substep, sensor_groups, observer, controller, X_INITIAL,
+                        np.zeros(1), control_period, noise=noise, mark_stale=mark_stale, seed=seed)
+
+
+def check_single_rate(duration=12.):
+    """ Largest difference in x from StateSpaceControlSim with every rate at 10 ms and no noise"""
+
+    result = make_sim(0.01, 1, [sensor_group([0, 1], 1)], noise=False).simulate(duration,
+                                                                                motor_test.reference_calculator)
+
+    gains = control_gains(0.01)
+    x_initial = np.asmatrix(X_INITIAL).T
+    quiet = GainsList(gains.replace(Q_noise=np.zeros((2, 2)), R_noise=np.zeros((2, 2))))
+    sim = StateSpaceControlSim(GainsList(gains), x_initial, np.zeros((1, 1)), x_initial, x_initial, gains.u_max,
+                               gains.u_min, plant=StateSpacePlant(quiet, x_initial))
+    x = np.array([np.asarray(sim.update(motor_test.reference_calculator(t))[0]).ravel()
+                  for t in np.arange(start=0., stop=duration, step=0.01)])
+    return np.max(np.abs(result.x - x[:len(result.x)]))
+
+
+def check_substep_jumps(duration=12.):
+    """ Largest difference in x between jumping a 1 ms plant between 10 ms events and stepping it every 1 ms, which
+        is forced here by a sensor that samples every substep"""
+
+    groups = [sensor_group(0, 10), sensor_group(1, 20, 5)]
+    jumped = make_sim(0.001, 10, groups, noise=False)
+    stepped = make_sim(0.001, 10, groups + [sensor_group([], 1)], noise=False)
+    x_jumped = jumped.simulate(duration, motor_test.reference_calculator).x
+    x_stepped = stepped.simulate(duration, motor_test.reference_calculator).x
+    return np.max(np.abs(x_jumped - x_stepped)), jumped.plant.jumps, stepped.plant.jumps
+
+
+def check_stale_sensor_update():
+    """ Largest difference of a SquareRootKalmanObserver update with one sensor missing from the textbook update, with
+        the motor's sensor noise reversed so R's diagonal isn't in ascending order"""
+
+    gains = control_gains(0.01)
+    R = np.asarray(gains.R_noise)
+    gains = gains.replace(R_noise=np.diag(np.diag(R)[::-1]))
+    x_hat = np.asmatrix(X_INITIAL).T
+    difference = 0.
+    for y in ([np.nan, 1.], [-3., np.nan]):
+        difference = max(difference, check_missing_sensors(gains, x_hat, np.eye(2), np.ones((1, 1)),
+                                                           np.asmatrix(y).T))
+    return difference
+
+
+def main(duration=12.):
+    print('single rate vs StateSpaceControlSim, largest difference %.3g' % check_single_rate(duration))
+    print('skipping a stale sensor vs the textbook Kalman update, largest difference %.3g'
+          % check_stale_sensor_update())
+    difference, jumps, steps = check_substep_jumps(duration)
+    print('plant jumps vs substeps, largest difference %.3g (%d jumps instead of %d steps)'
+          % (difference, jumps, steps))
+
+    groups = [sensor_group(0, 10), sensor_group(1, 20, 5)]
+    for label, stale in (('held sensors', False), ('stale sensors skipped', True)):
+        gains = control_gains(0.01)
+        observer = SquareRootKalmanObserver(GainsList(gains), np.asmatrix(X_INITIAL).T) if stale else None
+        sim = make_sim(0.001, 10, groups, observer=observer, mark_stale=stale)
+        start = time.perf_counter()
+        result = sim.simulate(duration, motor_test.reference_calculator)
+        elapsed = time.perf_counter() - start
+        r = np.stack([np.asarray(motor_test.reference_calculator(t - 0.01), dtype=float).ravel()
+                      for t in result.t])
+        print('%s: rms position error %.4f rad, %.0f ms for %d plant jumps' % (
+            label, np.sqrt(np.mean((result.x[:, 0] - r[:, 0]) ** 2)), elapsed * 1.e3, sim.plant.jumps))
+    print('cached discretizations: %d hits, %d misses' % (multirate_sim.discretize_interval.hits,
+                                                          multirate_sim.discretize_interval.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import time
+import numpy as np
+from robot import flywheel_test, motor_test
+from robot.models import flywheel, motor
+from utilities.state_space import robustness, sim_kernels
+
+"""
+How far off the motor and flywheel models can be before the designed gains stop working: the moment of inertia, gear
+ratio and efficiency are sampled around their nominal values, and the nominal K, L and Kff are run against every
+variant at once. Sampled efficiencies are clipped to 1, so the flywheel (nominally ideal) only ever gets worse.
+
+The motor's model folds the efficiency into its gear ratio (GEAR_RATIO = 3 / EFFICIENCY), so its variants are built the
+same way. The flywheel takes the efficiency directly.
+
+First checks the nominal variant: its simulation should be the same as the sim kernels', and with the limits taken off
+and r = 0, stepping the closed-loop matrix should give the same trajectory as the simulation. (The poles aren't just
+those of A - BK and A - LC even when the model matches, since the observer corrects with y measured after the step.)
+"""
+
+SPREAD = {'moment_of_inertia': 0.3, 'gear_ratio': 0.05, 'efficiency': 0.15}
+# A drivetrain can't deliver more torque than the ideal one
+UPPER_BOUNDS = {'efficiency': 1.}
+
+
+def motor_plant(moment_of_inertia, gear_ratio, efficiency):
+    return motor.batched_continuous_model(moment_of_inertia, gear_ratio / efficiency)
+
+
+def reference(reference_calculator, gains, duration):
+    return np.stack([np.asarray(reference_calculator(t), dtype=float).ravel()
+                     for t in np.arange(start=0., stop=duration, step=gains.dt)])
+
+
+def check_nominal(gains, plant_builder, nominal, r, x_initial):
+    """ Largest differences of the nominal variant from run_kernel, and of its closed-loop matrix from an unsaturated
+        simulation"""
+
+    parameters = {name: np.array([value]) for name, value in nominal.items()}
+    report = robustness.analyze_robustness(gains, plant_builder, parameters, r, x_initial)
+
+    matrices = sim_kernels.kernel_matrices(gains, gains.u_min, gains.u_max)
+    zeros = (np.zeros((1, len(r), gains.n)), np.zeros((1, len(r), gains.q)))
+    x, u, _, _ = sim_kernels.run_kernel('numpy', matrices, x_initial, x_initial, np.zeros(gains.p), r, None, *zeros)
+    sim_difference = max(np.max(np.abs(report.result.x - x)), np.max(np.abs(report.result.u - u)))
+
+    A_plant, B_plant = robustness.batched_c2d(*plant_builder(**parameters), gains.dt)
+    M = robustness.closed_loop_matrix(A_plant, B_plant, gains)[0]
+    K = np.asarray(gains.K, dtype=float)
+    steps = 200
+    result = robustness.simulate_variants(A_plant, B_plant, gains, np.zeros((steps, gains.n)), x_initial,
+                                          -np.inf, np.inf, u_initial=-K @ x_initial)
+    z = np.concatenate([x_initial, x_initial])
+    matrix_difference = 0.
+    for k in range(steps):
+        z = M @ z
+        matrix_difference = max(matrix_difference, np.max(np.abs(z[:gains.n] - result.x[0, k])),
+                                np.max(np.abs(z[gains.n:] - result.x_hat[0, k])))
+
+    return sim_difference, matrix_difference
+
+
+def print_report(label, report, elapsed):
+    variants = len(report.spectral_radius)
+    print('%s: %d variants in %.2f s, %d unstable' % (label, variants, elapsed, np.sum(~report.is_stable)))
+    for name in ('spectral_radius', 'rms_error', 'max_abs_u', 'saturated_fraction'):
+        percentiles = np.atleast_2d(report.percentiles[name].T)[0]
+        values, indices = report.worst[name]
+        value, index = np.atleast_1d(values)[0], np.atleast_1d(indices)[0]
+        worst = ', '.join('%s %.4g' % (parameter, samples[index]) for parameter, samples in report.parameters.items())
+        print('    %-18s p5 %.4g, p50 %.4g, p95 %.4g, worst %.4g (%s)'
+              % ((name,) + tuple(percentiles) + (value, worst)))
+
+
+def main(num=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    systems = (
+        ('motor', motor.create_gains, motor_plant, motor_test.reference_calculator, np.array([-3.14, 0.]), 12.,
+         {'moment_of_inertia': motor.MOMENT_OF_INERTIA, 'gear_ratio': 3., 'efficiency': motor.EFFICIENCY}),
+        ('flywheel', flywheel.create_gains, flywheel.batched_continuous_model, flywheel_test.reference_calculator,
+         np.array([0.]), 10., {'moment_of_inertia': flywheel.MOMENT_OF_INERTIA, 'gear_ratio': flywheel.GEAR_RATIO,
+                               'efficiency': flywheel.EFFICIENCY}),
+    )
+
+    for label, create_gains, plant_builder, reference_calculator, x_initial, duration, nominal in systems:
+        gains = create_gains()[0].get_gains(0)
+        r = reference(reference_calculator, gains, duration)
+
+        sim_difference, matrix_difference = check_nominal(gains, plant_builder, nominal, r, x_initial)
+        print('%s nominal: largest difference from run_kernel %.3g, closed-loop matrix vs unsaturated sim %.3g'
+              % (label, sim_difference, matrix_difference))
+
+        parameters = robustness.sample_parameters(nominal, SPREAD, num, rng, upper_bounds=UPPER_BOUNDS)
+        start = time.perf_counter()
+        report = robustness.analyze_robustness(gains, plant_builder, parameters, r, x_initial, noise_seed=seed)
+        print_report(label, report, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import numpy as np
+from robot import motor_test
+from robot.models import motor
+from utilities.state_space import sil_server
+from utilities.state_space.ss_sim import StateSpaceControlSim
+
+"""
+Software in the loop against the motor model: the plant runs in a PlantServer and the observer and controller talk to
+it over a local socket, the way external controller code would.
+
+Lockstep is checked against StateSpaceControlSim with the same noise (they should agree exactly), then the same loop
+is run against the wall clock to see how steady the pacing is.
+"""
+
+
+def make_sim():
+    gains_list, u_max, u_min = motor.create_gains()
+    x_initial = np.asmatrix([[-3.14], [0.]])
+    return StateSpaceControlSim(gains_list, x_hat_initial=x_initial, u_initial=np.zeros((1, 1)),
+                                x_initial=x_initial, r_initial=x_initial, u_max=u_max, u_min=u_min)
+
+
+async def serve(sim, steps, mode, speed=1., spin=0.):
+    server = sil_server.PlantServer(sim.plant, sim.u, mode=mode, speed=speed, spin=spin)
+    host, port = await server.start()
+    client = sil_server.PlantClient(sim.num_inputs, sim.num_sensor_inputs)
+    await client.connect(host, port)
+
+    try:
+        controller = asyncio.ensure_future(sil_server.run_controller(
+            client, sim.observer, sim.controller, motor_test.reference_calculator, sim.u, steps))
+        stats = await server.run(steps)
+        u, y, x_hat = await controller
+    finally:
+        client.close()
+        server.close()
+    return stats, u, y, x_hat
+
+
+def main(duration=12., realtime_duration=3.):
+    steps = int(round(duration / 0.01))
+
+    np.random.seed(0)
+    direct = make_sim()
+    u_direct = []
+    for k in range(steps):
+        _, u, _, _ = direct.update(motor_test.reference_calculator(k * 0.01))
+        u_direct.append(np.asarray(u, dtype=float).ravel())
+
+    np.random.seed(0)
+    stats, u, y, x_hat = asyncio.run(serve(make_sim(), steps, 'lockstep'))
+    print('lockstep: %d steps in %.3f s (%.0fx real time), largest difference from the direct sim %.3g'
+          % (stats.steps, stats.elapsed, duration / stats.elapsed, np.max(np.abs(u - np.array(u_direct)))))
+
+    realtime_steps = int(round(realtime_duration / 0.01))
+    for spin in (0., 0.002):
+        stats, _, _, _ = asyncio.run(serve(make_sim(), realtime_steps, 'realtime', spin=spin))
+        print('realtime, spinning %.1f ms: %d steps in %.3f s, lateness mean %.3f ms, p99 %.3f ms, max %.3f ms, '
+              '%d overruns, %d held inputs' % (spin * 1.e3, stats.steps, stats.elapsed, stats.mean_lateness * 1.e3,
+                                               stats.p99_lateness * 1.e3, stats.max_lateness * 1.e3, stats.overruns,
+                                               stats.held_inputs))
+
+
+if __name__ == '__main__':
+    main()
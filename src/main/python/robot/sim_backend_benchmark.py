@@ -0,0 +1,54 @@
+import time
+import numpy as np
+from robot import motor_test
+from utilities.state_space import sim_kernels
+from utilities.state_space.ss_sim import StateSpaceControlSim
+
+"""
+Checks that every simulation backend gives the same trajectories as the reference object path on the motor_test model,
+then times each of them, for one trajectory and for a batch.
+"""
+
+
+def make_sim():
+    gains_list, u_max, u_min = motor_test.create_gains()
+    x_initial = np.asmatrix([
+        [-3.14],
+        [0.]
+    ])
+    u_initial = np.zeros((1, 1))
+
+    return StateSpaceControlSim(gains_list, x_hat_initial=x_initial, u_initial=u_initial, x_initial=x_initial,
+                                r_initial=x_initial, u_max=u_max, u_min=u_min)
+
+
+def benchmark(duration=20., batch=1000, dtypes=(np.float64, np.float32)):
+    for use_ff in (False, True):
+        differences = sim_kernels.check_backend_equivalence(make_sim, 2., motor_test.reference_calculator,
+                                                            use_ff=use_ff)
+        print('use_ff=%s, largest difference from the reference: %s' % (use_ff, differences))
+
+    errors = sim_kernels.check_precision(make_sim, duration, motor_test.reference_calculator, dtype=np.float32)
+    print('float32, largest error relative to each signal\'s range: %s' % errors)
+
+    backends = ['reference', 'numpy'] + (['numba'] if sim_kernels.HAVE_NUMBA else [])
+    for backend in backends:
+        runs = [1] if backend == 'reference' else [1, batch]
+        for runs_batch in runs:
+            for dtype in dtypes:
+                sim = make_sim()
+                sim.backend = backend
+                if backend == 'numba':
+                    # The first call compiles the kernel
+                    sim.simulate(0.1, motor_test.reference_calculator, batch=runs_batch, dtype=dtype)
+                start = time.perf_counter()
+                result = sim.simulate(duration, motor_test.reference_calculator, batch=runs_batch, seed=0,
+                                      dtype=dtype)
+                elapsed = time.perf_counter() - start
+                steps = result.x.shape[0] * result.x.shape[1]
+                print('%-9s %-7s batch %5d: %8.3f s, %8.3f us per trajectory step'
+                      % (backend, np.dtype(dtype).name, runs_batch, elapsed, elapsed / steps * 1.e6))
+
+
+if __name__ == '__main__':
+    benchmark()
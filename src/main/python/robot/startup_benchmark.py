@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Measures how long the pre-compile gains generation takes from a cold interpreter, the same way the build_matrices
+gradle task runs it, and checks that none of the sim or plotting modules get pulled in along the way.
+"""
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that gain synthesis has no business importing
+HEAVY_MODULES = ['matplotlib', 'matplotlib.pyplot', 'tkinter', 'scipy.signal']
+
+CHILD_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+from robot import write_gains
+imported = time.perf_counter()
+write_gains.write_gains(sys.argv[1])
+done = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(imported - start, done - imported, ','.join(heavy))
+'''
+
+
+def benchmark(runs=5):
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = PYTHON_DIR + os.pathsep + environment.get('PYTHONPATH', '')
+
+    totals = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', CHILD_SCRIPT.format(heavy=HEAVY_MODULES),
+                                     out_dir + os.sep],
+                                    env=environment, check=True, capture_output=True, text=True).stdout
+            totals.append(time.perf_counter() - start)
+
+            import_time, write_time, heavy = output.split(' ')
+            heavy = heavy.strip()
+            print('process %.3f s (import %.3f s, generate and write %.3f s)%s'
+                  % (totals[-1], float(import_time), float(write_time),
+                     ', also imported ' + heavy if heavy else ''))
+
+    best = min(totals)
+    print('best of %d: %.3f s, %s' % (runs, best, 'under a second' if best < 1. else 'NOT under a second'))
+    return totals
+
+
+if __name__ == '__main__':
+    benchmark()
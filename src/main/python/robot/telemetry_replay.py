@@ -0,0 +1,73 @@
+import asyncio
+import numpy as np
+from robot import motor_test
+from robot.models import motor
+from utilities import telemetry
+from utilities.state_space.ss_sim import StateSpaceControlSim
+from utilities.state_space.state_space_gains import StateSpaceGains, GainsList
+from utilities.state_space.state_space_plant import StateSpacePlant
+from utilities.state_space.state_space_utils import c2d
+
+"""
+Stands in for the robot: replays simulated TestMotor telemetry to a local port and runs the receiver and the online
+model check against it, first with a plant that matches the model and then with one that has three times the moment
+of inertia. The check should stay quiet for the first and flag the second.
+"""
+
+PORT = 5800
+X_INITIAL = np.array([-3.14, 0.])
+
+
+def mismatched_gains(gains, moment_of_inertia):
+    """ The same gains, with the plant's A and B re-derived for a different moment of inertia"""
+
+    A, B, _, _, _, _ = motor.continuous_model(moment_of_inertia)
+    A_d, B_d, _, _ = c2d(A, B, gains.dt, gains.Q_noise, gains.R_noise)
+    return StateSpaceGains(gains.name, A_d, B_d, gains.C, gains.D, gains.Q_noise, gains.R_noise, gains.K, gains.L,
+                           gains.Kff, gains.u_min, gains.u_max, gains.dt)
+
+
+def recorded_telemetry(plant_gains, duration):
+    gains_list, u_max, u_min = motor.create_gains()
+    x_initial = np.asmatrix(X_INITIAL).T
+    # Only the plant is swapped, the observer and controller still use the model
+    plant = StateSpacePlant(GainsList(plant_gains), x_initial)
+    sim = StateSpaceControlSim(gains_list, x_hat_initial=x_initial, u_initial=np.zeros((1, 1)), x_initial=x_initial,
+                               r_initial=x_initial, u_max=u_max, u_min=u_min, plant=plant)
+    return telemetry.telemetry_from_sim(sim, duration, motor_test.reference_calculator)
+
+
+async def replay(gains, timestamps, values, speed, records_per_packet):
+    # StateSpacePlant scales its unit noise by Q_noise and R_noise, so those are the standard deviations here
+    Q = np.asarray(gains.Q_noise)
+    R = np.asarray(gains.R_noise)
+    estimator = telemetry.OnlineEstimator(gains, X_INITIAL, input_channels=[0], output_channels=[1, 2],
+                                          process_noise_covariance=Q @ Q.T, sensor_noise_covariance=R @ R.T)
+    receiver = telemetry.TelemetryReceiver(estimator=estimator)
+    host, port = await receiver.start('127.0.0.1', PORT)
+    try:
+        lateness = await telemetry.replay_telemetry(host, port, timestamps, values, records_per_packet, speed)
+        # Let the last datagrams land
+        await asyncio.sleep(0.05)
+    finally:
+        receiver.close()
+    return receiver, estimator, lateness
+
+
+def main(duration=12., speed=10., records_per_packet=5):
+    gains = motor.create_gains()[0].get_gains(0)
+
+    for label, plant_gains in (('matched plant', gains),
+                               ('3x moment of inertia', mismatched_gains(gains, 3. * motor.MOMENT_OF_INERTIA))):
+        timestamps, values = recorded_telemetry(plant_gains, duration)
+        receiver, estimator, lateness = asyncio.run(replay(gains, timestamps, values, speed, records_per_packet))
+
+        nis = estimator.history.latest()[:, -1]
+        print('%s: received %d, dropped %d, worst send lateness %.1f ms' % (label, receiver.received,
+                                                                            receiver.dropped, lateness * 1.e3))
+        print('    mean normalized innovation squared %.2f (expect about %d), mismatch flagged %d times, '
+              'flagged at the end: %s' % (np.nanmean(nis), gains.q, estimator.mismatch_count, estimator.mismatch))
+
+
+if __name__ == '__main__':
+    main()
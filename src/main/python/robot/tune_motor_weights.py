@@ -0,0 +1,33 @@
+import numpy as np
+from robot.models.motor import create_gains, lqr_weights
+from utilities.state_space.lqr_tuning import check_weight_gradient, quadratic_closed_loop_cost, tune_lqr_weights
+
+"""
+Tunes the diagonal of motor_test's Q_weight against a closed-loop cost, instead of by hand-adjusting p.
+
+The cost here is the expected quadratic cost of recovering from a position error of about a radian and a velocity
+error of about 10 rad/s, with a voltage penalty, but anything that returns a value and a gradient with respect to K
+can be used instead.
+"""
+
+
+def main():
+    gains = create_gains()[0].get_gains(0)
+    Q_weight, R_weight = lqr_weights()
+    A = np.asarray(gains.A)
+    B = np.asarray(gains.B)
+
+    cost = quadratic_closed_loop_cost(A, B, Q_eval=np.diag([1., 1.e-2]), R_eval=np.array([[5.e-2]]),
+                                      initial_covariance=np.diag([1., 100.]))
+
+    analytic, numeric = check_weight_gradient(A, B, Q_weight, R_weight, cost)
+    print('Analytic gradient', analytic, 'finite differences', numeric)
+
+    result = tune_lqr_weights(A, B, Q_weight, R_weight, cost, tune_R=False)
+    print('Starting cost %.4f, K = %s' % (cost(np.asarray(gains.K))[0], gains.K))
+    print('Tuned cost %.4f after %d synthesis calls, K = %s' % (result.cost, result.synthesis_calls, result.K))
+    print('Q_weight =\n', result.Q_weight)
+
+
+if __name__ == '__main__':
+    main()
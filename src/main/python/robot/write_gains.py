@@ -1,27 +1,29 @@
+from utilities.state_space.gains_registry import discover_gains, generate_gains
 from utilities.state_space.gains_writer import GainsWriter
-from robot import motor_test
-from robot import flywheel_test
 
 """
 This Python script is run before Java is compiled, so any constants or such that need to be generated via Python
 should be generated here
+Every module in robot/models registers its own gains factory and output directory with register_gains, so adding a
+mechanism doesn't mean touching this file. Only the model definitions are imported, so none of the sim or plotting
+code gets loaded
 """
 
-# Working directory when the gradle task is run defaults to project root
-# Multiple output directories can be used in addition to multiple sets of gains
-OUT_DIR = './src/main/java/frc/team687/robot/constants/'
+# Package that holds the model definitions
+MODELS_PACKAGE = 'robot.models'
 
 
-def write_gains():
-    # Create a GainsWriter from a GainsList
-    # In this instance, the subsystem in question is given its own individual Python file from which gains are created
-    gains_list = flywheel_test.create_gains()[0]
-    gains_list.add_gains(motor_test.create_gains()[0].get_gains(0))
+def write_gains(out_dir=None, max_workers=None):
+    # Find every registered gains factory and run them all in parallel, merging the results into a single GainsList
+    factories = discover_gains(MODELS_PACKAGE)
+    gains_list, paths = generate_gains(factories, max_workers=max_workers)
+    # Every set of gains goes to its factory's directory, unless everything is being redirected somewhere else
+    if out_dir is not None:
+        paths = [out_dir] * len(paths)
     writer = GainsWriter(gains_list)
-    # # Write the gains to the files indicated by their names, in the directory indicated
-    writer.write_all([OUT_DIR, OUT_DIR])
+    # Write the gains to the files indicated by their names, in the directory indicated
+    writer.write_all(paths)
 
 
 if __name__ == '__main__':
     write_gains()
-
@@ -0,0 +1,208 @@
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+from utilities.state_space.state_space_gains import GainsList, StateSpaceGains
+
+"""
+Simulates several mechanisms (drive, flywheel, arm, elevator...) as one system without ever forming the dense
+(sum of n)^2 matrices.
+
+The whole-robot state is the concatenation of every mechanism's state, so the composite A is block diagonal, plus
+whatever coupling terms are given between mechanisms. Mechanisms with the same dimensions are stacked into groups and
+stepped with one batched matmul per group, and the coupling is a sparse matrix, so a step costs O(sum of n_i^2 + nnz)
+instead of O((sum of n_i)^2).
+"""
+
+
+class _MechanismGroup(object):
+    """ Stacked matrices for every mechanism with a particular (n, p, q)"""
+
+    def __init__(self, members, gains, state_index, input_index, output_index):
+        self.members = members
+
+        def stack(name):
+            return np.stack([np.asarray(getattr(gains[i], name), dtype=float) for i in members])
+
+        self.A = stack('A')
+        self.B = stack('B')
+        self.C = stack('C')
+        self.D = stack('D')
+        self.K = stack('K')
+        self.L = stack('L')
+        self.Q_noise = stack('Q_noise')
+        self.R_noise = stack('R_noise')
+        self.A_LC = self.A - self.L @ self.C
+        self.u_min = np.stack([np.asarray(gains[i].u_min, dtype=float).ravel() for i in members])
+        self.u_max = np.stack([np.asarray(gains[i].u_max, dtype=float).ravel() for i in members])
+
+        # Where each member's states, inputs and outputs live in the flat composite vectors
+        self.states = np.stack([state_index[i] for i in members])
+        self.inputs = np.stack([input_index[i] for i in members])
+        self.outputs = np.stack([output_index[i] for i in members])
+
+    @staticmethod
+    def apply(M, v):
+        """ Batched M[i] * v[i] for stacked matrices M (g, a, b) and stacked vectors v (g, b)"""
+        return (M @ v[:, :, None])[:, :, 0]
+
+
+class CompositeSystem(object):
+    """
+    A whole-robot system made of one StateSpaceGains per mechanism. Each mechanism keeps its own observer and
+    controller, exactly like StateSpaceControlSim, and the plants can be coupled with sparse cross terms.
+
+    coupling maps (i, j) to an (n_i x n_j) matrix that gets added to the dynamics of mechanism i, so
+    x_i[k+1] = A_i * x_i[k] + B_i * u_i[k] + sum over j of A_ij * x_j[k]. The observers and controllers don't know
+    about the coupling, the same as on the robot.
+
+    All vectors are flat, in mechanism order: x and x_hat have sum(n_i) entries, u has sum(p_i) and y has sum(q_i).
+
+    Every mechanism has to be discretized at the same dt, since the whole system steps together. That isn't true of
+    the gains in robot/models as they are (the motor runs at 0.01 s and the flywheel at 0.02 s), and they can't just be
+    re-discretized here because K and L were designed for their own dt. Synthesize the gains at a common dt to compose
+    them, or simulate mechanisms that really do run at different rates separately.
+    """
+
+    def __init__(self, gains, x_initial, x_hat_initial=None, u_initial=None, coupling=None):
+        if isinstance(gains, GainsList):
+            gains = [gains.get_gains(i) for i in range(len(gains))]
+        for mechanism_gains in gains:
+            assert isinstance(mechanism_gains, StateSpaceGains), 'Every mechanism needs a set of StateSpaceGains'
+        assert len(set(mechanism_gains.dt for mechanism_gains in gains)) == 1, \
+            'Every mechanism must share one dt, synthesize the gains at a common dt to compose them'
+
+        self.gains = gains
+        self.dt = gains[0].dt
+
+        n = [mechanism_gains.n for mechanism_gains in gains]
+        p = [mechanism_gains.p for mechanism_gains in gains]
+        q = [mechanism_gains.q for mechanism_gains in gains]
+        self.state_offsets = np.cumsum([0] + n)
+        self.input_offsets = np.cumsum([0] + p)
+        self.output_offsets = np.cumsum([0] + q)
+        self.num_states = self.state_offsets[-1]
+        self.num_inputs = self.input_offsets[-1]
+        self.num_sensor_inputs = self.output_offsets[-1]
+
+        state_index = [np.arange(self.state_offsets[i], self.state_offsets[i + 1]) for i in range(len(gains))]
+        input_index = [np.arange(self.input_offsets[i], self.input_offsets[i + 1]) for i in range(len(gains))]
+        output_index = [np.arange(self.output_offsets[i], self.output_offsets[i + 1]) for i in range(len(gains))]
+
+        # Group mechanisms by shape, so each group is stepped with a single batched matmul
+        shapes = {}
+        for i, shape in enumerate(zip(n, p, q)):
+            shapes.setdefault(shape, []).append(i)
+        self.groups = [_MechanismGroup(members, gains, state_index, input_index, output_index)
+                       for members in shapes.values()]
+
+        self.coupling = self._build_coupling(coupling)
+
+        self.x = self._flat(x_initial, self.num_states)
+        self.x_hat = self.x.copy() if x_hat_initial is None else self._flat(x_hat_initial, self.num_states)
+        self.u = np.zeros(self.num_inputs) if u_initial is None else self._flat(u_initial, self.num_inputs)
+        self.y = self.output(self.x, self.u)
+
+    @staticmethod
+    def _flat(value, size):
+        """ Accepts either a flat vector or a list of per-mechanism column vectors"""
+
+        if isinstance(value, (list, tuple)):
+            value = np.concatenate([np.asarray(part, dtype=float).ravel() for part in value])
+        value = np.array(value, dtype=float).ravel()
+        assert value.shape == (size,), 'Expected %d entries, got %d' % (size, value.size)
+        return value
+
+    def _build_coupling(self, coupling):
+        if not coupling:
+            return None
+
+        rows = []
+        columns = []
+        values = []
+        for (i, j), block in coupling.items():
+            block = np.asarray(block, dtype=float)
+            assert block.shape == (self.gains[i].n, self.gains[j].n), \
+                'Coupling from mechanism %d to %d must be %d x %d' % (j, i, self.gains[i].n, self.gains[j].n)
+            block_rows, block_columns = np.nonzero(block)
+            rows.append(self.state_offsets[i] + block_rows)
+            columns.append(self.state_offsets[j] + block_columns)
+            values.append(block[block_rows, block_columns])
+
+        return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                       shape=(self.num_states, self.num_states))
+
+    def mechanism_slice(self, index):
+        """ Slice of the flat state vector belonging to one mechanism"""
+        return slice(self.state_offsets[index], self.state_offsets[index + 1])
+
+    def output(self, x, u):
+        y = np.empty(self.num_sensor_inputs)
+        for group in self.groups:
+            y[group.outputs] = group.apply(group.C, x[group.states]) + group.apply(group.D, u[group.inputs])
+        return y
+
+    def step_plant(self, u, noise=True):
+        """ Advances every plant one step with input u, and returns the new sensor readings"""
+
+        x_next = np.empty(self.num_states)
+        y = np.empty(self.num_sensor_inputs)
+        for group in self.groups:
+            x_group = group.apply(group.A, self.x[group.states]) + group.apply(group.B, u[group.inputs])
+            if noise:
+                # Same noise model as StateSpacePlant, Q_noise and R_noise times standard normal samples
+                x_group += group.apply(group.Q_noise, np.random.randn(*x_group.shape))
+            x_next[group.states] = x_group
+        if self.coupling is not None:
+            x_next += self.coupling @ self.x
+        self.x = x_next
+
+        for group in self.groups:
+            y_group = group.apply(group.C, self.x[group.states]) + group.apply(group.D, u[group.inputs])
+            if noise:
+                y_group += group.apply(group.R_noise, np.random.randn(*y_group.shape))
+            y[group.outputs] = y_group
+        self.y = y
+
+        return self.y
+
+    def update_observers(self, u, y):
+        x_hat_next = np.empty(self.num_states)
+        for group in self.groups:
+            x_hat_next[group.states] = (group.apply(group.A_LC, self.x_hat[group.states])
+                                        + group.apply(group.B, u[group.inputs])
+                                        + group.apply(group.L, y[group.outputs]))
+        self.x_hat = x_hat_next
+        return self.x_hat
+
+    def update_controllers(self, r):
+        u = np.empty(self.num_inputs)
+        for group in self.groups:
+            u_group = group.apply(group.K, r[group.states] - self.x_hat[group.states])
+            u[group.inputs] = np.clip(u_group, group.u_min, group.u_max)
+        self.u = u
+        return self.u
+
+    def update(self, r, noise=True):
+        """ One step of every mechanism, in the same order as StateSpaceControlSim.update"""
+
+        r = self._flat(r, self.num_states)
+        self.step_plant(self.u, noise)
+        self.update_observers(self.u, self.y)
+        self.update_controllers(r)
+
+        return self.x, self.u, self.y, self.x_hat
+
+    def update_with_voltage(self, u, noise=True):
+        self.u = self._flat(u, self.num_inputs)
+        self.step_plant(self.u, noise)
+        self.update_observers(self.u, self.y)
+
+        return self.x, self.u, self.y, self.x_hat
+
+    def dense_A(self):
+        """ The full composite A matrix, coupling included. Only meant for analysis and checking, not stepping"""
+
+        A = scipy.linalg.block_diag(*[np.asarray(mechanism_gains.A, dtype=float) for mechanism_gains in self.gains])
+        if self.coupling is not None:
+            A = A + self.coupling.toarray()
+        return A
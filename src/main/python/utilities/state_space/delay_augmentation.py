@@ -0,0 +1,232 @@
+import numpy as np
+import scipy.linalg
+from utilities.state_space.state_space_controller import StateSpaceController
+from utilities.state_space.state_space_observer import StateSpaceObserver
+from utilities.state_space.state_space_plant import StateSpacePlant
+
+"""
+Input delay and sensor latency, like the frame or two the Talon SRX CAN path adds.
+
+A d step delay is usually modeled by augmenting the state with the d pending inputs (or measurements), which makes A
+(n + d*p) x (n + d*p) and every step and every Riccati solve grow quadratically with the delay. But the extra states
+only ever shift along by one, so here they're kept in circular buffers instead, and the synthesis uses the shift
+structure:
+
+    Input delay:   the LQR gain of the augmented system is K * [A^d, A^(d-1) B, ..., B], the base dlqr gain applied to
+                   the state predicted d steps ahead with the inputs already sent. So the controller only needs the
+                   base K, and predicting is d steps of x = Ax + Bu.
+    Sensor delay:  a measurement that arrives d steps late is of the state d steps ago, and nothing newer is known
+                   about. So the base Kalman filter runs on a lagged estimate, which is propagated forward through the
+                   inputs applied since.
+
+Both cost O(d * n^2) per step. augmented_matrices builds the dense augmented system for checking this.
+"""
+
+
+class DelayLine(object):
+    """ A fixed-length circular buffer of vectors. push adds a new value and returns the one from length pushes ago"""
+
+    def __init__(self, length, initial):
+        initial = np.asarray(initial, dtype=float).ravel()
+        self.length = length
+        self.buffer = np.tile(initial, (max(length, 1), 1))
+        self.head = 0
+
+    def push(self, value):
+        value = np.asarray(value, dtype=float).ravel()
+        if self.length == 0:
+            return value
+        oldest = self.buffer[self.head].copy()
+        self.buffer[self.head] = value
+        self.head = (self.head + 1) % self.length
+        return oldest
+
+    def ordered(self):
+        """ Every buffered value, oldest first"""
+        if self.length == 0:
+            return self.buffer[:0]
+        return np.concatenate([self.buffer[self.head:], self.buffer[:self.head]])
+
+
+def propagate(A, B, x, inputs):
+    """ Steps x = Ax + Bu through inputs (oldest first) with no noise. x is a flat array"""
+
+    for u in inputs:
+        x = A @ x + B @ u
+    return x
+
+
+def predictor_gain(A, B, K, delay):
+    """ The gain of the dense augmented system, K * [A^d, A^(d-1) B, ..., AB, B], acting on [x; oldest input; ...;
+        newest input]. Only needed to compare against a dense synthesis, the controller never forms it"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    K = np.asarray(K, dtype=float)
+
+    blocks = [B]
+    for _ in range(delay - 1):
+        blocks.insert(0, A @ blocks[0])
+    return K @ np.hstack([np.linalg.matrix_power(A, delay)] + blocks)
+
+
+def augmented_matrices(A, B, C, input_delay=0, sensor_delay=0):
+    """ The dense augmented system, with state [x; pending inputs, oldest first; past outputs, oldest first].
+        The newest input enters the input chain, and the measurement is the oldest stored output. This is the
+        quadratically growing form the rest of this module avoids, kept here as a reference"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    C = np.asarray(C, dtype=float)
+    n = A.shape[0]
+    p = B.shape[1]
+    q = C.shape[0]
+    size = n + input_delay * p + sensor_delay * q
+
+    A_aug = np.zeros((size, size))
+    B_aug = np.zeros((size, p))
+    C_aug = np.zeros((q, size))
+
+    A_aug[:n, :n] = A
+    if input_delay == 0:
+        B_aug[:n] = B
+    else:
+        # The oldest pending input drives the plant, the rest shift along, and the new one goes in last
+        A_aug[:n, n:n + p] = B
+        for i in range(input_delay - 1):
+            A_aug[n + i * p:n + (i + 1) * p, n + (i + 1) * p:n + (i + 2) * p] = np.eye(p)
+        B_aug[n + (input_delay - 1) * p:n + input_delay * p] = np.eye(p)
+
+    offset = n + input_delay * p
+    if sensor_delay == 0:
+        C_aug[:, :n] = C
+    else:
+        for i in range(sensor_delay - 1):
+            A_aug[offset + i * q:offset + (i + 1) * q, offset + (i + 1) * q:offset + (i + 2) * q] = np.eye(q)
+        # The newest stored output is C times the current state
+        A_aug[offset + (sensor_delay - 1) * q:offset + sensor_delay * q, :n] = C
+        C_aug[:, offset:offset + q] = np.eye(q)
+
+    return A_aug, B_aug, C_aug
+
+
+class DelayedPlant(StateSpacePlant):
+    """ A StateSpacePlant whose inputs take effect input_delay steps after they're sent, and whose measurements
+        arrive sensor_delay steps after they're taken"""
+
+    def __init__(self, gains, x_initial, input_delay=1, sensor_delay=0, u_initial=None):
+        super().__init__(gains, x_initial)
+
+        if u_initial is None:
+            u_initial = np.zeros(self.current_gains.p)
+        self.input_delay = input_delay
+        self.sensor_delay = sensor_delay
+        self.inputs = DelayLine(input_delay, u_initial)
+        self.outputs = DelayLine(sensor_delay, self.y)
+        # What's actually being applied to the plant and what's actually true right now, for plotting and checking
+        self.u_applied = np.asmatrix(np.asarray(u_initial, dtype=float).reshape(-1, 1))
+        self.y_true = self.y
+
+    def step(self, u, process_noise, sensor_noise):
+        gains = self.current_gains
+
+        self.u_applied = np.asmatrix(self.inputs.push(u).reshape(-1, 1))
+        self.x = gains.A * self.x + gains.B * self.u_applied + process_noise
+        self.y_true = gains.C * self.x + gains.D * self.u_applied + sensor_noise
+        self.y = np.asmatrix(self.outputs.push(self.y_true).reshape(-1, 1))
+
+        return self.y
+
+
+class DelayCompensatedObserver(StateSpaceObserver):
+    """
+    Runs the base observer on an estimate of the state sensor_delay steps ago, which is what the incoming
+    measurements are of, then predicts forward to now through the inputs applied since. update takes the commands as
+    they're sent, the same as StateSpaceObserver, and keeps track of when each of them took effect.
+    """
+
+    def __init__(self, gains, x_hat_initial, input_delay=1, sensor_delay=0, u_initial=None):
+        super().__init__(gains, x_hat_initial)
+
+        if u_initial is None:
+            u_initial = np.zeros(self.current_gains.p)
+        self.input_delay = input_delay
+        self.sensor_delay = sensor_delay
+        self.x_hat_lagged = np.asarray(x_hat_initial, dtype=float).ravel()
+        # Commands go in as they're sent and come out when they take effect
+        self.sent = DelayLine(input_delay, u_initial)
+        # Inputs that took effect after the state the measurements are of, oldest first
+        self.applied = DelayLine(sensor_delay, u_initial)
+        self.steps = 0
+
+    def update(self, u, y):
+        gains = self.current_gains
+        A = np.asarray(gains.A)
+        B = np.asarray(gains.B)
+
+        u_applied = self.sent.push(u)
+        u_lagged = self.applied.push(u_applied)
+        self.steps += 1
+
+        # Until the first delayed measurement shows up, the lagged estimate has nothing to correct with
+        if self.steps > self.sensor_delay:
+            A_LC = np.asarray(gains.A - gains.L * gains.C)
+            self.x_hat_lagged = (A_LC @ self.x_hat_lagged + B @ u_lagged
+                                 + np.asarray(gains.L) @ np.asarray(y, dtype=float).ravel())
+
+        x_hat = propagate(A, B, self.x_hat_lagged, self.applied.ordered())
+        self.x_hat = np.asmatrix(x_hat.reshape(-1, 1))
+
+        return self.x_hat
+
+
+class DelayCompensatedController(StateSpaceController):
+    """ Applies the base gain K to the state predicted input_delay steps ahead, which is when the new command will
+        take effect, using the commands that are already on their way. This is the LQR controller of the augmented
+        system, without the augmented Riccati equation"""
+
+    def __init__(self, gains, u_initial, r_initial, u_max, u_min, input_delay=1):
+        super().__init__(gains, u_initial, r_initial, u_max, u_min)
+
+        self.input_delay = input_delay
+        self.pending = DelayLine(input_delay, u_initial)
+        self.x_predicted = None
+
+    def predict(self, x_hat):
+        gains = self.current_gains
+        return np.asmatrix(propagate(np.asarray(gains.A), np.asarray(gains.B), np.asarray(x_hat, dtype=float).ravel(),
+                                     self.pending.ordered()).reshape(-1, 1))
+
+    def bounded_update(self, r, x_hat):
+        self.x_predicted = self.predict(x_hat)
+        u = np.clip(self.update(r, self.x_predicted), self.u_min, self.u_max)
+        self.pending.push(u)
+        return u
+
+    def bounded_update_ff(self, r, x_hat):
+        self.x_predicted = self.predict(x_hat)
+        u = np.clip(self.update_ff(r, self.x_predicted), self.u_min, self.u_max)
+        self.pending.push(u)
+        return u
+
+
+def check_predictor_gain(gains, Q_weight, R_weight, input_delay):
+    """ Solves the dense augmented DARE (zero weight on the buffered inputs) and returns the largest difference
+        between its gain and predictor_gain, which should only be rounding"""
+
+    A_aug, B_aug, _ = augmented_matrices(gains.A, gains.B, gains.C, input_delay=input_delay)
+    n = gains.n
+    Q_aug = np.zeros(A_aug.shape)
+    Q_aug[:n, :n] = Q_weight
+
+    A = np.asarray(gains.A, dtype=float)
+    B = np.asarray(gains.B, dtype=float)
+    Q_weight = np.asarray(Q_weight, dtype=float)
+    R_weight = np.asarray(R_weight, dtype=float)
+
+    P_aug = scipy.linalg.solve_discrete_are(A_aug, B_aug, Q_aug, R_weight)
+    K_aug = np.linalg.solve(R_weight + B_aug.T @ P_aug @ B_aug, B_aug.T @ P_aug @ A_aug)
+    P = scipy.linalg.solve_discrete_are(A, B, Q_weight, R_weight)
+    K = np.linalg.solve(R_weight + B.T @ P @ B, B.T @ P @ A)
+
+    return np.max(np.abs(K_aug - predictor_gain(A, B, K, input_delay)))
@@ -0,0 +1,317 @@
+import itertools
+import numpy as np
+import scipy.optimize
+from collections import namedtuple
+from utilities.state_space.mpc_controller import build_condensed_problem
+from utilities.state_space.state_space_controller import StateSpaceController
+
+"""
+Explicit MPC for small systems: the input-constrained MPC problem from mpc_controller.py is solved offline for every
+parameter theta = [x; r] in a bounded box, which gives a piecewise-affine control law
+    u = F_i * theta + g_i   for theta in region i = {theta : A_i * theta <= b_i}
+Online, the region containing theta is found with a binary space partition tree whose hyperplanes are taken from the
+regions' own facets, so a tick is a short tree descent plus a few inequality checks, no matter how hard the QP was.
+
+With only input bounds, the constraints of the condensed QP don't depend on theta and are always linearly independent,
+so every combination of active bounds gives one candidate region. Enumerating them is exact, but there are 3^(N*p)
+combinations, so this is only meant for short horizons on small models like flywheel_test and motor_test.
+"""
+
+CriticalRegion = namedtuple('CriticalRegion', ['A', 'b', 'F', 'g', 'active_set'])
+
+# Regions are allowed to overlap by this much when checking whether a point is inside one
+REGION_TOLERANCE = 1.e-8
+
+
+def _chebyshev_radius(A, b):
+    """ Radius of the largest ball inside {theta : A * theta <= b}, or -1 if the polyhedron is empty"""
+
+    norms = np.linalg.norm(A, axis=1)
+    d = A.shape[1]
+    cost = np.zeros(d + 1)
+    cost[-1] = -1.
+    result = scipy.optimize.linprog(cost, A_ub=np.hstack([A, norms[:, None]]), b_ub=b,
+                                    bounds=[(None, None)] * d + [(0., None)], method='highs')
+    if result.status != 0:
+        return -1.
+    return result.x[-1]
+
+
+def _support_interval(A, b, direction):
+    """ The range of direction.T * theta over the polyhedron {theta : A * theta <= b}"""
+
+    d = A.shape[1]
+    bounds = [(None, None)] * d
+    lower = scipy.optimize.linprog(direction, A_ub=A, b_ub=b, bounds=bounds, method='highs').fun
+    upper = -scipy.optimize.linprog(-direction, A_ub=A, b_ub=b, bounds=bounds, method='highs').fun
+    return lower, upper
+
+
+def _split_directions(regions, d, max_directions):
+    """ Candidate normals for the partition's hyperplanes: the coordinate axes, then the most common facet normals.
+        Critical regions of the same problem share a lot of facet orientations, so this list stays short"""
+
+    directions = [np.eye(d)[i] for i in range(d)]
+    counts = [0] * d
+    for region in regions:
+        for row in region.A:
+            normal = row / np.linalg.norm(row)
+            for i, direction in enumerate(directions):
+                if np.allclose(normal, direction, atol=1.e-9) or np.allclose(normal, -direction, atol=1.e-9):
+                    counts[i] += 1
+                    break
+            else:
+                directions.append(normal)
+                counts.append(1)
+
+    # The axes always stay, the rest are kept by how many facets use them
+    order = d + np.argsort(counts[d:])[::-1]
+    keep = list(range(d)) + list(order[:max(max_directions - d, 0)])
+    return np.array([directions[i] for i in keep])
+
+
+def critical_regions(gains, Q_weight, R_weight, u_min, u_max, theta_min, theta_max, horizon):
+    """ Solves the multiparametric QP by enumerating active sets. Returns the list of non-empty critical regions.
+        Each region's A and b include the parameter box, so the regions exactly tile the box"""
+
+    problem = build_condensed_problem(gains, Q_weight, R_weight, u_min, u_max, horizon)
+    p = problem.p
+    num_inputs = problem.H.shape[0]
+
+    H_inv = np.linalg.inv(problem.H)
+    # The QP's linear term is F * theta with theta = [x; r]
+    F = np.hstack([problem.F_x, -problem.F_r])
+    d = F.shape[1]
+
+    G = np.vstack([np.eye(num_inputs), -np.eye(num_inputs)])
+    w = np.concatenate([problem.upper, -problem.lower])
+
+    theta_min = np.asarray(theta_min, dtype=float).ravel()
+    theta_max = np.asarray(theta_max, dtype=float).ravel()
+    assert len(theta_min) == d and len(theta_max) == d, 'The parameter box must bound both the state and reference'
+    box_A = np.vstack([np.eye(d), -np.eye(d)])
+    box_b = np.concatenate([theta_max, -theta_min])
+
+    regions = []
+    # 0 is free, 1 is at the lower bound and 2 is at the upper bound, for each stacked input
+    for combination in itertools.product((0, 1, 2), repeat=num_inputs):
+        combination = np.array(combination)
+        active = np.concatenate([np.flatnonzero(combination == 2), num_inputs + np.flatnonzero(combination == 1)])
+        inactive = np.setdiff1d(np.arange(2 * num_inputs), active)
+
+        if len(active) > 0:
+            G_A = G[active]
+            # From the KKT conditions, lambda(theta) = lambda_theta * theta + lambda_0
+            # and U(theta) = -H^-1 * (F * theta + G_A.T * lambda(theta))
+            M = np.linalg.inv(G_A @ H_inv @ G_A.T)
+            lambda_theta = -M @ G_A @ H_inv @ F
+            lambda_0 = -M @ w[active]
+            U_theta = -H_inv @ (F + G_A.T @ lambda_theta)
+            U_0 = -H_inv @ (G_A.T @ lambda_0)
+        else:
+            lambda_theta = np.zeros((0, d))
+            lambda_0 = np.zeros(0)
+            U_theta = -H_inv @ F
+            U_0 = np.zeros(num_inputs)
+
+        # Dual feasibility (lambda >= 0), primal feasibility of the inactive bounds, and the parameter box
+        A = np.vstack([-lambda_theta, G[inactive] @ U_theta, box_A])
+        b = np.concatenate([lambda_0, w[inactive] - G[inactive] @ U_0, box_b])
+
+        # Rows that don't depend on theta are either always satisfied or make the region empty
+        constant = np.linalg.norm(A, axis=1) < 1.e-12
+        if np.any(b[constant] < -REGION_TOLERANCE):
+            continue
+        A = A[~constant]
+        b = b[~constant]
+
+        if _chebyshev_radius(A, b) <= 1.e-9:
+            continue
+
+        regions.append(CriticalRegion(A, b, U_theta[:p], U_0[:p], tuple(combination)))
+
+    return regions
+
+
+class ExplicitMPCTable(object):
+    """
+    A piecewise-affine control law and the partition tree used to look it up. All of the data is stored in flat arrays so
+    it can be written out to Java as-is by GainsWriter.write_explicit_mpc.
+    """
+
+    def __init__(self, name, regions, theta_min, theta_max, u_min, u_max, leaf_size=2, max_depth=32,
+                 max_directions=32):
+        self.name = name
+        self.theta_min = np.asarray(theta_min, dtype=float).ravel()
+        self.theta_max = np.asarray(theta_max, dtype=float).ravel()
+        self.u_min = np.asarray(u_min, dtype=float).ravel()
+        self.u_max = np.asarray(u_max, dtype=float).ravel()
+
+        self.tolerance = REGION_TOLERANCE
+        self.num_regions = len(regions)
+        self.d = len(self.theta_min)
+        self.p = len(self.u_min)
+        assert self.num_regions > 0, 'There must be at least one region'
+
+        # Region constraints are stacked, with row_start[i]:row_start[i+1] belonging to region i
+        self.row_start = np.cumsum([0] + [len(region.b) for region in regions]).astype(int)
+        self.constraint_A = np.vstack([region.A for region in regions])
+        self.constraint_b = np.concatenate([region.b for region in regions])
+        self.law_gain = np.stack([region.F for region in regions])
+        self.law_offset = np.stack([region.g for region in regions])
+
+        # The extent of every region along every split direction, shape (num_regions, num_directions, 2)
+        self.directions = _split_directions(regions, self.d, max_directions)
+        self.support = np.array([[_support_interval(region.A, region.b, direction)
+                                  for direction in self.directions] for region in regions])
+
+        self._build_tree(leaf_size, max_depth)
+
+    def _choose_split(self, members):
+        """ Picks the hyperplane that leaves the fewest regions on its larger side. Regions that straddle the
+            hyperplane go to both sides"""
+
+        best = None
+        best_cost = len(members)
+        for k in range(len(self.directions)):
+            lower = self.support[members, k, 0]
+            upper = self.support[members, k, 1]
+            for value in np.unique(np.concatenate([lower, upper])):
+                left_members = members[lower < value - REGION_TOLERANCE]
+                right_members = members[upper > value + REGION_TOLERANCE]
+                cost = max(len(left_members), len(right_members))
+                if cost < best_cost and len(left_members) > 0 and len(right_members) > 0:
+                    best_cost = cost
+                    best = (k, value, left_members, right_members)
+        return best
+
+    def _build_tree(self, leaf_size, max_depth):
+        split_direction = []
+        split_value = []
+        left = []
+        right = []
+        leaf_start = []
+        leaf_count = []
+        leaf_regions = []
+
+        def add_node():
+            for array in (split_direction, left, right, leaf_start, leaf_count):
+                array.append(-1)
+            split_value.append(0.)
+            return len(split_direction) - 1
+
+        # Iterative so deep trees don't hit the recursion limit
+        root = add_node()
+        stack = [(root, np.arange(self.num_regions), 0)]
+        while stack:
+            node, members, depth = stack.pop()
+
+            split = None
+            if len(members) > leaf_size and depth < max_depth:
+                split = self._choose_split(members)
+
+            if split is None:
+                leaf_start[node] = len(leaf_regions)
+                leaf_count[node] = len(members)
+                leaf_regions.extend(int(member) for member in members)
+                continue
+
+            k, value, left_members, right_members = split
+            left_node = add_node()
+            right_node = add_node()
+            split_direction[node] = k
+            split_value[node] = value
+            left[node] = left_node
+            right[node] = right_node
+            stack.append((left_node, left_members, depth + 1))
+            stack.append((right_node, right_members, depth + 1))
+
+        self.split_direction = np.array(split_direction, dtype=int)
+        self.split_value = np.array(split_value, dtype=float)
+        self.left = np.array(left, dtype=int)
+        self.right = np.array(right, dtype=int)
+        self.leaf_start = np.array(leaf_start, dtype=int)
+        self.leaf_count = np.array(leaf_count, dtype=int)
+        self.leaf_regions = np.array(leaf_regions, dtype=int)
+
+    def locate(self, theta):
+        """ Returns the index of the region containing theta. If theta is outside every region (outside the parameter
+            box, or in a numerical sliver between regions), the least-violated candidate region is returned"""
+
+        theta = np.asarray(theta, dtype=float).ravel()
+
+        node = 0
+        while self.split_direction[node] >= 0:
+            if self.directions[self.split_direction[node]] @ theta <= self.split_value[node]:
+                node = self.left[node]
+            else:
+                node = self.right[node]
+
+        best_region = -1
+        best_violation = np.inf
+        for i in range(self.leaf_start[node], self.leaf_start[node] + self.leaf_count[node]):
+            region = self.leaf_regions[i]
+            rows = slice(self.row_start[region], self.row_start[region + 1])
+            violation = np.max(self.constraint_A[rows] @ theta - self.constraint_b[rows])
+            if violation < best_violation:
+                best_violation = violation
+                best_region = region
+            if violation <= self.tolerance:
+                break
+
+        return best_region
+
+    def evaluate(self, theta):
+        """ The constrained-optimal first input for theta = [x; r]"""
+
+        theta = np.asarray(theta, dtype=float).ravel()
+        region = self.locate(theta)
+        u = self.law_gain[region] @ theta + self.law_offset[region]
+        return np.clip(u, self.u_min, self.u_max)
+
+
+def generate_explicit_mpc(gains, Q_weight, R_weight, u_min, u_max, x_min, x_max, r_min=None, r_max=None,
+                          horizon=5, name=None, leaf_size=2):
+    """ Offline generator for an explicit MPC lookup table. The state box [x_min, x_max] and reference box
+        [r_min, r_max] (defaulting to the state box) bound the region of parameter space that gets partitioned"""
+
+    x_min = np.asarray(x_min, dtype=float).ravel()
+    x_max = np.asarray(x_max, dtype=float).ravel()
+    r_min = x_min if r_min is None else np.asarray(r_min, dtype=float).ravel()
+    r_max = x_max if r_max is None else np.asarray(r_max, dtype=float).ravel()
+    theta_min = np.concatenate([x_min, r_min])
+    theta_max = np.concatenate([x_max, r_max])
+
+    if name is None:
+        name = gains.name + 'ExplicitMPC'
+
+    regions = critical_regions(gains, Q_weight, R_weight, u_min, u_max, theta_min, theta_max, horizon)
+    return ExplicitMPCTable(name, regions, theta_min, theta_max, u_min, u_max, leaf_size=leaf_size)
+
+
+class ExplicitMPCController(StateSpaceController):
+    """ A StateSpaceController that looks up precomputed explicit MPC tables, one per gains index, so it can be used
+        in StateSpaceControlSim like any other controller"""
+
+    def __init__(self, gains, u_initial, r_initial, u_max, u_min, tables):
+        super().__init__(gains, u_initial, r_initial, u_max, u_min)
+
+        if isinstance(tables, ExplicitMPCTable):
+            tables = [tables]
+        assert len(tables) == len(self.gains), 'There must be one table for every set of gains'
+        self.tables = tables
+
+    def update(self, r, x_hat):
+        theta = np.concatenate([np.asarray(x_hat, dtype=float).ravel(), np.asarray(r, dtype=float).ravel()])
+
+        self.r = r
+        self.u = np.asmatrix(self.tables[self.gains_index].evaluate(theta).reshape(-1, 1))
+
+        return self.u
+
+    def bounded_update(self, r, x_hat):
+        # Table outputs are already within the bounds
+        return self.update(r, x_hat)
+
+    def bounded_update_ff(self, r, x_hat):
+        return self.update(r, x_hat)
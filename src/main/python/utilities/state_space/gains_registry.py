@@ -0,0 +1,88 @@
+import importlib
+import pkgutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from utilities.state_space.state_space_gains import GainsList, Gains
+
+"""
+A registry of gains factories, so the pre-compile step doesn't have to know about every mechanism by hand.
+
+Each mechanism module registers its factory and where its gains should be written:
+
+    @register_gains('./src/main/java/frc/team687/robot/constants/')
+    def create_gains():
+        ...
+
+A factory returns a GainsList (or a single set of gains), or a tuple whose first entry is one, which is what the
+existing create_gains functions already return. discover_gains imports every module in a package so their
+registrations run, and generate_gains runs all the factories in a process pool and merges the results.
+"""
+
+GainsFactory = namedtuple('GainsFactory', ['module', 'function', 'out_dir'])
+
+_registry = {}
+
+
+def register_gains(out_dir):
+    """ Decorator that registers a gains factory, along with the directory its Java files should be written to"""
+
+    def decorator(factory):
+        key = (factory.__module__, factory.__qualname__)
+        _registry[key] = GainsFactory(factory.__module__, factory.__qualname__, out_dir)
+        return factory
+
+    return decorator
+
+
+def registered_gains():
+    """ Every registered factory, sorted by module so the output order doesn't depend on import order"""
+    return [_registry[key] for key in sorted(_registry)]
+
+
+def discover_gains(package='robot.models'):
+    """ Imports every module in the package (which registers their factories) and returns the registered factories"""
+
+    package_module = importlib.import_module(package)
+    for module_info in pkgutil.iter_modules(package_module.__path__):
+        importlib.import_module(package + '.' + module_info.name)
+    return [factory for factory in registered_gains() if factory.module.startswith(package + '.')]
+
+
+def run_factory(module, function):
+    """ Imports and calls a single factory and normalizes what it returns to a GainsList.
+        This is module level so it can be sent to pool workers"""
+
+    result = getattr(importlib.import_module(module), function)()
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, Gains):
+        result = GainsList(result)
+    assert isinstance(result, GainsList), 'Gains factories must return gains, a GainsList, or a tuple starting with one'
+    return result
+
+
+def generate_gains(factories, max_workers=None):
+    """ Runs every factory, in parallel when there's more than one, and merges the results into one GainsList along
+        with a matching list of output directories (one per set of gains), ready for GainsWriter.write_all"""
+
+    assert len(factories) > 0, 'There must be at least one gains factory'
+
+    if max_workers == 1 or len(factories) == 1:
+        results = [run_factory(factory.module, factory.function) for factory in factories]
+    else:
+        if max_workers is None:
+            max_workers = len(factories)
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(factories))) as executor:
+            futures = [executor.submit(run_factory, factory.module, factory.function) for factory in factories]
+            results = [future.result() for future in futures]
+
+    gains_list = None
+    paths = []
+    for factory, result in zip(factories, results):
+        if gains_list is None:
+            gains_list = GainsList(list(result.gains_list))
+        else:
+            gains_list.add_gains(result.gains_list)
+        paths += [factory.out_dir] * len(result)
+
+    return gains_list, paths
@@ -1,5 +1,6 @@
 import numpy as np
 from utilities.state_space.state_space_gains import GainsList, StateSpaceGains, ContinuousGains
+from utilities.state_space.java_codegen import build_loop_program, render_java
 
 
 def numpy_to_jama_matrix(np_matrix):
@@ -24,13 +25,28 @@ def numpy_to_jama_matrix(np_matrix):
     return output
 
 
+def numpy_to_java_array(np_array):
+    """ Flattens an array (row-major) into the body of a Java double[] or int[] initializer"""
+
+    values = np.asarray(np_array).ravel()
+    if np.issubdtype(values.dtype, np.integer):
+        entries = [str(int(value)) for value in values]
+    else:
+        # repr round-trips exactly, so Java ends up with the same doubles Python used
+        entries = [repr(float(value)) for value in values]
+
+    # Keeps lines from getting absurdly long for big tables
+    lines = [', '.join(entries[i:i + 8]) for i in range(0, len(entries), 8)]
+    return '{' + ',\n        '.join(lines) + '}'
+
+
 class GainsWriter(object):
     """ A class to handle writing gains to Java files"""
 
     def __init__(self, gains: GainsList):
         self.gains = gains
 
-    def write_all(self, paths):
+    def write_all(self, paths, write_loops=True):
         assert isinstance(paths, list) and isinstance(paths[0], str) or \
             isinstance(paths, str)
         if isinstance(paths, str):
@@ -40,6 +56,21 @@ class GainsWriter(object):
         assert len(paths) == len(self.gains), 'The number of paths must be equal to the number of gains lists'
         for i, path in enumerate(paths):
             self.write_discrete_gains(path, i)
+            if write_loops:
+                self.write_loop_class(path, i)
+
+    def write_loop_class(self, path: str, gains_index: int):
+        """ Writes the allocation-free, unrolled observer and controller for a set of gains (see java_codegen.py)
+            to a class named after the gains with Loop on the end"""
+
+        current_gains = self.gains.get_gains(gains_index)
+        assert isinstance(current_gains, StateSpaceGains)
+
+        program = build_loop_program(current_gains)
+        javafile = open(path + program.name + '.java', 'w')
+        javafile.truncate()
+        javafile.write(render_java(program))
+        javafile.close()
 
     def write_discrete_gains(self, path: str, gains_index: int):
         current_gains = self.gains.get_gains(gains_index)
@@ -117,3 +148,91 @@ public class {name} {{
                        u_max_data=current_u_max_data, dt_data=current_dt_data,)
         )
         javafile.close()
+
+    def write_explicit_mpc(self, path: str, table):
+        """ Writes an ExplicitMPCTable to a Java class named after the table, with a static evaluate method that does
+            the same partition tree lookup as ExplicitMPCTable.evaluate without allocating anything"""
+
+        javafile = open(path + table.name + '.java', 'w')
+        javafile.truncate()
+        javafile.write('''
+package frc.team687.robot.constants;
+
+public class {name} {{
+
+    public static final int kParameterDimension = {d};
+    public static final int kInputDimension = {p};
+    private static final double kTolerance = {tolerance};
+
+    private static final double[] kDirections = {directions};
+    private static final int[] kSplitDirection = {split_direction};
+    private static final double[] kSplitValue = {split_value};
+    private static final int[] kLeft = {left};
+    private static final int[] kRight = {right};
+    private static final int[] kLeafStart = {leaf_start};
+    private static final int[] kLeafCount = {leaf_count};
+    private static final int[] kLeafRegions = {leaf_regions};
+
+    private static final int[] kRowStart = {row_start};
+    private static final double[] kConstraintA = {constraint_A};
+    private static final double[] kConstraintB = {constraint_b};
+    private static final double[] kLawGain = {law_gain};
+    private static final double[] kLawOffset = {law_offset};
+    private static final double[] kUMin = {u_min};
+    private static final double[] kUMax = {u_max};
+
+    private static double dot(double[] matrix, int row, double[] theta) {{
+        double sum = 0;
+        for (int k = 0; k < kParameterDimension; k++) {{
+            sum += matrix[row * kParameterDimension + k] * theta[k];
+        }}
+        return sum;
+    }}
+
+    // theta is the estimated state followed by the reference, and the constrained-optimal input is written into u
+    public static void evaluate(double[] theta, double[] u) {{
+        int node = 0;
+        while (kSplitDirection[node] >= 0) {{
+            node = dot(kDirections, kSplitDirection[node], theta) <= kSplitValue[node] ? kLeft[node] : kRight[node];
+        }}
+
+        int bestRegion = -1;
+        double bestViolation = Double.POSITIVE_INFINITY;
+        for (int i = kLeafStart[node]; i < kLeafStart[node] + kLeafCount[node]; i++) {{
+            int region = kLeafRegions[i];
+            double violation = Double.NEGATIVE_INFINITY;
+            for (int row = kRowStart[region]; row < kRowStart[region + 1]; row++) {{
+                violation = Math.max(violation, dot(kConstraintA, row, theta) - kConstraintB[row]);
+            }}
+            if (violation < bestViolation) {{
+                bestViolation = violation;
+                bestRegion = region;
+            }}
+            if (violation <= kTolerance) {{
+                break;
+            }}
+        }}
+
+        for (int j = 0; j < kInputDimension; j++) {{
+            double value = kLawOffset[bestRegion * kInputDimension + j]
+                    + dot(kLawGain, bestRegion * kInputDimension + j, theta);
+            u[j] = Math.min(Math.max(value, kUMin[j]), kUMax[j]);
+        }}
+    }}
+
+}}
+            '''.format(name=table.name, d=table.d, p=table.p, tolerance=repr(table.tolerance),
+                       directions=numpy_to_java_array(table.directions),
+                       split_direction=numpy_to_java_array(table.split_direction),
+                       split_value=numpy_to_java_array(table.split_value),
+                       left=numpy_to_java_array(table.left), right=numpy_to_java_array(table.right),
+                       leaf_start=numpy_to_java_array(table.leaf_start),
+                       leaf_count=numpy_to_java_array(table.leaf_count),
+                       leaf_regions=numpy_to_java_array(table.leaf_regions),
+                       row_start=numpy_to_java_array(table.row_start),
+                       constraint_A=numpy_to_java_array(table.constraint_A),
+                       constraint_b=numpy_to_java_array(table.constraint_b),
+                       law_gain=numpy_to_java_array(table.law_gain), law_offset=numpy_to_java_array(table.law_offset),
+                       u_min=numpy_to_java_array(table.u_min), u_max=numpy_to_java_array(table.u_max))
+        )
+        javafile.close()
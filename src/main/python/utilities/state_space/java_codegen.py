@@ -0,0 +1,238 @@
+import numpy as np
+from collections import namedtuple
+
+"""
+Generates a specialized, allocation-free Java control loop for one set of gains.
+
+The Jama-based StateSpaceObserver and StateSpaceController create new Matrix objects for every product, every loop.
+Since the matrix sizes are fixed once the gains are generated, the same arithmetic can be unrolled into scalar
+expressions on primitive doubles, with every coefficient as a static final field and zero coefficients dropped.
+
+The loop is built as a small list of statements first. The same statements are rendered to Java and interpreted in
+Python, and since both evaluate left to right in IEEE doubles, the interpreter gives the same numbers the robot will.
+verify_loop_program checks the interpreted statements against StateSpaceControlSim trajectories.
+"""
+
+# target = sum of coefficient * source over terms
+SumStatement = namedtuple('SumStatement', ['target', 'terms'])
+# target = left - right
+DifferenceStatement = namedtuple('DifferenceStatement', ['target', 'left', 'right'])
+# target = min(max(source, lower), upper)
+ClampStatement = namedtuple('ClampStatement', ['target', 'source', 'lower', 'upper'])
+# array element = local
+StoreStatement = namedtuple('StoreStatement', ['target', 'source'])
+
+LoopProgram = namedtuple('LoopProgram', ['name', 'n', 'p', 'q', 'coefficients', 'observer', 'controller'])
+
+
+def _matrix_terms(coefficients, field_prefix, matrix, row, sources):
+    """ Terms for row of matrix times the vector held in sources, skipping zero coefficients"""
+
+    terms = []
+    for column, source in enumerate(sources):
+        value = float(matrix[row, column])
+        if value != 0.:
+            field = '%s_%d_%d' % (field_prefix, row, column)
+            coefficients[field] = value
+            terms.append((field, source))
+    return terms
+
+
+def build_loop_program(gains, name=None):
+    """ Builds the statements for one loop iteration:
+            x_hat = (A - LC) * x_hat + B * u + L * y    (the observer, using the last output u)
+            u = clamp(K * (r - x_hat), u_min, u_max)   (the controller)
+        which is the same order StateSpaceControlSim.update runs them in"""
+
+    if name is None:
+        name = gains.name + 'Loop'
+
+    A_LC = np.asarray(gains.A - gains.L * gains.C, dtype=float)
+    B = np.asarray(gains.B, dtype=float)
+    L = np.asarray(gains.L, dtype=float)
+    K = np.asarray(gains.K, dtype=float)
+    u_min = np.asarray(gains.u_min, dtype=float).ravel()
+    u_max = np.asarray(gains.u_max, dtype=float).ravel()
+    n = gains.n
+    p = gains.p
+    q = gains.q
+
+    x_hat = ['xHat[%d]' % i for i in range(n)]
+    u = ['u[%d]' % i for i in range(p)]
+    r = ['r[%d]' % i for i in range(n)]
+    y = ['y[%d]' % i for i in range(q)]
+
+    coefficients = {}
+
+    # Every new estimate is computed into a local before any of them are stored, since they all read the old ones
+    observer = []
+    for i in range(n):
+        terms = _matrix_terms(coefficients, 'kA_LC', A_LC, i, x_hat)
+        terms += _matrix_terms(coefficients, 'kB', B, i, u)
+        terms += _matrix_terms(coefficients, 'kL', L, i, y)
+        observer.append(SumStatement('nextXHat%d' % i, terms))
+    for i in range(n):
+        observer.append(StoreStatement(x_hat[i], 'nextXHat%d' % i))
+
+    controller = []
+    for i in range(n):
+        controller.append(DifferenceStatement('error%d' % i, r[i], x_hat[i]))
+    errors = ['error%d' % i for i in range(n)]
+    for i in range(p):
+        coefficients['kUMin_%d' % i] = float(u_min[i])
+        coefficients['kUMax_%d' % i] = float(u_max[i])
+        controller.append(SumStatement('output%d' % i, _matrix_terms(coefficients, 'kK', K, i, errors)))
+        controller.append(ClampStatement('output%d' % i, 'output%d' % i, 'kUMin_%d' % i, 'kUMax_%d' % i))
+        controller.append(StoreStatement(u[i], 'output%d' % i))
+
+    return LoopProgram(name, n, p, q, coefficients, observer, controller)
+
+
+def _render_statement(statement, declared):
+    if isinstance(statement, SumStatement):
+        if statement.terms:
+            expression = ' + '.join('%s * %s' % term for term in statement.terms)
+        else:
+            expression = '0.0'
+    elif isinstance(statement, DifferenceStatement):
+        expression = '%s - %s' % (statement.left, statement.right)
+    elif isinstance(statement, ClampStatement):
+        expression = 'Math.min(Math.max(%s, %s), %s)' % (statement.source, statement.lower, statement.upper)
+    else:
+        return '%s = %s;' % (statement.target, statement.source)
+
+    if statement.target in declared:
+        return '%s = %s;' % (statement.target, expression)
+    declared.add(statement.target)
+    return 'double %s = %s;' % (statement.target, expression)
+
+
+def render_java(program):
+    """ Renders a LoopProgram to the source of a Java class in frc.team687.robot.constants"""
+
+    fields = '\n'.join('    private static final double %s = %s;' % (field, repr(value))
+                       for field, value in sorted(program.coefficients.items()))
+
+    declared = set()
+    observer = '\n'.join('        ' + _render_statement(statement, declared) for statement in program.observer)
+    controller = '\n'.join('        ' + _render_statement(statement, declared) for statement in program.controller)
+
+    return '''
+package frc.team687.robot.constants;
+
+/**
+ * Generated by gains_writer.py, don't edit by hand.
+ * Observer and controller with every matrix product unrolled into primitive doubles, so update doesn't allocate.
+ */
+public class {name} {{
+
+{fields}
+
+    public static final int n = {n};
+    public static final int p = {p};
+    public static final int q = {q};
+
+    // Current state estimate and last output, updated in place
+    public final double[] xHat = new double[n];
+    public final double[] u = new double[p];
+
+    public {name}(double[] initialState) {{
+        this.reset(initialState);
+    }}
+
+    public void reset(double[] initialState) {{
+        System.arraycopy(initialState, 0, this.xHat, 0, n);
+        java.util.Arrays.fill(this.u, 0.0);
+    }}
+
+    // Observer update with the last output and the new measurement y
+    public double[] updateObserver(double[] y) {{
+{observer}
+        return xHat;
+    }}
+
+    // One control loop: observer update, then the clamped control law u = K * (r - xHat). Returns the new output
+    public double[] update(double[] r, double[] y) {{
+        this.updateObserver(y);
+{controller}
+        return u;
+    }}
+
+}}
+'''.format(name=program.name, fields=fields, n=program.n, p=program.p, q=program.q,
+           observer=observer, controller=controller)
+
+
+class LoopInterpreter(object):
+    """ Runs a LoopProgram in Python with exactly the operations the generated Java does, in the same order"""
+
+    def __init__(self, program, x_hat_initial, u_initial=None):
+        self.program = program
+        self.values = dict(program.coefficients)
+        for i, value in enumerate(np.asarray(x_hat_initial, dtype=float).ravel()):
+            self.values['xHat[%d]' % i] = float(value)
+        u_initial = np.zeros(program.p) if u_initial is None else np.asarray(u_initial, dtype=float).ravel()
+        for i, value in enumerate(u_initial):
+            self.values['u[%d]' % i] = float(value)
+
+    def _run(self, statements):
+        values = self.values
+        for statement in statements:
+            if isinstance(statement, SumStatement):
+                total = 0.
+                for j, (field, source) in enumerate(statement.terms):
+                    # Java's a * b + c * d starts from the first product, not from 0 + a * b
+                    total = values[field] * values[source] if j == 0 else total + values[field] * values[source]
+                values[statement.target] = total
+            elif isinstance(statement, DifferenceStatement):
+                values[statement.target] = values[statement.left] - values[statement.right]
+            elif isinstance(statement, ClampStatement):
+                values[statement.target] = min(max(values[statement.source], values[statement.lower]),
+                                               values[statement.upper])
+            else:
+                values[statement.target] = values[statement.source]
+
+    def update(self, r, y):
+        program = self.program
+        for i, value in enumerate(np.asarray(r, dtype=float).ravel()):
+            self.values['r[%d]' % i] = float(value)
+        for i, value in enumerate(np.asarray(y, dtype=float).ravel()):
+            self.values['y[%d]' % i] = float(value)
+
+        self._run(program.observer)
+        self._run(program.controller)
+
+        return (np.array([self.values['xHat[%d]' % i] for i in range(program.n)]),
+                np.array([self.values['u[%d]' % i] for i in range(program.p)]))
+
+
+def verify_loop_program(program, sim, reference_calculator, duration, rtol=1.e-9, atol=1.e-9):
+    """ Runs sim (a fresh StateSpaceControlSim with the same gains) and the interpreted program side by side, feeding
+        the program the sim's noisy measurements. Returns the largest absolute difference in x_hat and u, and raises
+        an AssertionError if they're further apart than rounding can explain"""
+
+    interpreter = LoopInterpreter(program, sim.x_hat, sim.u)
+
+    max_x_hat_error = 0.
+    max_u_error = 0.
+    for t in np.arange(start=0., stop=duration, step=sim.current_gains.dt):
+        r = reference_calculator(t)
+        x, u, y, x_hat = sim.update(r)
+        generated_x_hat, generated_u = interpreter.update(r, y)
+
+        x_hat = np.asarray(x_hat, dtype=float).ravel()
+        u = np.asarray(u, dtype=float).ravel()
+        assert np.allclose(generated_x_hat, x_hat, rtol=rtol, atol=atol), \
+            'Generated observer diverged from the sim at t = %s' % t
+        assert np.allclose(generated_u, u, rtol=rtol, atol=atol), \
+            'Generated controller diverged from the sim at t = %s' % t
+        max_x_hat_error = max(max_x_hat_error, np.max(np.abs(generated_x_hat - x_hat)))
+        max_u_error = max(max_u_error, np.max(np.abs(generated_u - u)))
+
+        # Keep rounding differences from compounding, so every step is checked against the same starting point
+        for i, value in enumerate(x_hat):
+            interpreter.values['xHat[%d]' % i] = float(value)
+        for i, value in enumerate(u):
+            interpreter.values['u[%d]' % i] = float(value)
+
+    return max_x_hat_error, max_u_error
@@ -0,0 +1,161 @@
+import numpy as np
+import scipy.linalg
+from collections import namedtuple
+
+"""
+Tunes the diagonal LQR weights by gradient descent on a closed-loop cost, instead of by trial and error.
+
+The weights are parameterized as Q = diag(exp(theta_Q)) and R = diag(exp(theta_R)), which keeps them positive. The
+gradient of a cost J(K) with respect to theta goes through the discrete algebraic Riccati equation analytically.
+Differentiating the DARE gives
+    dP = A_cl.T * dP * A_cl + dQ + K.T * dR * K           (a Lyapunov equation, A_cl = A - BK)
+    dK = S^-1 * (B.T * dP * A_cl - dR * K),  S = R + B.T * P * B
+and instead of solving the Lyapunov equation once per weight, its adjoint
+    Y = A_cl * Y * A_cl.T + A_cl * M.T * B.T,  M = S^-T * dJ/dK
+gives the gradient with respect to every weight at once. So each optimizer step is one DARE solve, one Lyapunov solve,
+and whatever the cost needs, rather than a finite difference over every weight.
+
+A cost is any function of K (and the DARE solution P) that returns its value and its gradient with respect to K.
+quadratic_closed_loop_cost builds the usual one: the expected infinite-horizon quadratic cost of the closed loop under
+evaluation weights that can differ from the design weights.
+"""
+
+LQRTuningResult = namedtuple('LQRTuningResult', ['Q_weight', 'R_weight', 'K', 'cost', 'synthesis_calls',
+                                                 'optimizer_result'])
+
+
+def lqr_with_riccati(A, B, Q_weight, R_weight):
+    """ The same K as dlqr, along with the Riccati solution P and S = R + B.T * P * B"""
+
+    P = scipy.linalg.solve_discrete_are(A, B, Q_weight, R_weight)
+    S = R_weight + B.T @ P @ B
+    K = np.linalg.solve(S, B.T @ P @ A)
+    return K, P, S
+
+
+def dare_weight_gradient(A, B, K, S, cost_gradient):
+    """ Gradient of a cost with respect to the diagonals of Q_weight and R_weight, given the cost's gradient with
+        respect to K (p x n), using one Lyapunov solve for the adjoint of the Riccati sensitivity"""
+
+    A_cl = A - B @ K
+    M = np.linalg.solve(S.T, cost_gradient)
+    Y = scipy.linalg.solve_discrete_lyapunov(A_cl, A_cl @ M.T @ B.T)
+    # Only the symmetric part of Y matters against the symmetric dQ and dR
+    Y = 0.5 * (Y + Y.T)
+
+    gradient_Q = np.diag(Y)
+    gradient_R = np.diag(K @ Y @ K.T - K @ M.T)
+    return gradient_Q, gradient_R
+
+
+def quadratic_closed_loop_cost(A, B, Q_eval, R_eval, initial_covariance=None):
+    """ Builds J(K) = trace(X * Sigma_0), the expected sum over all time of x.T * Q_eval * x + u.T * R_eval * u for the
+        closed loop u = -Kx started from x_0 with covariance Sigma_0 (the identity by default), where
+            X = A_cl.T * X * A_cl + Q_eval + K.T * R_eval * K
+        Its gradient is 2 * ((R_eval + B.T * X * B) * K - B.T * X * A) * Sigma_K, with Sigma_K the closed-loop state
+        covariance. Unstable gains cost infinity"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    Q_eval = np.asarray(Q_eval, dtype=float)
+    R_eval = np.asarray(R_eval, dtype=float)
+    if initial_covariance is None:
+        initial_covariance = np.eye(A.shape[0])
+    initial_covariance = np.asarray(initial_covariance, dtype=float)
+
+    def cost(K, P=None):
+        A_cl = A - B @ K
+        if np.max(np.abs(np.linalg.eigvals(A_cl))) >= 1.:
+            return np.inf, np.zeros(K.shape)
+
+        X = scipy.linalg.solve_discrete_lyapunov(A_cl.T, Q_eval + K.T @ R_eval @ K)
+        Sigma = scipy.linalg.solve_discrete_lyapunov(A_cl, initial_covariance)
+        value = np.trace(X @ initial_covariance)
+        gradient = 2. * ((R_eval + B.T @ X @ B) @ K - B.T @ X @ A) @ Sigma
+        return value, gradient
+
+    return cost
+
+
+def weight_objective(A, B, cost, tune_R=True, R_diagonal=None, counter=None):
+    """ The function of theta = [log diag Q, log diag R] that the optimizer sees, returning the cost and its gradient.
+        With tune_R off, theta is only log diag Q and R stays at R_diagonal"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    n = A.shape[0]
+
+    def objective(theta):
+        Q_diagonal = np.exp(theta[:n])
+        R_current = np.exp(theta[n:]) if tune_R else np.asarray(R_diagonal, dtype=float)
+        K, P, S = lqr_with_riccati(A, B, np.diag(Q_diagonal), np.diag(R_current))
+        if counter is not None:
+            counter[0] += 1
+
+        value, cost_gradient = cost(K, P)
+        if not np.isfinite(value):
+            return value, np.zeros(theta.shape)
+
+        gradient_Q, gradient_R = dare_weight_gradient(A, B, K, S, cost_gradient)
+        # Chain rule through Q = diag(exp(theta))
+        gradient = gradient_Q * Q_diagonal
+        if tune_R:
+            gradient = np.concatenate([gradient, gradient_R * R_current])
+        return value, gradient
+
+    return objective
+
+
+def tune_lqr_weights(A, B, Q_weight, R_weight, cost, tune_R=True, max_iterations=100, tolerance=1.e-10,
+                     log_bounds=(-30., 30.)):
+    """ Minimizes cost(K, P) over the diagonals of the LQR weights with L-BFGS-B, starting from the diagonals of
+        Q_weight and R_weight. Scaling Q and R together doesn't change K, so tuning R as well only adds a flat
+        direction. It's mostly useful with costs that aren't invariant to it, or with tune_R off to hold the input
+        weight fixed.
+
+        tolerance is on the gradient in log-weight space. Weights that start out tiny (like the motor's velocity
+        weight) sit on a plateau where the cost barely changes, so the optimizer shouldn't stop on relative progress
+        alone"""
+
+    import scipy.optimize
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    Q_diagonal = np.diag(np.asarray(Q_weight, dtype=float))
+    R_diagonal = np.diag(np.asarray(R_weight, dtype=float))
+    assert np.all(Q_diagonal > 0.) and np.all(R_diagonal > 0.), 'The starting weights must be positive on the diagonal'
+
+    counter = [0]
+    objective = weight_objective(A, B, cost, tune_R, R_diagonal, counter)
+    theta = np.log(np.concatenate([Q_diagonal, R_diagonal]) if tune_R else Q_diagonal)
+
+    result = scipy.optimize.minimize(objective, theta, jac=True, method='L-BFGS-B',
+                                     bounds=[log_bounds] * len(theta),
+                                     options={'maxiter': max_iterations, 'ftol': 1.e-15, 'gtol': tolerance})
+
+    n = A.shape[0]
+    Q_tuned = np.asmatrix(np.diag(np.exp(result.x[:n])))
+    R_tuned = np.asmatrix(np.diag(np.exp(result.x[n:]) if tune_R else R_diagonal))
+    K, _, _ = lqr_with_riccati(A, B, np.asarray(Q_tuned), np.asarray(R_tuned))
+
+    return LQRTuningResult(Q_tuned, R_tuned, np.asmatrix(K), result.fun, counter[0], result)
+
+
+def check_weight_gradient(A, B, Q_weight, R_weight, cost, step=1.e-6):
+    """ Compares the analytic gradient with central differences in log-weight space. Returns both, so they can be
+        compared to whatever tolerance makes sense for the cost"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    objective = weight_objective(A, B, cost)
+    theta = np.log(np.concatenate([np.diag(np.asarray(Q_weight, dtype=float)),
+                                   np.diag(np.asarray(R_weight, dtype=float))]))
+
+    _, analytic = objective(theta)
+    numeric = np.zeros(theta.shape)
+    for i in range(len(theta)):
+        offset = np.zeros(theta.shape)
+        offset[i] = step
+        numeric[i] = (objective(theta + offset)[0] - objective(theta - offset)[0]) / (2. * step)
+
+    return analytic, numeric
@@ -0,0 +1,51 @@
+import functools
+import numpy as np
+from collections import OrderedDict
+
+"""
+Memoization for the synthesis functions (c2d, dlqr, discrete_kalman...), whose arguments are matrices.
+
+Arrays aren't hashable, so the key is built from each argument's dtype, shape and raw bytes. That means a cache hit
+needs bit-for-bit identical inputs, which is exactly what happens when only some of the tuning parameters change: the
+steps that don't depend on them get the same inputs and are skipped.
+"""
+
+
+def _key_part(value):
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        return ('array', array.dtype.str, array.shape, array.tobytes())
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_key_part(item) for item in value)
+    return value
+
+
+def memoize_arrays(maxsize=128):
+    """ Decorator that caches a function of arrays and plain values, keeping the maxsize most recently used results.
+        Cached results are shared between calls, so callers mustn't modify them in place"""
+
+    def decorator(function):
+        cache = OrderedDict()
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = (tuple(_key_part(arg) for arg in args),
+                   tuple(sorted((name, _key_part(value)) for name, value in kwargs.items())))
+            if key in cache:
+                cache.move_to_end(key)
+                wrapper.hits += 1
+                return cache[key]
+
+            wrapper.misses += 1
+            result = function(*args, **kwargs)
+            cache[key] = result
+            if len(cache) > maxsize:
+                cache.popitem(last=False)
+            return result
+
+        wrapper.hits = 0
+        wrapper.misses = 0
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
@@ -0,0 +1,170 @@
+import numpy as np
+from collections import namedtuple
+from utilities.state_space.memoize import memoize_arrays
+from utilities.state_space.state_space_observer import psd_sqrt
+from utilities.state_space.state_space_utils import c2d
+
+"""
+Simulation where the plant, each group of sensors, the observer and the controller all run at their own rates, like on
+the robot where encoders, gyros and cameras update at different periods from the 10 or 20 ms control loop.
+
+Time is counted in ticks of the plant substep, and every component fires on a whole number of ticks (plus an optional
+offset). Nothing happens to the plant between two events except holding the input, so instead of stepping it one
+substep at a time the plant jumps straight to the next event with the model discretized over the whole gap. Those
+discretizations are cached per model and gap length, and since the gaps only take a few distinct values the run costs
+one Python step per event however fine the substep is.
+
+The plant is the continuous model (A, B, C, D, Q_noise, R_noise) that the gains are discretized from. Q_noise and
+R_noise are treated as continuous noise intensities, the same way c2d treats them, so noise is drawn from the c2d
+covariance of each gap (which is what summing the substeps would give) and each sensor sample has covariance
+R_noise / period, so a sensor that's read more often is noisier per sample.
+"""
+
+# rows are the rows of C the group measures, and period and offset are in plant substeps
+SensorGroup = namedtuple('SensorGroup', ['rows', 'period', 'offset'])
+
+# Sampled at every controller event. y is what the sensors were holding at the time
+MultiRateResult = namedtuple('MultiRateResult', ['t', 'x', 'u', 'y', 'x_hat'])
+
+
+@memoize_arrays(maxsize=256)
+def discretize_interval(A, B, Q_noise, dt):
+    """ A_d, B_d and a square root of the process noise covariance for holding the input over dt, cached per
+        (model, dt)"""
+
+    A_d, B_d, Q_d = c2d(A, B, dt, Q_noise)
+    return np.asarray(A_d), np.asarray(B_d), psd_sqrt(Q_d)
+
+
+def sensor_group(rows, period, offset=0):
+    return SensorGroup(tuple(np.atleast_1d(rows).tolist()), int(period), int(offset))
+
+
+class MultiRatePlant(object):
+    """ The continuous model, advanced from event to event with the input held in between"""
+
+    def __init__(self, model, substep, x_initial, noise=True, rng=None):
+        A, B, C, D, Q_noise, R_noise = model
+        self.A = np.asarray(A, dtype=float)
+        self.B = np.asarray(B, dtype=float)
+        self.C = np.asarray(C, dtype=float)
+        self.D = np.asarray(D, dtype=float)
+        self.Q_noise = np.asarray(Q_noise, dtype=float)
+        self.R_noise = np.asarray(R_noise, dtype=float)
+        self.substep = substep
+        self.noise = noise
+        self.rng = np.random.default_rng() if rng is None else rng
+
+        self.x = np.asarray(x_initial, dtype=float).ravel().copy()
+        self.tick = 0
+        self.jumps = 0
+
+    def advance(self, tick, u):
+        """ Holds u from the current tick up to tick"""
+
+        ticks = tick - self.tick
+        if ticks <= 0:
+            return self.x
+        A_d, B_d, Q_sqrt = discretize_interval(self.A, self.B, self.Q_noise, ticks * self.substep)
+        self.x = A_d @ self.x + B_d @ u
+        if self.noise:
+            self.x = self.x + Q_sqrt @ self.rng.standard_normal(len(self.x))
+        self.tick = tick
+        self.jumps += 1
+        return self.x
+
+    def measure(self, group, u):
+        rows = list(group.rows)
+        y = self.C[rows] @ self.x + self.D[rows] @ u
+        if self.noise:
+            R_d = self.R_noise[np.ix_(rows, rows)] / (group.period * self.substep)
+            y = y + psd_sqrt(R_d) @ self.rng.standard_normal(len(rows))
+        return y
+
+
+class MultiRateSim(object):
+    """
+    Runs a plant, sensor groups, an observer and a controller each at their own period. control_period and
+    observer_period are in plant substeps, and the observer and controller are the usual objects (StateSpaceObserver,
+    SquareRootKalmanObserver, StateSpaceController, MPCController...) built from gains discretized at their own period.
+
+    At a tick where several things fire, the plant is advanced first, then the sensors sample, then the observer
+    updates with the input that's been applied and whatever the sensors are holding, then the controller picks the
+    input that's applied from then on. With every period equal to the gains' dt that's exactly the order of
+    StateSpaceControlSim.update. If mark_stale is set, sensors that haven't sampled since the observer last ran are
+    passed to it as NaN instead of their held value, which SquareRootKalmanObserver skips.
+    """
+
+    def __init__(self, model, substep, sensor_groups, observer, controller, x_initial, u_initial, control_period,
+                 observer_period=None, noise=True, mark_stale=False, seed=None):
+        self.plant = MultiRatePlant(model, substep, x_initial, noise, np.random.default_rng(seed))
+        self.substep = substep
+        self.sensor_groups = [group if isinstance(group, SensorGroup) else sensor_group(*group)
+                              for group in sensor_groups]
+        self.observer = observer
+        self.controller = controller
+        self.control_period = int(control_period)
+        self.observer_period = self.control_period if observer_period is None else int(observer_period)
+        self.mark_stale = mark_stale
+
+        q = self.plant.C.shape[0]
+        measured = sorted(row for group in self.sensor_groups for row in group.rows)
+        assert measured == list(range(q)), 'Every row of C must be in exactly one sensor group'
+
+        self.u = np.asarray(u_initial, dtype=float).ravel().copy()
+        self.y = self.plant.C @ self.plant.x + self.plant.D @ self.u
+        self.fresh = np.zeros(q, dtype=bool)
+        self.x_hat = observer.x_hat
+
+    @staticmethod
+    def _fires(tick, period, offset=0):
+        return tick >= offset and (tick - offset) % period == 0
+
+    @staticmethod
+    def _next_fire(tick, period, offset=0):
+        """ The first tick after tick where a component fires"""
+        if tick < offset:
+            return offset
+        return tick + period - (tick - offset) % period
+
+    def simulate(self, duration, reference_calculator):
+        """ Runs for duration seconds, with reference_calculator(t) giving r at each controller event"""
+
+        end = int(round(duration / self.substep))
+        periods = [(group.period, group.offset) for group in self.sensor_groups]
+        periods += [(self.observer_period, 0), (self.control_period, 0)]
+
+        t_out, x_out, u_out, y_out, x_hat_out = [], [], [], [], []
+        tick = 0
+        while True:
+            tick = min(self._next_fire(tick, period, offset) for period, offset in periods)
+            if tick > end:
+                break
+
+            self.plant.advance(tick, self.u)
+
+            for group in self.sensor_groups:
+                if self._fires(tick, group.period, group.offset):
+                    rows = list(group.rows)
+                    self.y[rows] = self.plant.measure(group, self.u)
+                    self.fresh[rows] = True
+
+            if self._fires(tick, self.observer_period):
+                y = np.where(self.fresh, self.y, np.nan) if self.mark_stale else self.y
+                self.x_hat = self.observer.update(np.asmatrix(self.u).T, np.asmatrix(y).T)
+                self.fresh[:] = False
+
+            if self._fires(tick, self.control_period):
+                t = tick * self.substep
+                # Same convention as StateSpaceControlSim, whose first update is at t = 0 for the step ending at dt
+                r = reference_calculator(t - self.control_period * self.substep)
+                self.u = np.asarray(self.controller.bounded_update(r, self.x_hat), dtype=float).ravel()
+
+                t_out.append(t)
+                x_out.append(self.plant.x.copy())
+                u_out.append(self.u.copy())
+                y_out.append(self.y.copy())
+                x_hat_out.append(np.asarray(self.x_hat, dtype=float).ravel())
+
+        return MultiRateResult(np.array(t_out), np.array(x_out), np.array(u_out), np.array(y_out),
+                               np.array(x_hat_out))
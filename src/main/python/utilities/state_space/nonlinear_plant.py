@@ -0,0 +1,152 @@
+import numpy as np
+from utilities.state_space import sim_kernels
+from utilities.state_space.state_space_plant import StateSpacePlant
+
+"""
+Nonlinear plants, for checking designs against what the linear model leaves out: supply current limits, static
+friction and battery sag.
+
+The continuous dynamics dx/dt = f(x, u) are integrated with fixed-step RK4, with several substeps per control period.
+Everything works on (batch, n) arrays, so a whole Monte Carlo batch is integrated together. The sensors are still the
+linear C and D of the gains, and process and sensor noise are added once per control period the same way
+StateSpacePlant adds them.
+"""
+
+
+def rk4_step(dynamics, x, u, dt, substeps=1):
+    """ Integrates dx/dt = dynamics(x, u) over dt with the input held, using substeps fixed RK4 steps.
+        x is (batch, n) and u is (batch, p)"""
+
+    h = dt / substeps
+    for _ in range(substeps):
+        k1 = dynamics(x, u)
+        k2 = dynamics(x + (0.5 * h) * k1, u)
+        k3 = dynamics(x + (0.5 * h) * k2, u)
+        k4 = dynamics(x + h * k3, u)
+        x = x + (h / 6.) * (k1 + 2. * k2 + 2. * k3 + k4)
+    return x
+
+
+class DCMotorDynamics(object):
+    """
+    A geared DC motor driving an inertia, with state [position (rad), velocity (rad/s)] and input voltage, built from
+    the MotorType constants the same way the linear models are. With no limits, friction or sag it's exactly the
+    continuous model the linear gains come from:
+        I = (V - GR * w / Kv) / R
+        torque = GR * (Kt * I - d * GR * w)
+    On top of that:
+        current_limit            the controller's current limit per motor (A), clipping I
+        static_friction          Coulomb friction torque at the output (N-m), smoothed over friction_velocity so
+                                 RK4 doesn't chatter around zero
+        battery_resistance       internal resistance of the battery and wiring (ohms). The voltage available to the
+                                 motors sags by the total current times this, so commands near the battery voltage
+                                 can't actually be reached under load
+    """
+
+    def __init__(self, motor_type, gear_ratio, moment_of_inertia, num_motors=1, current_limit=None,
+                 static_friction=0., friction_velocity=1.e-2, battery_resistance=0.):
+        free_speed, free_current, stall_torque, stall_current, battery_voltage = motor_type.value
+
+        self.Kt = stall_torque / stall_current
+        self.R = battery_voltage / stall_current
+        self.Kv = free_speed / (battery_voltage - free_current * self.R)
+        self.d = free_current * self.Kt / free_speed
+        self.battery_voltage = battery_voltage
+
+        self.gear_ratio = gear_ratio
+        self.moment_of_inertia = moment_of_inertia
+        self.num_motors = num_motors
+        self.current_limit = current_limit
+        self.static_friction = static_friction
+        self.friction_velocity = friction_velocity
+        self.battery_resistance = battery_resistance
+
+    def applied_voltage(self, velocity, u):
+        """ The voltage the motors actually see: the command, limited by what the sagging battery can supply"""
+
+        if self.battery_resistance == 0.:
+            return np.clip(u, -self.battery_voltage, self.battery_voltage)
+
+        # At full output V = s * V_battery - R_battery * N * I with I = (V - back_emf) / R, solved for V
+        back_emf = self.gear_ratio * velocity / self.Kv
+        series_resistance = self.num_motors * self.battery_resistance
+        available = (np.sign(u) * self.battery_voltage * self.R + series_resistance * back_emf) \
+            / (self.R + series_resistance)
+        return np.where(np.abs(u) > np.abs(available), available, u)
+
+    def current(self, x, u):
+        """ Current through each motor (A), after the current limit"""
+
+        velocity = x[:, 1:2]
+        voltage = self.applied_voltage(velocity, u[:, 0:1])
+        current = (voltage - self.gear_ratio * velocity / self.Kv) / self.R
+        if self.current_limit is not None:
+            current = np.clip(current, -self.current_limit, self.current_limit)
+        return current
+
+    def __call__(self, x, u):
+        velocity = x[:, 1:2]
+        torque = self.num_motors * self.gear_ratio * (self.Kt * self.current(x, u) - self.d * self.gear_ratio * velocity)
+        if self.static_friction != 0.:
+            torque = torque - self.static_friction * np.tanh(velocity / self.friction_velocity)
+        return np.hstack([velocity, torque / self.moment_of_inertia])
+
+
+class NonlinearPlant(StateSpacePlant):
+    """ A drop-in replacement for StateSpacePlant that integrates nonlinear dynamics instead of stepping A and B.
+        x is an (n, 1) matrix like every other plant, so it works in StateSpaceControlSim"""
+
+    def __init__(self, gains, x_initial, dynamics, substeps=10):
+        super().__init__(gains, x_initial)
+        self.dynamics = dynamics
+        self.substeps = substeps
+
+    def step(self, u, process_noise, sensor_noise):
+        gains = self.current_gains
+
+        x = np.asarray(self.x, dtype=float).reshape(1, -1)
+        u = np.asarray(u, dtype=float).reshape(1, -1)
+        x = rk4_step(self.dynamics, x, u, gains.dt, self.substeps)
+        self.x = np.asmatrix(x.reshape(-1, 1)) + process_noise
+        self.y = gains.C * self.x + gains.D * np.asmatrix(u.reshape(-1, 1)) + sensor_noise
+
+        return self.y
+
+
+def simulate_nonlinear(gains, dynamics, r, x_initial, u_min, u_max, x_hat_initial=None, u_initial=None,
+                       process_noise=None, sensor_noise=None, batch=1, substeps=10, seed=None):
+    """ The closed loop of the linear observer and controller around the nonlinear plant, for a whole batch at once.
+        Takes and returns the same shapes as sim_kernels.run_kernel, and r is (T, n) or (batch, T, n)"""
+
+    r = np.asarray(r, dtype=float)
+    steps = r.shape[-2]
+    if process_noise is None or sensor_noise is None:
+        process_noise, sensor_noise = sim_kernels.generate_noise(gains, batch, steps, np.random.default_rng(seed))
+    batch = process_noise.shape[0]
+
+    m = sim_kernels.kernel_matrices(gains, u_min, u_max)
+    r = np.broadcast_to(r, (batch, steps, gains.n))
+    x = np.array(np.broadcast_to(np.asarray(x_initial, dtype=float).reshape(-1, gains.n), (batch, gains.n)))
+    x_hat = x.copy() if x_hat_initial is None else \
+        np.array(np.broadcast_to(np.asarray(x_hat_initial, dtype=float).reshape(-1, gains.n), (batch, gains.n)))
+    u = np.zeros((batch, gains.p)) if u_initial is None else \
+        np.array(np.broadcast_to(np.asarray(u_initial, dtype=float).reshape(-1, gains.p), (batch, gains.p)))
+
+    x_out = np.empty((batch, steps, gains.n))
+    u_out = np.empty((batch, steps, gains.p))
+    y_out = np.empty((batch, steps, gains.q))
+    x_hat_out = np.empty((batch, steps, gains.n))
+
+    # The same order as StateSpaceControlSim.update, with the plant step swapped out
+    for t in range(steps):
+        x = rk4_step(dynamics, x, u, gains.dt, substeps) + process_noise[:, t]
+        y = x @ m.C.T + u @ m.D.T + sensor_noise[:, t]
+        x_hat = x_hat @ m.A_LC.T + u @ m.B.T + y @ m.L.T
+        u = np.clip((r[:, t] - x_hat) @ m.K.T, m.u_min, m.u_max)
+
+        x_out[:, t] = x
+        u_out[:, t] = u
+        y_out[:, t] = y
+        x_hat_out[:, t] = x_hat
+
+    return x_out, u_out, y_out, x_hat_out
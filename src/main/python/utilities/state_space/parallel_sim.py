@@ -0,0 +1,243 @@
+import os
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from utilities.state_space import sim_kernels
+from utilities.state_space.state_space_gains import GainsList, StateSpaceGains, gains_layout
+
+"""
+Multi-process Monte Carlo runs of the simulation kernels, without pickling any trajectories.
+
+Every run's output arrays live in multiprocessing.shared_memory blocks created by the parent. Each worker simulates a
+slice of the batch and writes it straight into its rows, so the only thing that comes back through the pool is the
+slice that finished. The gains are packed into one shared float64 buffer and handed to the workers once, in the pool
+initializer, and every run's references and initial states go through shared memory too, so a task is only a few
+integers and block names.
+"""
+
+# Where a shared array lives, which is all a worker needs to attach to it
+SharedArraySpec = namedtuple('SharedArraySpec', ['name', 'shape', 'dtype'])
+
+# Where one set of gains' own buffer sits in the packed gains buffer, and everything else needed to rebuild it
+GainsLayout = namedtuple('GainsLayout', ['name', 'dt', 'n', 'p', 'q', 'offset', 'is_controllable', 'is_observable'])
+
+
+def create_shared_array(shape, dtype=np.float64):
+    """ Allocates a shared memory block and returns it along with an ndarray view of it and its spec"""
+
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return block, array, SharedArraySpec(block.name, tuple(shape), dtype.str)
+
+
+def attach_shared_array(spec):
+    """ Attaches to a block made by create_shared_array. The block has to be kept alive as long as the array is used"""
+
+    block = shared_memory.SharedMemory(name=spec.name)
+    return block, np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=block.buf)
+
+
+def pack_gains(gains):
+    """ Concatenates the buffers of every set of gains into one float64 array. Returns the array and the layouts
+        needed to rebuild the gains from it"""
+
+    if isinstance(gains, StateSpaceGains):
+        gains = GainsList(gains)
+
+    pieces = []
+    layouts = []
+    offset = 0
+    for i in range(len(gains)):
+        current_gains = gains.get_gains(i)
+        pieces.append(current_gains.buffer)
+        layouts.append(GainsLayout(current_gains.name, current_gains.dt, current_gains.n, current_gains.p,
+                                   current_gains.q, offset, current_gains.is_controllable,
+                                   current_gains.is_observable))
+        offset += len(current_gains.buffer)
+
+    return np.concatenate(pieces), layouts
+
+
+def unpack_gains(buffer, layouts):
+    """ Rebuilds a GainsList whose matrices are views into buffer rather than copies"""
+
+    gains_list = []
+    for layout in layouts:
+        size = gains_layout(layout.n, layout.p, layout.q)[1]
+        gains_list.append(StateSpaceGains.from_buffer(layout.name, layout.dt, layout.n, layout.p, layout.q,
+                                                      buffer[layout.offset:layout.offset + size],
+                                                      layout.is_controllable, layout.is_observable))
+    return GainsList(gains_list)
+
+
+# Per-worker state, set up once by _initialize_worker
+_worker = {}
+
+
+def _initialize_worker(gains_spec, layouts):
+    block, buffer = attach_shared_array(gains_spec)
+    _worker['gains_block'] = block
+    _worker['gains'] = unpack_gains(buffer, layouts)
+    _worker['attached'] = {}
+
+
+def _attached(spec):
+    """ Attaches to a shared array once per worker and reuses it for every task after that"""
+
+    attached = _worker['attached']
+    if spec.name not in attached:
+        attached[spec.name] = attach_shared_array(spec)
+    return attached[spec.name][1]
+
+
+def _release(names):
+    """ Detaches from the blocks of a finished run"""
+
+    for name in names:
+        block, _ = _worker['attached'].pop(name, (None, None))
+        if block is not None:
+            block.close()
+
+
+def _simulate_slice(task):
+    """ Simulates trajectories start to stop of one run and writes them into the shared output arrays"""
+
+    (start, stop, gains_index, backend, seed, inputs, outputs, released) = task
+    _release(released)
+
+    gains = _worker['gains'].get_gains(gains_index)
+    x_initial, x_hat_initial, u_initial, r, u_offset, u_limits = [_attached(spec) for spec in inputs]
+    dtype = _attached(outputs[0]).dtype
+    matrices = sim_kernels.kernel_matrices(gains, u_limits[0], u_limits[1], dtype)
+
+    # Every trajectory gets its own stream, so results don't depend on how the batch was split up
+    process_noise = np.empty((stop - start,) + r.shape[1:], dtype)
+    sensor_noise = np.empty((stop - start, r.shape[1], gains.q), dtype)
+    for i in range(start, stop):
+        process_noise[i - start], sensor_noise[i - start] = [
+            noise[0] for noise in sim_kernels.generate_noise(gains, 1, r.shape[1], np.random.default_rng([seed, i]),
+                                                             dtype)]
+
+    results = sim_kernels.run_kernel(backend, matrices, x_initial[start:stop], x_hat_initial[start:stop],
+                                     u_initial[start:stop], r[start:stop], u_offset[start:stop],
+                                     process_noise, sensor_noise)
+    for spec, result in zip(outputs, results):
+        _attached(spec)[start:stop] = result
+
+    return start, stop
+
+
+class ParallelSimRunner(object):
+    """
+    A pool of worker processes for Monte Carlo batches over one GainsList.
+
+    The gains are shared with the workers when the pool starts. Each call to run puts its inputs in shared memory,
+    splits the batch into chunks, and returns a SimResult whose arrays are views of the shared output blocks. Those
+    views stay valid until close, so copy anything that needs to outlive the runner.
+
+        with ParallelSimRunner(gains_list) as runner:
+            result = runner.run(1000, reference, x_initial, u_min, u_max, seed=5)
+    """
+
+    def __init__(self, gains, max_workers=None, backend='numpy'):
+        assert backend in ('numpy', 'numba'), 'The parallel runner uses the numpy or numba kernels'
+
+        buffer, self.layouts = pack_gains(gains)
+        self.gains_block, gains_array, self.gains_spec = create_shared_array(buffer.shape)
+        gains_array[:] = buffer
+        self.gains = unpack_gains(gains_array, self.layouts)
+
+        self.backend = backend
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_initialize_worker,
+                                        initargs=(self.gains_spec, self.layouts))
+
+        # Output blocks are kept until close, since the results handed out are views of them
+        self.output_blocks = []
+        # Input blocks of the last run, which workers can detach from once the next run starts
+        self.input_blocks = []
+        # Names of the last run's output blocks. Workers only write them during that run, so they can detach from
+        # them too (this process keeps them open for the results it handed out)
+        self.last_output_names = []
+
+    def _share(self, value, shape, dtype):
+        block, array, spec = create_shared_array(shape, dtype)
+        array[:] = value
+        self.input_blocks.append(block)
+        return spec
+
+    def run(self, batch, r, x_initial, u_min, u_max, x_hat_initial=None, u_initial=None, u_offset=None,
+            gains_index=0, seed=0, dtype=np.float64, chunk_size=None):
+        """ Simulates batch trajectories of r, which is (T, n) or (batch, T, n). Initial states are (n,) or (batch, n),
+            and x_hat_initial defaults to x_initial. Returns a SimResult of shared (batch, T, dim) arrays"""
+
+        gains = self.gains.get_gains(gains_index)
+        r = np.asarray(r, dtype=float)
+        steps = r.shape[-2]
+        t = np.arange(steps) * gains.dt
+
+        if x_hat_initial is None:
+            x_hat_initial = x_initial
+        if u_initial is None:
+            u_initial = np.zeros(gains.p)
+        if u_offset is None:
+            u_offset = np.zeros(gains.p)
+
+        # Blocks from the previous run can go now that every worker is done with it
+        released = [block.name for block in self.input_blocks] + self.last_output_names
+        for block in self.input_blocks:
+            block.close()
+            block.unlink()
+        self.input_blocks = []
+
+        inputs = [
+            self._share(np.broadcast_to(np.asarray(x_initial, dtype=float).reshape(-1, gains.n), (batch, gains.n)),
+                        (batch, gains.n), float),
+            self._share(np.broadcast_to(np.asarray(x_hat_initial, dtype=float).reshape(-1, gains.n),
+                                        (batch, gains.n)), (batch, gains.n), float),
+            self._share(np.broadcast_to(np.asarray(u_initial, dtype=float).reshape(-1, gains.p), (batch, gains.p)),
+                        (batch, gains.p), float),
+            self._share(np.broadcast_to(r, (batch, steps, gains.n)), (batch, steps, gains.n), float),
+            self._share(np.broadcast_to(np.asarray(u_offset, dtype=float), (batch, steps, gains.p)),
+                        (batch, steps, gains.p), float),
+            self._share(np.stack([np.broadcast_to(np.asarray(u_min, dtype=float).ravel(), (gains.p,)),
+                                  np.broadcast_to(np.asarray(u_max, dtype=float).ravel(), (gains.p,))]),
+                        (2, gains.p), float),
+        ]
+
+        outputs = []
+        arrays = []
+        for dim in (gains.n, gains.p, gains.q, gains.n):
+            block, array, spec = create_shared_array((batch, steps, dim), dtype)
+            self.output_blocks.append(block)
+            outputs.append(spec)
+            arrays.append(array)
+        self.last_output_names = [spec.name for spec in outputs]
+
+        if chunk_size is None:
+            # A few chunks per worker keeps them all busy without making the tasks tiny
+            chunk_size = max(1, -(-batch // (4 * self.max_workers)))
+        tasks = [(start, min(start + chunk_size, batch), gains_index, self.backend, seed, inputs, outputs, released)
+                 for start in range(0, batch, chunk_size)]
+        for _ in self.pool.map(_simulate_slice, tasks):
+            pass
+
+        return sim_kernels.SimResult(t, *arrays)
+
+    def close(self):
+        self.pool.shutdown()
+        for block in self.input_blocks + self.output_blocks + [self.gains_block]:
+            block.close()
+            block.unlink()
+        self.input_blocks = []
+        self.output_blocks = []
+        self.last_output_names = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
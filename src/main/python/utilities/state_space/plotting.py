@@ -0,0 +1,183 @@
+import numpy as np
+
+"""
+Plotting for long and batched simulation results, where handing every sample to plt.plot is unusably slow.
+
+Each signal is decimated down to about as many points as the axes are pixels wide before it's drawn, so rendering
+cost depends on the screen rather than the length of the run. The default decimation keeps the minimum and maximum of
+every pixel-wide bucket, which draws exactly the same picture as the full signal would, spikes included. Largest
+triangle three buckets (LTTB) is also available, which picks one visually representative point per bucket instead.
+
+Monte Carlo batches are drawn as a median line over shaded percentile bands, with the bands decimated by keeping the
+outermost edge of each bucket.
+
+matplotlib is only imported by the functions that actually draw, the decimation itself is plain NumPy.
+"""
+
+DEFAULT_PERCENTILES = (5., 25., 50., 75., 95.)
+
+
+def _bucket_indices(length, buckets):
+    """ Splits range(length) into buckets equal runs, padding the last one by repeating the final index.
+        Returns a (buckets, bucket_size) index array"""
+
+    bucket_size = -(-length // buckets)
+    indices = np.arange(buckets * bucket_size)
+    return np.minimum(indices, length - 1).reshape(buckets, bucket_size)
+
+
+def minmax_decimate(t, y, buckets):
+    """ Keeps the first and last point, and the minimum and maximum of each of buckets equal runs, in time order.
+        Signals that are already short enough come back unchanged"""
+
+    t = np.asarray(t)
+    y = np.asarray(y)
+    if len(y) <= 2 * buckets + 2:
+        return t, y
+
+    indices = _bucket_indices(len(y), buckets)
+    values = y[indices]
+    rows = np.arange(buckets)
+    low = indices[rows, np.argmin(values, axis=1)]
+    high = indices[rows, np.argmax(values, axis=1)]
+    # Within a bucket, whichever extreme comes first is drawn first
+    keep = np.concatenate([[0], np.sort(np.stack([low, high], axis=1), axis=1).ravel(), [len(y) - 1]])
+    return t[keep], y[keep]
+
+
+def lttb_decimate(t, y, threshold):
+    """ Largest triangle three buckets: keeps the first and last point, plus the point of each bucket in between that
+        makes the largest triangle with the point kept before it and the average of the next bucket"""
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    length = len(y)
+    if threshold >= length or threshold < 3:
+        return t, y
+
+    edges = np.floor(np.linspace(1, length - 1, threshold - 1)).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0] = 0
+    keep[-1] = length - 1
+
+    previous = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Average of the next bucket, or the last point for the final bucket
+        if i + 2 < len(edges):
+            next_start, next_stop = edges[i + 1], edges[i + 2]
+            t_next = t[next_start:next_stop].mean()
+            y_next = y[next_start:next_stop].mean()
+        else:
+            t_next = t[-1]
+            y_next = y[-1]
+
+        # Twice the triangle areas, which is all the comparison needs
+        areas = np.abs((t[previous] - t_next) * (y[start:stop] - y[previous])
+                       - (t[previous] - t[start:stop]) * (y_next - y[previous]))
+        previous = start + int(np.argmax(areas))
+        keep[i + 1] = previous
+
+    return t[keep], y[keep]
+
+
+def decimate(t, y, buckets, method='minmax'):
+    if method == 'minmax':
+        return minmax_decimate(t, y, buckets)
+    if method == 'lttb':
+        return lttb_decimate(t, y, 2 * buckets)
+    if method is None:
+        return np.asarray(t), np.asarray(y)
+    raise ValueError('Unknown decimation method ' + repr(method))
+
+
+def percentile_bands(values, percentiles=DEFAULT_PERCENTILES):
+    """ Percentiles across the batch at every step. values is (batch, T) and the result is (len(percentiles), T)"""
+    return np.percentile(np.asarray(values, dtype=float), percentiles, axis=0)
+
+
+def envelope_decimate(t, lower, upper, buckets):
+    """ Decimates a band by keeping the lowest lower edge and the highest upper edge of every bucket, so the band is
+        never drawn narrower than it really is. Each bucket is drawn from its first time to its last"""
+
+    t = np.asarray(t)
+    lower = np.asarray(lower)
+    upper = np.asarray(upper)
+    if len(t) <= 2 * buckets:
+        return t, lower, upper
+
+    indices = _bucket_indices(len(t), buckets)
+    band_lower = lower[indices].min(axis=1)
+    band_upper = upper[indices].max(axis=1)
+    # Two points per bucket, so the band stays a step shape instead of being interpolated between buckets
+    band_t = np.stack([t[indices[:, 0]], t[indices[:, -1]]], axis=1).ravel()
+    return band_t, np.repeat(band_lower, 2), np.repeat(band_upper, 2)
+
+
+def axes_pixel_width(axes):
+    """ Width of the axes on screen, in pixels"""
+    return max(int(axes.get_window_extent().width), 1)
+
+
+def plot_signal(axes, t, y, buckets=None, method='minmax', **kwargs):
+    """ Plots one signal decimated to the width of the axes. Returns the line"""
+
+    if buckets is None:
+        buckets = axes_pixel_width(axes)
+    t_plot, y_plot = decimate(t, y, buckets, method)
+    line, = axes.plot(t_plot, y_plot, **kwargs)
+    return line
+
+
+def plot_batch(axes, t, values, percentiles=DEFAULT_PERCENTILES, buckets=None, method='minmax', label=None,
+               color=None, alpha=0.2):
+    """ Plots a (batch, T) signal as its median, with a shaded band between each symmetric pair of percentiles.
+        percentiles must be sorted and should include 50 for the median line"""
+
+    if buckets is None:
+        buckets = axes_pixel_width(axes)
+
+    percentiles = list(percentiles)
+    bands = percentile_bands(values, percentiles)
+
+    if 50. in percentiles:
+        line = plot_signal(axes, t, bands[percentiles.index(50.)], buckets, method, label=label, color=color)
+        color = line.get_color()
+
+    for i in range(len(percentiles) // 2):
+        band_t, lower, upper = envelope_decimate(t, bands[i], bands[-1 - i], buckets)
+        axes.fill_between(band_t, lower, upper, color=color, alpha=alpha, linewidth=0.)
+
+    return bands
+
+
+def signal_names(num_states, num_inputs, num_sensor_inputs):
+    """ Names in the same x, u, y, x_hat order the plot_settings tuples use"""
+    return (['x%d' % i for i in range(num_states)] + ['u%d' % i for i in range(num_inputs)]
+            + ['y%d' % i for i in range(num_sensor_inputs)] + ['x_hat%d' % i for i in range(num_states)])
+
+
+def plot_sim_result(result, plot_settings, axes=None, percentiles=DEFAULT_PERCENTILES, method='minmax'):
+    """ Plots the signals of a SimResult picked out by plot_settings (x, u, y, then x_hat, like the plot_* methods of
+        StateSpaceControlSim) against time. Batches of one are drawn as lines, bigger batches as percentile bands"""
+
+    import matplotlib.pyplot as plt
+
+    if axes is None:
+        _, axes = plt.subplots()
+
+    signals = [result.x, result.u, result.y, result.x_hat]
+    columns = [(signal, i) for signal in signals for i in range(signal.shape[-1])]
+    names = signal_names(result.x.shape[-1], result.u.shape[-1], result.y.shape[-1])
+
+    for flag, (signal, i), name in zip(plot_settings, columns, names):
+        if not flag:
+            continue
+        if signal.shape[0] == 1:
+            plot_signal(axes, result.t, signal[0, :, i], method=method, label=name)
+        else:
+            plot_batch(axes, result.t, signal[:, :, i], percentiles, method=method, label=name)
+
+    axes.set_xlabel('t (s)')
+    axes.legend()
+    return axes
@@ -0,0 +1,137 @@
+import numpy as np
+from collections import namedtuple
+
+"""
+Step response and input metrics for whole batches of trajectories, like the (batch, T, dim) arrays in the SimResult from
+StateSpaceControlSim.simulate. Everything is computed with array operations over the batch and signal axes at once, so
+ranking tens of thousands of runs costs about as much as a few passes over their trajectories.
+
+A step is a window of samples over which the reference is held: the response starts from wherever the signal is at the
+first sample of the window and the target is the reference at the last one. step_windows finds them in a reference like
+motor_test's, which steps a couple of times during a run.
+
+Anything that's undefined for a run is NaN instead of raising, e.g. the rise time of a response that never gets to 90%
+or the settling time of one that's still outside the band at the end of the window. Overshoot, rise and settling are
+all relative to the size of the step, so they're NaN for a signal whose reference didn't change.
+"""
+
+# Every field is (batch, signal), with the steady-state error signed as target - response
+StepMetrics = namedtuple('StepMetrics', ['rise_time', 'overshoot', 'settling_time', 'steady_state_error',
+                                         'integrated_absolute_error'])
+
+# Every field is (batch, p)
+InputMetrics = namedtuple('InputMetrics', ['peak', 'rms', 'time_saturated', 'fraction_saturated'])
+
+
+def step_windows(r, t_start=0):
+    """ (start, stop) sample indices of every stretch where the reference r (T, signal) is held constant, from sample
+        t_start on"""
+
+    r = np.asarray(r, dtype=float).reshape(len(r), -1)
+    changes = np.flatnonzero(np.any(r[1:] != r[:-1], axis=1)) + 1
+    edges = [t_start] + [int(change) for change in changes if change > t_start] + [len(r)]
+    return [(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop - start > 1]
+
+
+def _first_true(mask):
+    """ Index of the first True along the last axis and whether there is one, without a second pass over mask"""
+    index = np.argmax(mask, axis=-1)
+    return index, np.take_along_axis(mask, index[..., None], axis=-1)[..., 0]
+
+
+def step_metrics(t, y, r, window=None, rise=(0.1, 0.9), settling_band=0.02, final_samples=10):
+    """
+    Metrics of the response y (batch, T, signal) to the reference r, (T, signal) or (batch, T, signal), over the
+    window (start, stop) of samples (the whole run by default). t is the (T,) sample times.
+
+    The rise time is from the response first reaching rise[0] of the step to first reaching rise[1], the overshoot is
+    how far past the target it goes as a fraction of the step, and the settling time is from the start of the window to
+    when the response last comes back inside settling_band (again a fraction of the step) of the target.
+    The steady-state error is averaged over the last final_samples samples, and the integrated absolute error is the
+    sum of |r - y| * dt over the window.
+    """
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y)
+    r = np.asarray(r, dtype=float)
+    start, stop = (0, y.shape[1]) if window is None else window
+    assert stop - start > 1, 'A step window needs at least two samples'
+
+    t_window = t[start:stop]
+    y_window = y[:, start:stop]
+    r_window = r[..., start:stop, :]
+    dt = t[1] - t[0]
+
+    initial = y_window[:, 0]
+    target = np.broadcast_to(r_window[..., -1, :], initial.shape)
+    step = target - initial
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step = np.where(step == 0., np.nan, step)
+        # 0 at the start of the window and 1 at the target, whichever way the step goes. Laid out as
+        # (batch, signal, T) so every reduction below runs along contiguous memory
+        progress = np.ascontiguousarray(np.swapaxes(y_window, 1, 2), dtype=float)
+        progress -= initial[..., None]
+        progress /= step[..., None]
+
+        low, reached_low = _first_true(progress >= rise[0])
+        high, reached_high = _first_true(progress >= rise[1])
+        rise_time = np.where(reached_low & reached_high, t_window[high] - t_window[low], np.nan)
+
+        overshoot = np.maximum(np.max(progress, axis=-1) - 1., 0.)
+
+        outside = ~(np.abs(progress - 1.) <= settling_band)
+        last_outside, any_outside = _first_true(outside[..., ::-1])
+        settled_index = np.minimum(outside.shape[-1] - last_outside, outside.shape[-1] - 1)
+        settling_time = np.where(any_outside, t_window[settled_index] - t_window[0], 0.)
+        settling_time = np.where(outside[..., -1], np.nan, settling_time)
+
+    steady_state_error = target - np.mean(y_window[:, -final_samples:], axis=1)
+    integrated_absolute_error = np.sum(np.abs(r_window - y_window), axis=1) * dt
+
+    return StepMetrics(rise_time, overshoot, settling_time, steady_state_error, integrated_absolute_error)
+
+
+def input_metrics(t, u, u_min, u_max, window=None):
+    """ Peak and rms of |u| (batch, T, p) and how long it spends at u_min or u_max, over the window (start, stop)"""
+
+    t = np.asarray(t, dtype=float)
+    u = np.asarray(u)
+    start, stop = (0, u.shape[1]) if window is None else window
+    u_window = u[:, start:stop]
+    p = u.shape[-1]
+    u_min = np.broadcast_to(np.asarray(u_min, dtype=float).ravel(), (p,))
+    u_max = np.broadcast_to(np.asarray(u_max, dtype=float).ravel(), (p,))
+
+    saturated = np.count_nonzero((u_window <= u_min) | (u_window >= u_max), axis=1)
+    return InputMetrics(np.max(np.abs(u_window), axis=1), np.sqrt(np.mean(np.square(u_window), axis=1)),
+                        saturated * (t[1] - t[0]), saturated / u_window.shape[1])
+
+
+def response_metrics(result, r, u_min, u_max, signal='x', window=None, **step_options):
+    """ step_metrics of one of a SimResult's signals ('x', 'y' or 'x_hat') against r, and input_metrics of its u, over
+        the same window"""
+
+    return (step_metrics(result.t, getattr(result, signal), r, window, **step_options),
+            input_metrics(result.t, result.u, u_min, u_max, window))
+
+
+def rank_runs(metrics, weights, signals=None):
+    """
+    Orders the runs best first by the weighted sum of some of their metrics, e.g.
+        rank_runs(step, {'settling_time': 1., 'overshoot': 0.5}, signals=[0])
+    where metrics is a StepMetrics or InputMetrics (or anything else with (batch, signal) fields), summed over signals
+    (all of them by default). The steady-state error counts by its magnitude, and a run with any NaN in a weighted
+    metric goes to the back, so leave out signals whose reference doesn't step. Returns the order and the (batch,)
+    scores.
+    """
+
+    score = 0.
+    for name, weight in weights.items():
+        values = np.abs(getattr(metrics, name))
+        values = values.reshape(len(values), -1)
+        if signals is not None:
+            values = values[:, signals]
+        score = score + weight * np.sum(np.where(np.isnan(values), np.inf, values), axis=1)
+    score = np.asarray(score, dtype=float)
+    return np.argsort(score, kind='stable'), score
@@ -0,0 +1,193 @@
+import numpy as np
+import scipy.linalg
+from collections import namedtuple
+from utilities.state_space import sim_kernels
+
+"""
+Robustness of a fixed design to the physical parameters being off: the gains (K, L, Kff) are designed for the nominal
+moment of inertia, gear ratio and efficiency, and the plant is rebuilt for thousands of sampled variants of those.
+
+Everything is batched over the variants. The continuous A and B are built as stacks by the model's
+batched_continuous_model, discretized with one stacked expm, and then two things are checked for every variant at once:
+    the eigenvalues of the closed loop of the real plant with the nominal observer and controller, a 2n x 2n matrix
+    since the observer's model doesn't match the plant, so the loop doesn't separate into the controller and observer
+    a simulation of the whole batch stepping together, with the same ordering as the sim kernels
+and the results are summarized as percentiles and worst cases across the variants.
+
+The sign conventions are the same as StateSpaceControlSim. With u = K * (r - x_hat), y = C * x + D * u measured after
+the plant steps, and x_hat[k+1] = (A - LC) * x_hat[k] + B * u[k] + L * y[k+1], the closed loop of [x; x_hat] is
+    [[A_p,         -B_p * K                                    ],
+     [L * C * A_p, A - LC - B * K - L * C * B_p * K - L * D * K]]
+"""
+
+RobustnessReport = namedtuple('RobustnessReport', ['parameters', 'spectral_radius', 'is_stable', 'result', 'metrics',
+                                                   'percentiles', 'worst'])
+
+
+def sample_parameters(nominal, relative_spread, num, rng=None, distribution='uniform', upper_bounds=None):
+    """ Samples num variants of the parameters in nominal (a dict of name to nominal value). Each parameter in
+        relative_spread is either uniform within +- that fraction of nominal, or normal with that fraction as its
+        relative standard deviation, and parameters without a spread stay nominal. Parameters in upper_bounds are
+        clipped to at most that value, e.g. {'efficiency': 1.} since nothing's better than ideal.
+        Returns a dict of (num,) arrays"""
+
+    if rng is None:
+        rng = np.random.default_rng()
+    if upper_bounds is None:
+        upper_bounds = {}
+    assert distribution in ('uniform', 'normal'), 'Distribution must be uniform or normal'
+
+    samples = {}
+    for name, value in nominal.items():
+        spread = relative_spread.get(name, 0.)
+        if distribution == 'uniform':
+            scale = 1. + rng.uniform(-spread, spread, num)
+        else:
+            # Physical parameters can't go negative, however wide the spread is
+            scale = np.maximum(1. + spread * rng.standard_normal(num), 1.e-3)
+        samples[name] = np.minimum(value * scale, upper_bounds.get(name, np.inf))
+    return samples
+
+
+def batched_c2d(A, B, dt):
+    """ Zero-order hold discretization of stacks of (N, n, n) A and (N, n, p) B, with one stacked expm"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    batch, n, _ = A.shape
+    p = B.shape[-1]
+
+    M = np.zeros((batch, n + p, n + p))
+    M[:, :n, :n] = A
+    M[:, :n, n:] = B
+    N = scipy.linalg.expm(M * dt)
+    return N[:, :n, :n], N[:, :n, n:]
+
+
+def closed_loop_matrix(A_plant, B_plant, gains):
+    """ The (N, 2n, 2n) closed loop of [x; x_hat] for every plant variant, with the gains' own observer and
+        controller"""
+
+    A = np.asarray(gains.A, dtype=float)
+    B = np.asarray(gains.B, dtype=float)
+    C = np.asarray(gains.C, dtype=float)
+    D = np.asarray(gains.D, dtype=float)
+    K = np.asarray(gains.K, dtype=float)
+    L = np.asarray(gains.L, dtype=float)
+    n = gains.n
+    batch = A_plant.shape[0]
+
+    M = np.empty((batch, 2 * n, 2 * n))
+    M[:, :n, :n] = A_plant
+    M[:, :n, n:] = -B_plant @ K
+    M[:, n:, :n] = L @ C @ A_plant
+    M[:, n:, n:] = (A - L @ C - B @ K - L @ D @ K) - L @ C @ B_plant @ K
+    return M
+
+
+def simulate_variants(A_plant, B_plant, gains, r, x_initial, u_min, u_max, x_hat_initial=None, u_initial=None,
+                      u_offset=None, process_noise=None, sensor_noise=None):
+    """ Simulates every plant variant against the gains' observer and controller in one batch, in the same order as
+        sim_kernels.run_kernel. r and u_offset are (T, dim) or (N, T, dim), and the noise is (N, T, dim) or None for
+        none. Returns a SimResult without t"""
+
+    m = sim_kernels.kernel_matrices(gains, u_min, u_max)
+    batch = A_plant.shape[0]
+    n, p, q = gains.n, gains.p, gains.q
+    r = np.broadcast_to(np.asarray(r, dtype=float), (batch,) + np.shape(r)[-2:])
+    steps = r.shape[1]
+    u_offset = np.zeros((batch, steps, p)) if u_offset is None else \
+        np.broadcast_to(np.asarray(u_offset, dtype=float), (batch, steps, p))
+
+    x = np.array(np.broadcast_to(np.asarray(x_initial, dtype=float).reshape(-1, n), (batch, n)))
+    x_hat = x.copy() if x_hat_initial is None else \
+        np.array(np.broadcast_to(np.asarray(x_hat_initial, dtype=float).reshape(-1, n), (batch, n)))
+    u = np.zeros((batch, p)) if u_initial is None else \
+        np.array(np.broadcast_to(np.asarray(u_initial, dtype=float).reshape(-1, p), (batch, p)))
+
+    x_out = np.empty((batch, steps, n))
+    u_out = np.empty((batch, steps, p))
+    y_out = np.empty((batch, steps, q))
+    x_hat_out = np.empty((batch, steps, n))
+
+    A_plant_T = np.swapaxes(A_plant, 1, 2)
+    B_plant_T = np.swapaxes(B_plant, 1, 2)
+    # Unstable variants overflow eventually, which is the answer rather than an error
+    with np.errstate(over='ignore', invalid='ignore'):
+        for t in range(steps):
+            x = (x[:, None, :] @ A_plant_T + u[:, None, :] @ B_plant_T)[:, 0]
+            if process_noise is not None:
+                x = x + process_noise[:, t]
+            y = x @ m.C.T + u @ m.D.T
+            if sensor_noise is not None:
+                y = y + sensor_noise[:, t]
+            x_hat = x_hat @ m.A_LC.T + u @ m.B.T + y @ m.L.T
+            u = np.clip((r[:, t] - x_hat) @ m.K.T + u_offset[:, t], m.u_min, m.u_max)
+
+            x_out[:, t] = x
+            u_out[:, t] = u
+            y_out[:, t] = y
+            x_hat_out[:, t] = x_hat
+
+    return sim_kernels.SimResult(None, x_out, u_out, y_out, x_hat_out)
+
+
+def tracking_metrics(result, r, u_min, u_max):
+    """ Per-variant metrics: rms and final absolute tracking error of each state, and the largest input and the
+        fraction of steps saturated for each input"""
+
+    r = np.broadcast_to(np.asarray(r, dtype=float), result.x.shape)
+    error = result.x - r
+    u_min = np.asarray(u_min, dtype=float).ravel()
+    u_max = np.asarray(u_max, dtype=float).ravel()
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        return {
+            'rms_error': np.sqrt(np.mean(error ** 2, axis=1)),
+            'final_error': np.abs(error[:, -1]),
+            'max_abs_u': np.max(np.abs(result.u), axis=1),
+            'saturated_fraction': np.mean((result.u <= u_min) | (result.u >= u_max), axis=1),
+        }
+
+
+def analyze_robustness(gains, plant_builder, parameters, r, x_initial, percentiles=(5., 50., 95.), use_ff=False,
+                       noise_seed=None):
+    """
+    Checks the gains against every variant in parameters (a dict of (N,) arrays, e.g. from sample_parameters).
+    plant_builder(**parameters) returns the stacked continuous A and B, like the models' batched_continuous_model.
+
+    Returns a RobustnessReport with the parameters, each variant's closed-loop spectral radius and whether it's
+    stable, the simulation, the per-variant metrics, their percentiles across variants (the spectral radius included)
+    and the worst variant for each, as (worst value, variant index) per column. Noise is only added if noise_seed is
+    given, and then drawn the same way sim_kernels.generate_noise draws it.
+    """
+
+    A_continuous, B_continuous = plant_builder(**parameters)
+    A_plant, B_plant = batched_c2d(A_continuous, B_continuous, gains.dt)
+    batch = A_plant.shape[0]
+
+    spectral_radius = np.max(np.abs(np.linalg.eigvals(closed_loop_matrix(A_plant, B_plant, gains))), axis=-1)
+    is_stable = spectral_radius < 1.
+
+    r = np.asarray(r, dtype=float)
+    u_offset = sim_kernels.feedforward_offset(gains, r, np.asarray(x_initial, dtype=float)) if use_ff else None
+    process_noise = sensor_noise = None
+    if noise_seed is not None:
+        process_noise, sensor_noise = sim_kernels.generate_noise(gains, batch, r.shape[-2],
+                                                                 np.random.default_rng(noise_seed))
+
+    result = simulate_variants(A_plant, B_plant, gains, r, x_initial, gains.u_min, gains.u_max, u_offset=u_offset,
+                               process_noise=process_noise, sensor_noise=sensor_noise)
+
+    metrics = tracking_metrics(result, r, gains.u_min, gains.u_max)
+    metrics['spectral_radius'] = spectral_radius
+
+    summary = {}
+    worst = {}
+    for name, values in metrics.items():
+        # An overflowed run counts as the worst possible one
+        values = np.where(np.isnan(values), np.inf, values)
+        summary[name] = np.percentile(values, percentiles, axis=0)
+        worst[name] = (np.max(values, axis=0), np.argmax(values, axis=0))
+
+    return RobustnessReport(parameters, spectral_radius, is_stable, result, metrics, summary, worst)
@@ -0,0 +1,239 @@
+import asyncio
+import numpy as np
+from collections import namedtuple
+from utilities.telemetry import RingBuffer, record_dtype, encode_records
+
+"""
+Runs a plant as a service on a local UDP socket, so controller code outside the sim (another process, another
+language, the real robot code in a desktop build) can be run against the model in the loop.
+
+Messages use the same packed records as the telemetry stream: a sequence number, a timestamp, then the values. The
+controller sends inputs (p values) and the plant publishes its noisy sensor outputs (q values) back to whichever
+address last sent it an input. Output record k is the measurement after step k, stamped with the sim time at the end
+of the step, and an input record with sequence k is the input for step k. That's the order StateSpaceControlSim runs
+in: the first input goes out before any measurement has come back, so a controller starts by sending u_initial.
+
+Two modes:
+    'realtime'      the plant steps every dt of wall-clock time (divided by speed), applying whichever input arrived
+                    most recently, like a real mechanism would. Steps are scheduled on absolute deadlines so timing
+                    errors don't accumulate, and the lateness of every step is recorded as jitter. Steps that start
+                    a whole period late are overruns, and steps that go ahead without an input for them are holds
+    'lockstep'      the plant steps as soon as the input for the next step arrives and replies immediately, which
+                    runs as fast as the controller can go and is repeatable down to the noise
+"""
+
+MODES = ('realtime', 'lockstep')
+
+# Lateness is in seconds. held_inputs counts steps that reused an older input because the new one hadn't arrived
+LoopStats = namedtuple('LoopStats', ['steps', 'elapsed', 'mean_lateness', 'p99_lateness', 'max_lateness',
+                                     'overruns', 'held_inputs', 'stale_inputs'])
+
+
+class _DatagramEndpoint(asyncio.DatagramProtocol):
+
+    def __init__(self, receive):
+        self.receive = receive
+
+    def datagram_received(self, data, address):
+        self.receive(data, address)
+
+
+class PlantServer(object):
+    """ Serves any plant with the StateSpacePlant update interface, e.g. sim.plant of a StateSpaceControlSim"""
+
+    def __init__(self, plant, u_initial=None, mode='realtime', speed=1., spin=0., stats_capacity=100000):
+        assert mode in MODES, 'Mode must be one of ' + ', '.join(MODES)
+        assert speed > 0., 'Speed must be positive'
+
+        self.plant = plant
+        self.mode = mode
+        self.speed = speed
+        # Busy-waiting the last spin seconds before each deadline trades a core for less jitter than sleep alone
+        self.spin = spin
+
+        gains = plant.current_gains
+        self.p = gains.p
+        self.input_dtype = record_dtype(gains.p)
+        self.u = np.zeros((gains.p, 1)) if u_initial is None else np.asmatrix(u_initial).reshape(gains.p, 1)
+        self.u_sequence = -1
+
+        self.step = 0
+        self.steps = None
+        self.client = None
+        self.transport = None
+        self.done = None
+
+        self.lateness = RingBuffer(stats_capacity, 1)
+        self.overruns = 0
+        self.held_inputs = 0
+        self.stale_inputs = 0
+        self.elapsed = 0.
+
+    @property
+    def dt(self):
+        return self.plant.current_gains.dt
+
+    async def start(self, host='127.0.0.1', port=0):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _DatagramEndpoint(self.receive),
+                                                                local_addr=(host, port))
+        return self.transport.get_extra_info('sockname')
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def receive(self, data, address):
+        if len(data) == 0 or len(data) % self.input_dtype.itemsize != 0:
+            return
+        self.client = address
+
+        for record in np.frombuffer(data, dtype=self.input_dtype):
+            sequence = int(record['sequence'])
+            if sequence <= self.u_sequence or sequence < self.step:
+                # Duplicates, and inputs for steps that have already been run
+                self.stale_inputs += 1
+                continue
+            if self.mode == 'lockstep' and sequence != self.step:
+                # Can't skip ahead, the steps in between never got inputs
+                self.stale_inputs += 1
+                continue
+
+            self.u = np.asmatrix(record['values'].reshape(self.p, 1))
+            self.u_sequence = sequence
+            # Between runs the input is only held on to, and the next run steps it as soon as it starts
+            if self.mode == 'lockstep' and self.steps is not None:
+                self._step()
+
+    def _step(self):
+        if self.steps is None or self.step >= self.steps:
+            return
+        if self.u_sequence < self.step:
+            self.held_inputs += 1
+
+        y = np.asarray(self.plant.update(self.u), dtype=float).ravel()
+        self.step += 1
+        if self.client is not None and self.transport is not None:
+            self.transport.sendto(encode_records([self.step - 1], [self.step * self.dt], y[None]), self.client)
+
+        if self.step >= self.steps and self.done is not None and not self.done.done():
+            self.done.set_result(None)
+
+    async def run(self, steps):
+        """ Runs steps plant steps in the server's mode and returns the loop statistics. The plant only steps while a
+            run is going, so it can be run again for more steps afterwards"""
+
+        loop = asyncio.get_running_loop()
+        self.steps = self.step + steps
+        self.done = loop.create_future()
+        start = loop.time()
+
+        try:
+            if self.mode == 'lockstep':
+                if self.u_sequence == self.step:
+                    # The input for the first step came in before the run started
+                    self._step()
+                if self.step >= self.steps and not self.done.done():
+                    self.done.set_result(None)
+                await self.done
+            else:
+                await self._run_realtime(loop, start)
+        finally:
+            self.steps = None
+            if not self.done.done():
+                self.done.cancel()
+            self.done = None
+
+        self.elapsed += loop.time() - start
+        return self.stats()
+
+    async def _run_realtime(self, loop, start):
+        """ Steps on absolute deadlines every dt / speed until the run's steps are done"""
+
+        period = self.dt / self.speed
+        first = self.step
+        while self.step < self.steps:
+            deadline = start + (self.step - first + 1) * period
+            delay = deadline - loop.time() - self.spin
+            if delay > 0.:
+                await asyncio.sleep(delay)
+            while loop.time() < deadline:
+                # Still lets inputs in while spinning, since sleep(0) runs one pass of the event loop
+                await asyncio.sleep(0.)
+
+            lateness = loop.time() - deadline
+            self.lateness.append([lateness])
+            if lateness > period:
+                self.overruns += 1
+            self._step()
+
+    def stats(self):
+        lateness = self.lateness.latest()[:, 0]
+        if len(lateness) == 0:
+            lateness = np.zeros(1)
+        return LoopStats(self.step, self.elapsed, float(np.mean(lateness)), float(np.percentile(lateness, 99.)),
+                         float(np.max(lateness)), self.overruns, self.held_inputs, self.stale_inputs)
+
+
+class PlantClient(object):
+    """ The controller's end of the socket. Measurements are queued as (sequence, timestamp, y) as they arrive"""
+
+    def __init__(self, num_inputs, num_outputs):
+        self.num_inputs = num_inputs
+        self.output_dtype = record_dtype(num_outputs)
+        self.measurements = asyncio.Queue()
+        self.transport = None
+
+    async def connect(self, host, port):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _DatagramEndpoint(self.receive),
+                                                                remote_addr=(host, port))
+
+    def receive(self, data, address):
+        if len(data) == 0 or len(data) % self.output_dtype.itemsize != 0:
+            return
+        for record in np.frombuffer(data, dtype=self.output_dtype):
+            self.measurements.put_nowait((int(record['sequence']), float(record['timestamp']),
+                                          np.asmatrix(record['values'].reshape(-1, 1))))
+
+    def send(self, sequence, u, timestamp=0.):
+        self.transport.sendto(encode_records([sequence], [timestamp], np.asarray(u, dtype=float).reshape(1, -1)))
+
+    async def step(self, sequence, u):
+        """ Sends the input for step sequence and waits for the measurement that comes back. Lockstep only"""
+
+        self.send(sequence, u)
+        while True:
+            received, timestamp, y = await self.measurements.get()
+            if received == sequence:
+                return timestamp, y
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+async def run_controller(client, observer, controller, reference_calculator, u_initial, steps, use_ff=False):
+    """ Closes the loop over the socket with a StateSpaceObserver and StateSpaceController, the same way
+        StateSpaceControlSim.update does: u goes out, y comes back, the observer and then the controller update.
+        Works in either mode, since it answers every measurement with the input for the next step.
+        Returns the (steps, ...) u, y and x_hat that were used and seen"""
+
+    control = controller.bounded_update_ff if use_ff else controller.bounded_update
+    u = np.asmatrix(u_initial)
+    u_out, y_out, x_hat_out = [], [], []
+
+    client.send(0, u)
+    for _ in range(steps):
+        sequence, timestamp, y = await client.measurements.get()
+        x_hat = observer.update(u, y)
+        u = control(reference_calculator(timestamp - observer.current_gains.dt), x_hat)
+        client.send(sequence + 1, u, timestamp)
+
+        u_out.append(np.asarray(u, dtype=float).ravel())
+        y_out.append(np.asarray(y, dtype=float).ravel())
+        x_hat_out.append(np.asarray(x_hat, dtype=float).ravel())
+
+    return np.array(u_out), np.array(y_out), np.array(x_hat_out)
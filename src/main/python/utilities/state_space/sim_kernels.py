@@ -0,0 +1,295 @@
+import numpy as np
+from collections import namedtuple
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+"""
+Whole-trajectory simulation kernels for StateSpaceControlSim.
+
+StateSpaceControlSim.update does a handful of np.matrix products per step, and for a 2 state model almost all of the
+time goes to NumPy call overhead rather than arithmetic. These kernels run the entire
+    plant -> observer -> controller -> clip
+loop over T steps (and a batch of trajectories) in one call instead:
+    'numpy'  vectorizes across the batch, so the overhead is paid once per step instead of once per step per trajectory
+    'numba'  compiles scalar loops over the fixed-size matrices, if numba is installed
+Noise is generated up front, so every backend (including the reference object path) can be fed exactly the same noise
+and checked against each other with check_backend_equivalence.
+
+The kernels can also run and store everything in float32, which halves the memory of big Monte Carlo batches (the
+trajectories of 10^4 runs of 10^4 steps of the motor model are 5.6 GB in float64) and makes the memory-bound numpy
+backend faster. The gains are still synthesized in float64 and only rounded when they're handed to the kernel.
+check_precision measures what that costs in accuracy.
+"""
+
+HAVE_NUMBA = numba is not None
+BACKENDS = ('reference', 'numpy', 'numba')
+
+# Every field is (batch, T, dim), except t which is (T,)
+SimResult = namedtuple('SimResult', ['t', 'x', 'u', 'y', 'x_hat'])
+
+KernelMatrices = namedtuple('KernelMatrices', ['A', 'B', 'C', 'D', 'A_LC', 'L', 'K', 'u_min', 'u_max'])
+
+
+def kernel_matrices(gains, u_min, u_max, dtype=np.float64):
+    """ The gains as contiguous arrays of dtype, with A - LC precomputed (in float64) like the observer does every
+        step"""
+
+    p = gains.p
+
+    def as_array(M):
+        return np.ascontiguousarray(np.asarray(M, dtype=float), dtype=dtype)
+
+    return KernelMatrices(as_array(gains.A), as_array(gains.B), as_array(gains.C), as_array(gains.D),
+                          as_array(gains.A - gains.L * gains.C), as_array(gains.L), as_array(gains.K),
+                          as_array(np.broadcast_to(np.asarray(u_min, dtype=float).ravel(), (p,))),
+                          as_array(np.broadcast_to(np.asarray(u_max, dtype=float).ravel(), (p,))))
+
+
+def generate_noise(gains, batch, steps, rng=None, dtype=np.float64):
+    """ Process and sensor noise for a whole run, (batch, T, n) and (batch, T, q), scaled the same way
+        StateSpacePlant.generate_noise scales it"""
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    Q_noise = np.asarray(gains.Q_noise, dtype=dtype)
+    R_noise = np.asarray(gains.R_noise, dtype=dtype)
+    process_noise = rng.standard_normal((batch, steps, gains.n), dtype=dtype) @ Q_noise.T
+    sensor_noise = rng.standard_normal((batch, steps, gains.q), dtype=dtype) @ R_noise.T
+
+    return process_noise, sensor_noise
+
+
+def feedforward_offset(gains, r, r_held):
+    """ The Kff * (r - A * r_held) term StateSpaceController.update_ff adds to the feedback, for every step of r
+        (T, n) at once. update_ff never advances the controller's r, so r_held is whatever the controller holds"""
+
+    A = np.asarray(gains.A, dtype=float)
+    Kff = np.asarray(gains.Kff, dtype=float)
+    r_held = np.asarray(r_held, dtype=float).ravel()
+
+    return (r - A @ r_held) @ Kff.T
+
+
+def _simulate_numpy(m, x, x_hat, u, r, u_offset, process_noise, sensor_noise, out):
+    """ Steps every trajectory in the batch at once. x, x_hat and u are (batch, dim), the rest are (batch, T, dim)"""
+
+    x_out, u_out, y_out, x_hat_out = out
+    A_T = m.A.T
+    B_T = m.B.T
+    C_T = m.C.T
+    D_T = m.D.T
+    A_LC_T = m.A_LC.T
+    L_T = m.L.T
+    K_T = m.K.T
+
+    for t in range(r.shape[1]):
+        x = x @ A_T + u @ B_T + process_noise[:, t]
+        y = x @ C_T + u @ D_T + sensor_noise[:, t]
+        x_hat = x_hat @ A_LC_T + u @ B_T + y @ L_T
+        u = np.clip((r[:, t] - x_hat) @ K_T + u_offset[:, t], m.u_min, m.u_max)
+
+        x_out[:, t] = x
+        u_out[:, t] = u
+        y_out[:, t] = y
+        x_hat_out[:, t] = x_hat
+
+
+def _simulate_scalar(A, B, C, D, A_LC, L, K, u_min, u_max, x_initial, x_hat_initial, u_initial, r, u_offset,
+                     process_noise, sensor_noise, x_out, u_out, y_out, x_hat_out):
+    """ The same loop written out as scalar arithmetic, which is what numba compiles. It also runs as plain Python,
+        just very slowly, which is how the kernel itself gets checked where numba isn't installed"""
+
+    batch = r.shape[0]
+    steps = r.shape[1]
+    n = A.shape[0]
+    p = B.shape[1]
+    q = C.shape[0]
+
+    for b in _prange(batch):
+        x = x_initial[b].copy()
+        x_hat = x_hat_initial[b].copy()
+        u = u_initial[b].copy()
+        next_x = np.empty_like(x)
+        next_x_hat = np.empty_like(x)
+        y = np.empty_like(sensor_noise[b, 0])
+
+        for t in range(steps):
+            for i in range(n):
+                total = process_noise[b, t, i]
+                for j in range(n):
+                    total += A[i, j] * x[j]
+                for j in range(p):
+                    total += B[i, j] * u[j]
+                next_x[i] = total
+            for i in range(n):
+                x[i] = next_x[i]
+
+            for i in range(q):
+                total = sensor_noise[b, t, i]
+                for j in range(n):
+                    total += C[i, j] * x[j]
+                for j in range(p):
+                    total += D[i, j] * u[j]
+                y[i] = total
+
+            for i in range(n):
+                total = 0.
+                for j in range(n):
+                    total += A_LC[i, j] * x_hat[j]
+                for j in range(p):
+                    total += B[i, j] * u[j]
+                for j in range(q):
+                    total += L[i, j] * y[j]
+                next_x_hat[i] = total
+            for i in range(n):
+                x_hat[i] = next_x_hat[i]
+
+            for i in range(p):
+                total = u_offset[b, t, i]
+                for j in range(n):
+                    total += K[i, j] * (r[b, t, j] - x_hat[j])
+                u[i] = min(max(total, u_min[i]), u_max[i])
+
+            for i in range(n):
+                x_out[b, t, i] = x[i]
+                x_hat_out[b, t, i] = x_hat[i]
+            for i in range(p):
+                u_out[b, t, i] = u[i]
+            for i in range(q):
+                y_out[b, t, i] = y[i]
+
+
+if HAVE_NUMBA:
+    _prange = numba.prange
+    _simulate_compiled = numba.njit(cache=True, parallel=True)(_simulate_scalar)
+else:
+    _prange = range
+    _simulate_compiled = None
+
+
+def _batch_array(value, batch, steps, dim, dtype):
+    """ Broadcasts (dim,), (T, dim) or (batch, T, dim) up to a contiguous (batch, T, dim) array"""
+
+    value = np.asarray(value, dtype=dtype)
+    if value.ndim == 1:
+        value = value.reshape(1, 1, dim)
+    elif value.ndim == 2:
+        value = value[None]
+    return np.ascontiguousarray(np.broadcast_to(value, (batch, steps, dim)))
+
+
+def _initial_array(value, batch, dim, dtype):
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=dtype).reshape(-1, dim), (batch, dim)))
+
+
+def run_kernel(backend, matrices, x_initial, x_hat_initial, u_initial, r, u_offset, process_noise, sensor_noise):
+    """ Runs backend ('numpy', 'numba' or 'scalar', the uncompiled numba kernel) over the whole of r.
+        Initial values are (dim,) or (batch, dim), r and u_offset may leave out the batch axis, and the noise is
+        (batch, T, dim). Everything runs in the dtype of the matrices (see kernel_matrices). Returns the x, u, y and
+        x_hat trajectories, each (batch, T, dim)"""
+
+    batch, steps, _ = process_noise.shape
+    dtype = matrices.A.dtype
+    n = matrices.A.shape[0]
+    p = matrices.B.shape[1]
+    q = matrices.C.shape[0]
+
+    x_initial = _initial_array(x_initial, batch, n, dtype)
+    x_hat_initial = _initial_array(x_hat_initial, batch, n, dtype)
+    u_initial = _initial_array(u_initial, batch, p, dtype)
+    r = _batch_array(r, batch, steps, n, dtype)
+    u_offset = _batch_array(np.zeros(p) if u_offset is None else u_offset, batch, steps, p, dtype)
+    process_noise = np.ascontiguousarray(process_noise, dtype=dtype)
+    sensor_noise = np.ascontiguousarray(sensor_noise, dtype=dtype)
+
+    out = (np.empty((batch, steps, n), dtype), np.empty((batch, steps, p), dtype),
+           np.empty((batch, steps, q), dtype), np.empty((batch, steps, n), dtype))
+
+    if backend == 'numpy':
+        _simulate_numpy(matrices, x_initial, x_hat_initial, u_initial, r, u_offset, process_noise, sensor_noise, out)
+    elif backend in ('numba', 'scalar'):
+        if backend == 'numba':
+            assert HAVE_NUMBA, 'The numba backend needs numba installed, use the numpy backend instead'
+            kernel = _simulate_compiled
+        else:
+            kernel = _simulate_scalar
+        kernel(*(matrices + (x_initial, x_hat_initial, u_initial, r, u_offset, process_noise, sensor_noise) + out))
+    else:
+        raise ValueError('Unknown simulation kernel backend ' + repr(backend))
+
+    return out
+
+
+def check_backend_equivalence(sim_factory, duration, reference_calculator, use_ff=False, backends=None, seed=0,
+                              rtol=1.e-9, atol=1.e-9):
+    """ Simulates the same run, with the same noise, through the reference object path and every backend in backends
+        (all of the available ones by default, plus the uncompiled scalar kernel), each on a fresh sim from
+        sim_factory. Raises an AssertionError if any of them disagree with the reference, and otherwise returns the
+        largest absolute difference for each backend"""
+
+    if backends is None:
+        backends = ['numpy', 'scalar'] + (['numba'] if HAVE_NUMBA else [])
+
+    reference_sim = sim_factory()
+    gains = reference_sim.plant.current_gains
+    steps = len(np.arange(start=0., stop=duration, step=gains.dt))
+    process_noise, sensor_noise = generate_noise(gains, 1, steps, np.random.default_rng(seed))
+
+    reference_sim.backend = 'reference'
+    reference = reference_sim.simulate(duration, reference_calculator, use_ff=use_ff,
+                                       process_noise=process_noise, sensor_noise=sensor_noise)
+
+    differences = {}
+    for backend in backends:
+        sim = sim_factory()
+        sim.backend = backend
+        result = sim.simulate(duration, reference_calculator, use_ff=use_ff,
+                              process_noise=process_noise, sensor_noise=sensor_noise)
+
+        difference = 0.
+        for name in ('x', 'u', 'y', 'x_hat'):
+            expected = getattr(reference, name)
+            actual = getattr(result, name)
+            assert np.allclose(actual, expected, rtol=rtol, atol=atol), \
+                'The %s backend diverged from the reference in %s' % (backend, name)
+            difference = max(difference, np.max(np.abs(actual - expected)))
+        differences[backend] = difference
+
+    return differences
+
+
+def check_precision(sim_factory, duration, reference_calculator, dtype=np.float32, backend='numpy', batch=16,
+                    use_ff=False, seed=0):
+    """ Runs the same batch, with the same noise, in float64 and in dtype, and returns the largest error of the dtype
+        run in each of x, u, y and x_hat, relative to the range that signal covers in the float64 run.
+
+        The error comes from rounding the gains and every intermediate to dtype. Since the closed loop is stable the
+        rounding errors decay instead of compounding, so they stay around a few times the float32 epsilon (1.2e-7)
+        times the condition of the loop. For the motor_test model they're a few 1e-6 of the signal range, far below
+        the sensor noise"""
+
+    runs = {}
+    process_noise = None
+    sensor_noise = None
+    for run_dtype in (np.float64, dtype):
+        sim = sim_factory()
+        sim.backend = backend
+        if process_noise is None:
+            gains = sim.plant.current_gains
+            steps = len(np.arange(start=0., stop=duration, step=gains.dt))
+            process_noise, sensor_noise = generate_noise(gains, batch, steps, np.random.default_rng(seed))
+        runs[run_dtype] = sim.simulate(duration, reference_calculator, use_ff=use_ff, process_noise=process_noise,
+                                       sensor_noise=sensor_noise, dtype=run_dtype)
+
+    errors = {}
+    for name in ('x', 'u', 'y', 'x_hat'):
+        expected = getattr(runs[np.float64], name)
+        actual = getattr(runs[dtype], name).astype(np.float64)
+        scale = np.maximum(expected.max(axis=(0, 1)) - expected.min(axis=(0, 1)), np.finfo(float).tiny)
+        errors[name] = np.max(np.abs(actual - expected) / scale)
+
+    return errors
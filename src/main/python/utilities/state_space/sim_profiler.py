@@ -0,0 +1,125 @@
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+"""
+Opt-in instrumentation for StateSpaceControlSim. Pass a SimProfiler as the sim's profiler and every update is broken
+down into plant noise generation, plant stepping, observer, controller and recording stages. Without a profiler the
+sim runs its normal path, so the only cost of having this around is one None check per update.
+
+Stages are identified by stacks of names, e.g. ('update', 'observer'), which is what the flamegraph export needs.
+"""
+
+StageStats = namedtuple('StageStats', ['calls', 'total_s', 'min_s', 'max_s', 'allocated_bytes', 'net_blocks'])
+
+
+class SimProfiler(object):
+    """
+    Collects per-stage call counts and perf_counter timings. With track_allocations, each leaf stage also records how
+    many bytes it allocated at its peak (through tracemalloc) and how many memory blocks it left allocated. Allocation
+    tracking slows everything down a lot, so timings taken with it on are only good for relative comparisons.
+    """
+
+    def __init__(self, track_allocations=False):
+        self.track_allocations = track_allocations
+        self._started_tracing = False
+        self.reset()
+
+    def reset(self):
+        self._calls = {}
+        self._total = {}
+        self._min = {}
+        self._max = {}
+        self._allocated = {}
+        self._blocks = {}
+
+    def begin(self, leaf=True):
+        """ Starts timing a stage. The returned token gets passed back to end"""
+
+        if self.track_allocations and leaf:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            return time.perf_counter_ns(), tracemalloc.get_traced_memory()[0], sys.getallocatedblocks()
+        return time.perf_counter_ns(), None, None
+
+    def stop_tracing(self):
+        """ Turns tracemalloc back off if this profiler was the one that turned it on"""
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def end(self, stack, token):
+        """ Records a stage that was started with begin"""
+
+        elapsed = time.perf_counter_ns() - token[0]
+
+        if stack in self._calls:
+            self._calls[stack] += 1
+            self._total[stack] += elapsed
+            if elapsed < self._min[stack]:
+                self._min[stack] = elapsed
+            if elapsed > self._max[stack]:
+                self._max[stack] = elapsed
+        else:
+            self._calls[stack] = 1
+            self._total[stack] = elapsed
+            self._min[stack] = elapsed
+            self._max[stack] = elapsed
+            self._allocated[stack] = 0
+            self._blocks[stack] = 0
+
+        if token[1] is not None:
+            self._allocated[stack] += tracemalloc.get_traced_memory()[1] - token[1]
+            self._blocks[stack] += sys.getallocatedblocks() - token[2]
+
+    @property
+    def stats(self):
+        """ Dictionary from stage stack to StageStats, with times in seconds"""
+
+        return {stack: StageStats(self._calls[stack], self._total[stack] * 1.e-9, self._min[stack] * 1.e-9,
+                                  self._max[stack] * 1.e-9, self._allocated[stack], self._blocks[stack])
+                for stack in self._calls}
+
+    def _self_times(self):
+        """ Time spent in each stack that isn't spent in any of its child stacks, in nanoseconds"""
+
+        self_times = dict(self._total)
+        for stack, total in self._total.items():
+            parent = stack[:-1]
+            if parent in self_times:
+                self_times[parent] -= total
+        return self_times
+
+    def report(self):
+        """ A plain text table of every stage, sorted by total time"""
+
+        stats = self.stats
+        # Percentages are of the time spent in outermost stages, the ones with no recorded parent
+        grand_total = sum(stat.total_s for stack, stat in stats.items() if stack[:-1] not in stats)
+        lines = ['%-40s %10s %12s %12s %8s %14s %10s' % ('stage', 'calls', 'total (ms)', 'mean (us)', '% time',
+                                                        'alloc (bytes)', 'net blocks')]
+        for stack, stat in sorted(stats.items(), key=lambda item: -item[1].total_s):
+            share = 100. * stat.total_s / grand_total if grand_total > 0 else 0.
+            lines.append('%-40s %10d %12.3f %12.3f %8.1f %14d %10d'
+                         % ('.'.join(stack), stat.calls, stat.total_s * 1.e3, stat.total_s / stat.calls * 1.e6,
+                            share, stat.allocated_bytes, stat.net_blocks))
+        return '\n'.join(lines)
+
+    def to_folded(self):
+        """ Brendan Gregg's folded stack format ('update;observer 1234' per line, values in microseconds), which
+            flamegraph.pl, inferno and speedscope can all read"""
+
+        lines = []
+        for stack, self_time in sorted(self._self_times().items()):
+            microseconds = int(round(max(self_time, 0) * 1.e-3))
+            if microseconds > 0:
+                lines.append('%s %d' % (';'.join(stack), microseconds))
+        return '\n'.join(lines) + '\n'
+
+    def write_folded(self, path):
+        with open(path, 'w') as folded_file:
+            folded_file.write(self.to_folded())
@@ -2,13 +2,14 @@ from utilities.state_space.state_space_controller import StateSpaceController
 from utilities.state_space.state_space_gains import GainsList, StateSpaceGains
 from utilities.state_space.state_space_observer import StateSpaceObserver
 from utilities.state_space.state_space_plant import StateSpacePlant
+from utilities.state_space import plotting, sim_kernels
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 class StateSpaceControlSim(object):
 
-    def __init__(self, gains, x_hat_initial, u_initial, x_initial, r_initial, u_max, u_min):
+    def __init__(self, gains, x_hat_initial, u_initial, x_initial, r_initial, u_max, u_min, observer=None,
+                 controller=None, profiler=None, backend='reference', plant=None):
         assert isinstance(gains, GainsList) or isinstance(gains, StateSpaceGains), \
             "Gains must be a list of gains or a state space gains object"
         if isinstance(gains, StateSpaceGains):
@@ -19,14 +20,34 @@ class StateSpaceControlSim(object):
         self.gains_index = 0
         self.current_gains = self.gains.get_gains(self.gains_index)
 
-        self.controller = StateSpaceController(gains=self.gains, u_initial=u_initial, r_initial=r_initial, u_max=u_max, u_min=u_min)
-        self.observer = StateSpaceObserver(gains=self.gains, x_hat_initial=x_hat_initial)
-        self.plant = StateSpacePlant(gains=self.gains, x_initial=x_initial)
+        # Likewise, any controller with the StateSpaceController interface can be used, e.g. MPCController
+        if controller is None:
+            self.controller = StateSpaceController(gains=self.gains, u_initial=u_initial, r_initial=r_initial,
+                                                   u_max=u_max, u_min=u_min)
+        else:
+            self.controller = controller
+        # Any observer with the same update/set_index interface can be swapped in, e.g. SquareRootKalmanObserver
+        if observer is None:
+            self.observer = StateSpaceObserver(gains=self.gains, x_hat_initial=x_hat_initial)
+        else:
+            self.observer = observer
+        # And any plant with the same generate_noise/step/update interface, e.g. DelayedPlant
+        if plant is None:
+            self.plant = StateSpacePlant(gains=self.gains, x_initial=x_initial)
+        else:
+            self.plant = plant
 
         self.u = u_initial
         self.y = self.current_gains.C * x_initial
         self.x_hat = x_hat_initial
 
+        # Optional SimProfiler, which breaks every update down into stages
+        self.profiler = profiler
+
+        # How simulate runs: 'reference' steps the objects above, 'numpy' and 'numba' use the whole-run kernels
+        assert backend in sim_kernels.BACKENDS, 'Backend must be one of ' + ', '.join(sim_kernels.BACKENDS)
+        self.backend = backend
+
         self.num_states = self.current_gains.A.shape[0]
         self.num_inputs = self.current_gains.B.shape[1]
         self.num_sensor_inputs = self.current_gains.C.shape[0]
@@ -39,7 +60,37 @@ class StateSpaceControlSim(object):
         self.observer.set_index(index)
         self.plant.set_index(index)
 
+    def _profiled_update(self, name, u, control=None, r=None):
+        """ The same steps as update, update_ff and update_with_voltage, but with every stage timed"""
+
+        profiler = self.profiler
+        update_token = profiler.begin(leaf=False)
+
+        token = profiler.begin()
+        process_noise, sensor_noise = self.plant.generate_noise()
+        profiler.end((name, 'plant_noise'), token)
+
+        token = profiler.begin()
+        self.y = self.plant.step(u, process_noise, sensor_noise)
+        profiler.end((name, 'plant'), token)
+
+        token = profiler.begin()
+        self.x_hat = self.observer.update(u, self.y)
+        profiler.end((name, 'observer'), token)
+
+        if control is not None:
+            token = profiler.begin()
+            self.u = control(r, self.x_hat)
+            profiler.end((name, 'controller'), token)
+
+        profiler.end((name,), update_token)
+
+        return self.plant.x, self.u, self.y, self.x_hat
+
     def update(self, r):
+        if self.profiler is not None:
+            return self._profiled_update('update', self.u, self.controller.bounded_update, r)
+
         self.y = self.plant.update(self.u)
         self.x_hat = self.observer.update(self.u, self.y)
         self.u = self.controller.bounded_update(r, self.x_hat)
@@ -47,6 +98,9 @@ class StateSpaceControlSim(object):
         return self.plant.x, self.u, self.y, self.x_hat
     
     def update_ff(self, r):
+        if self.profiler is not None:
+            return self._profiled_update('update_ff', self.u, self.controller.bounded_update_ff, r)
+
         self.y = self.plant.update(self.u)
         self.x_hat = self.observer.update(self.u, self.y)
         self.u = self.controller.bounded_update_ff(r, self.x_hat)
@@ -55,32 +109,105 @@ class StateSpaceControlSim(object):
 
     def update_with_voltage(self, u):
         self.u = u
+        if self.profiler is not None:
+            return self._profiled_update('update_with_voltage', u)
+
         self.y = self.plant.update(u)
         self.x_hat = self.observer.update(u, self.y)
         return self.plant.x, self.u, self.y, self.x_hat
 
+    def simulate(self, duration, reference_calculator=(lambda time: np.zeros((1, 1))), use_ff=False, batch=1,
+                 process_noise=None, sensor_noise=None, seed=None, dtype=np.float64):
+        """ Runs update (or update_ff) for duration seconds with the selected backend and returns a SimResult of
+            (batch, T, dim) arrays. The noise is generated up front unless it's given, (batch, T, n) and (batch, T, q).
+            The 'reference' backend only runs one trajectory. With batch == 1 the sim ends up in the same state as if
+            update had been called every step, whichever backend is used.
+
+            dtype is what the kernels run and store in. np.float32 halves the memory of big batches, see
+            sim_kernels.check_precision for what it costs in accuracy. The reference backend always runs in float64
+            and only stores its results as dtype"""
+
+        gains = self.plant.current_gains
+        t = np.arange(start=0., stop=duration, step=gains.dt)
+        r = np.stack([np.asarray(reference_calculator(time), dtype=float).ravel() for time in t])
+
+        if process_noise is None or sensor_noise is None:
+            generated_process_noise, generated_sensor_noise = sim_kernels.generate_noise(
+                gains, batch, len(t), np.random.default_rng(seed), dtype)
+            process_noise = generated_process_noise if process_noise is None else process_noise
+            sensor_noise = generated_sensor_noise if sensor_noise is None else sensor_noise
+        batch = process_noise.shape[0]
+
+        if self.backend == 'reference':
+            assert batch == 1, 'The reference backend only simulates one trajectory at a time'
+            control = self.controller.bounded_update_ff if use_ff else self.controller.bounded_update
+            x = np.empty((len(t), self.num_states), dtype)
+            u = np.empty((len(t), self.num_inputs), dtype)
+            y = np.empty((len(t), self.num_sensor_inputs), dtype)
+            x_hat = np.empty((len(t), self.num_states), dtype)
+            for k in range(len(t)):
+                r_k = np.asmatrix(r[k]).T
+                self.y = self.plant.step(self.u, np.asmatrix(process_noise[0, k], dtype=float).T,
+                                         np.asmatrix(sensor_noise[0, k], dtype=float).T)
+                self.x_hat = self.observer.update(self.u, self.y)
+                self.u = control(r_k, self.x_hat)
+                x[k] = np.asarray(self.plant.x).ravel()
+                u[k] = np.asarray(self.u).ravel()
+                y[k] = np.asarray(self.y).ravel()
+                x_hat[k] = np.asarray(self.x_hat).ravel()
+            return sim_kernels.SimResult(t, x[None], u[None], y[None], x_hat[None])
+
+        # The kernels have the plain plant, observer and controller equations built in
+        assert type(self.observer) is StateSpaceObserver and type(self.controller) is StateSpaceController \
+            and type(self.plant) is StateSpacePlant, \
+            'The kernel backends only simulate the standard plant, observer and controller'
+
+        matrices = sim_kernels.kernel_matrices(gains, self.controller.u_min, self.controller.u_max, dtype)
+        u_offset = sim_kernels.feedforward_offset(gains, r, self.controller.r) if use_ff else None
+        x, u, y, x_hat = sim_kernels.run_kernel(self.backend, matrices, np.asarray(self.plant.x).ravel(),
+                                                np.asarray(self.x_hat).ravel(), np.asarray(self.u).ravel(), r,
+                                                u_offset, process_noise, sensor_noise)
+
+        if batch == 1 and len(t) > 0:
+            # The objects always carry on in float64
+            self.plant.x = np.asmatrix(x[0, -1], dtype=float).T
+            self.y = self.plant.y = np.asmatrix(y[0, -1], dtype=float).T
+            self.x_hat = self.observer.x_hat = np.asmatrix(x_hat[0, -1], dtype=float).T
+            self.u = np.asmatrix(u[0, -1], dtype=float).T
+            # What the controller itself keeps is the unclipped feedback, without the feedforward
+            self.controller.u = gains.K * (np.asmatrix(r[-1]).T - self.x_hat)
+            if not use_ff:
+                self.controller.r = np.asmatrix(r[-1]).T
+
+        return sim_kernels.SimResult(t, x, u, y, x_hat)
+
     def plot_reference_tracking(self, duration, plot_settings,
                                 reference_calculator=(lambda time: np.zeros((1, 1))), use_ff=False):
 
         # x, then u, then y, then x_hat
-        x_list = [[]] * self.num_states
-        u_list = [[]] * self.num_inputs
-        y_list = [[]] * self.num_sensor_inputs
-        x_hat_list = [[]] * self.num_states
+        x_list = [[] for _ in range(self.num_states)]
+        u_list = [[] for _ in range(self.num_inputs)]
+        y_list = [[] for _ in range(self.num_sensor_inputs)]
+        x_hat_list = [[] for _ in range(self.num_states)]
 
         for t in np.arange(start=0., stop=duration, step=self.current_gains.dt):
             if use_ff:
                 x, u, y, x_hat = self.update_ff(reference_calculator(t))
             else:
                 x, u, y, x_hat = self.update(reference_calculator(t))
+            if self.profiler is not None:
+                token = self.profiler.begin()
+            # Appending in place, since copying the whole list every step made long runs quadratic
             for state_num in range(self.num_states):
-                x_list[state_num] = x_list[state_num] + [x[state_num, 0]]
+                x_list[state_num].append(x[state_num, 0])
             for input_num in range(self.num_inputs):
-                u_list[input_num] = u_list[input_num] + [u[input_num, 0]]
+                u_list[input_num].append(u[input_num, 0])
             for output_num in range(self.num_sensor_inputs):
-                y_list[output_num] = y_list[output_num] + [y[output_num, 0]]
+                y_list[output_num].append(y[output_num, 0])
             for est_state_num in range(self.num_states):
-                x_hat_list[est_state_num] = x_hat_list[est_state_num] + [x_hat[est_state_num, 0]]
+                x_hat_list[est_state_num].append(x_hat[est_state_num, 0])
+            if self.profiler is not None:
+                self.profiler.end(('plot_reference_tracking', 'recording'), token)
 
         generated_vals = [[]] * (2*self.num_states + self.num_sensor_inputs + self.num_inputs)
         current_idx = 0
@@ -99,31 +226,42 @@ class StateSpaceControlSim(object):
         for i in range(self.num_states):
             generated_vals[current_idx + i] = x_hat_list[i]
         
+        # pyplot is slow to import, so it's only imported once something actually gets plotted
+        import matplotlib.pyplot as plt
+
         # x, u, y, x_hat, all expanded hopefully = generated_vals
+        # Each signal is decimated to the width of the axes, so long runs don't bog matplotlib down
+        _, axes = plt.subplots()
+        t = np.arange(len(generated_vals[0])) * self.current_gains.dt
         for i, flag in enumerate(plot_settings):
             if flag:
-                plt.plot(generated_vals[i])
+                plotting.plot_signal(axes, t, np.asarray(generated_vals[i]))
         plt.show()
 
     def plot_input_response(self, duration, plot_settings,
                             input_calculator=lambda time: np.zeros((0, 0))):
 
         # x, then u, then y, then x_hat
-        x_list = [[]] * self.num_states
-        u_list = [[]] * self.num_inputs
-        y_list = [[]] * self.num_sensor_inputs
-        x_hat_list = [[]] * self.num_states
+        x_list = [[] for _ in range(self.num_states)]
+        u_list = [[] for _ in range(self.num_inputs)]
+        y_list = [[] for _ in range(self.num_sensor_inputs)]
+        x_hat_list = [[] for _ in range(self.num_states)]
 
         for t in np.arange(start=0., stop=duration, step=self.current_gains.dt):
             x, u, y, x_hat = self.update_with_voltage(input_calculator(t))
+            if self.profiler is not None:
+                token = self.profiler.begin()
+            # Appending in place, since copying the whole list every step made long runs quadratic
             for state_num in range(self.num_states):
-                x_list[state_num] = x_list[state_num] + [x[state_num, 0]]
+                x_list[state_num].append(x[state_num, 0])
             for input_num in range(self.num_inputs):
-                u_list[input_num] = u_list[input_num] + [u[input_num, 0]]
+                u_list[input_num].append(u[input_num, 0])
             for output_num in range(self.num_sensor_inputs):
-                y_list[output_num] = y_list[output_num] + [y[output_num, 0]]
+                y_list[output_num].append(y[output_num, 0])
             for est_state_num in range(self.num_states):
-                x_hat_list[est_state_num] = x_hat_list[est_state_num] + [x_hat[est_state_num, 0]]
+                x_hat_list[est_state_num].append(x_hat[est_state_num, 0])
+            if self.profiler is not None:
+                self.profiler.end(('plot_input_response', 'recording'), token)
 
         generated_vals = [[]] * (2*self.num_states + self.num_sensor_inputs + self.num_inputs)
         current_idx = 0
@@ -142,8 +280,27 @@ class StateSpaceControlSim(object):
         for i in range(self.num_states):
             generated_vals[current_idx + i] = x_hat_list[i]
 
+        # pyplot is slow to import, so it's only imported once something actually gets plotted
+        import matplotlib.pyplot as plt
+
         # x, u, y, x_hat, all expanded hopefully = generated_vals
+        # Each signal is decimated to the width of the axes, so long runs don't bog matplotlib down
+        _, axes = plt.subplots()
+        t = np.arange(len(generated_vals[0])) * self.current_gains.dt
         for i, flag in enumerate(plot_settings):
             if flag:
-                plt.plot(generated_vals[i])
+                plotting.plot_signal(axes, t, np.asarray(generated_vals[i]))
+        plt.show()
+
+    def plot_simulation(self, duration, plot_settings, reference_calculator=(lambda time: np.zeros((1, 1))),
+                        use_ff=False, batch=1, seed=None, percentiles=plotting.DEFAULT_PERCENTILES):
+        """ Like plot_reference_tracking, but through simulate, so it works with any backend and with batches.
+            Batches are drawn as percentile bands"""
+
+        import matplotlib.pyplot as plt
+
+        result = self.simulate(duration, reference_calculator, use_ff=use_ff, batch=batch, seed=seed)
+        plotting.plot_sim_result(result, plot_settings, percentiles=percentiles)
         plt.show()
+
+        return result
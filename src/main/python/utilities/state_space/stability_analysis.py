@@ -0,0 +1,207 @@
+import numpy as np
+from collections import namedtuple
+from utilities.state_space.state_space_gains import GainsList, StateSpaceGains
+
+"""
+Batched closed-loop analysis for discrete-time state space designs.
+Everything in here works on stacks of candidate matrices with a leading candidate axis, so a sweep over thousands of
+K and L matrices is a handful of batched LAPACK calls rather than a Python loop.
+
+Sign conventions match the controller and observer:
+    u = K * (r - x_hat)                                   -> closed-loop controller dynamics are A - BK
+    x_hat[k+1] = (A - LC) * x_hat[k] + B * u[k] + L * y[k] -> observer error dynamics are A - LC
+"""
+
+StabilityMargins = namedtuple('StabilityMargins',
+                              ['gain_margin', 'phase_margin', 'phase_crossover', 'gain_crossover'])
+
+StabilityReport = namedtuple('StabilityReport',
+                             ['controller_poles', 'observer_poles', 'is_stable', 'omegas',
+                              'controller_loop', 'observer_loop', 'controller_margins', 'observer_margins'])
+
+
+def stack_gains(gains):
+    """ Stacks the discrete A, B, C, K and L matrices of a GainsList (or a list of gains) into arrays with a leading
+        candidate axis. All of the gains must have the same dimensions and dt."""
+
+    if isinstance(gains, StateSpaceGains):
+        gains = GainsList(gains)
+    if isinstance(gains, GainsList):
+        gains = [gains.get_gains(i) for i in range(len(gains))]
+
+    assert len(gains) > 0, 'There must be at least one set of gains to stack'
+    dt = gains[0].dt
+    for current_gains in gains:
+        assert current_gains.dt == dt, 'All stacked gains must share the same dt'
+
+    A = np.stack([np.asarray(current_gains.A, dtype=float) for current_gains in gains])
+    B = np.stack([np.asarray(current_gains.B, dtype=float) for current_gains in gains])
+    C = np.stack([np.asarray(current_gains.C, dtype=float) for current_gains in gains])
+    K = np.stack([np.asarray(current_gains.K, dtype=float) for current_gains in gains])
+    L = np.stack([np.asarray(current_gains.L, dtype=float) for current_gains in gains])
+
+    return A, B, C, K, L, dt
+
+
+def closed_loop_poles(A, B, K):
+    """ Returns the eigenvalues of A - BK for every candidate, shape (..., n)
+        A, B and K broadcast against each other, so one plant can be paired with a whole stack of K matrices"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    K = np.asarray(K, dtype=float)
+
+    return np.linalg.eigvals(A - B @ K)
+
+
+def observer_poles(A, C, L):
+    """ Returns the eigenvalues of A - LC for every candidate, shape (..., n)"""
+
+    A = np.asarray(A, dtype=float)
+    C = np.asarray(C, dtype=float)
+    L = np.asarray(L, dtype=float)
+
+    return np.linalg.eigvals(A - L @ C)
+
+
+def is_stable(poles):
+    """ A discrete-time system is stable when all of its poles are strictly inside the unit circle"""
+    return np.all(np.abs(poles) < 1., axis=-1)
+
+
+def frequency_grid(dt, num=512, w_min=None):
+    """ Log-spaced frequencies in rad/s from w_min up to the Nyquist frequency pi / dt"""
+
+    w_nyquist = np.pi / dt
+    if w_min is None:
+        w_min = w_nyquist * 1.e-4
+    return np.logspace(np.log10(w_min), np.log10(w_nyquist), num)
+
+
+def loop_frequency_response(A, B, K, omegas, dt):
+    """ Evaluates the loop transfer matrix K * (zI - A)^-1 * B at z = e^(j * w * dt) for every frequency in omegas.
+        This is the loop broken at the plant input, so the return difference is I + K(zI - A)^-1 B.
+        A is (..., n, n), B is (..., n, p), K is (..., p, n), and the result is (..., num_frequencies, p, p)"""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    K = np.asarray(K, dtype=float)
+    omegas = np.asarray(omegas, dtype=float)
+
+    n = A.shape[-1]
+    z = np.exp(1.j * omegas * dt)
+
+    # A and B can each be shared or stacked, so the candidates are whatever their leading dimensions broadcast to
+    batch = np.broadcast_shapes(A.shape[:-2], B.shape[:-2])
+    A = np.broadcast_to(A, batch + A.shape[-2:])
+    B = np.broadcast_to(B, batch + B.shape[-2:])
+
+    # (..., F, n, n) stack of zI - A, one per candidate and frequency
+    resolvent = z[:, None, None] * np.eye(n) - A[..., None, :, :]
+    # Solving is cheaper and better conditioned than inverting and multiplying
+    X = np.linalg.solve(resolvent, np.broadcast_to(B[..., None, :, :], resolvent.shape[:-1] + B.shape[-1:]))
+
+    return K[..., None, :, :] @ X
+
+
+def stability_margins(loop_response, omegas):
+    """ Gain and phase margins of a stack of single-input single-output loop responses, shape (..., F) or
+        (..., F, 1, 1). The loop is assumed to be closed with negative feedback, as it is with u = -Kx.
+
+        Gain margin is in dB and phase margin is in degrees. Crossover frequencies are linearly interpolated between
+        grid points. Loops that never cross a given condition on the grid get an infinite margin and a NaN frequency.
+        If a loop crosses more than once, the smallest (most restrictive) margin is reported."""
+
+    loop_response = np.asarray(loop_response)
+    omegas = np.asarray(omegas, dtype=float)
+    if loop_response.shape[-1] != len(omegas):
+        assert loop_response.shape[-2:] == (1, 1),                                  \
+            'Margins are only defined here for single-input single-output loops'
+        loop_response = loop_response[..., 0, 0]
+
+    L0 = loop_response[..., :-1]
+    L1 = loop_response[..., 1:]
+    w0 = omegas[:-1]
+    w1 = omegas[1:]
+
+    # Gain crossover: |L| passes through 1, interpolated in log-magnitude
+    log_mag = np.log(np.maximum(np.abs(loop_response), 1.e-300))
+    m0 = log_mag[..., :-1]
+    m1 = log_mag[..., 1:]
+    gain_crossing = (m0 >= 0.) != (m1 >= 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_gain = np.where(gain_crossing, m0 / (m0 - m1), 0.)
+    L_gain = L0 + t_gain * (L1 - L0)
+    # angle(-L) is 180 + angle(L) wrapped to (-180, 180]
+    phase_margins = np.where(gain_crossing, np.angle(-L_gain, deg=True), np.inf)
+
+    # Phase crossover: L passes through the negative real axis
+    im0 = L0.imag
+    im1 = L1.imag
+    phase_crossing = ((im0 >= 0.) != (im1 >= 0.))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_phase = np.where(phase_crossing, im0 / (im0 - im1), 0.)
+    L_phase = L0 + t_phase * (L1 - L0)
+    phase_crossing &= L_phase.real < 0.
+    # A grid that ends at the Nyquist frequency ends where the loop of a real system is exactly real, so a negative
+    # endpoint is a phase crossover that never shows up as a sign change
+    L_end = loop_response[..., -1:]
+    end_crossing = (np.abs(L_end.imag) <= 1.e-9 * np.abs(L_end)) & (L_end.real < 0.)
+    phase_crossing = np.concatenate([phase_crossing, end_crossing], axis=-1)
+    L_phase = np.concatenate([L_phase, L_end], axis=-1)
+    t_phase = np.concatenate([t_phase, np.zeros(L_end.shape)], axis=-1)
+    phase_w0 = np.append(w0, omegas[-1])
+    phase_w1 = np.append(w1, omegas[-1])
+    with np.errstate(divide='ignore'):
+        gain_margins = np.where(phase_crossing, -20. * np.log10(np.abs(L_phase.real)), np.inf)
+
+    gain_idx = np.argmin(phase_margins, axis=-1)[..., None]
+    phase_idx = np.argmin(gain_margins, axis=-1)[..., None]
+
+    phase_margin = np.take_along_axis(phase_margins, gain_idx, axis=-1)[..., 0]
+    gain_margin = np.take_along_axis(gain_margins, phase_idx, axis=-1)[..., 0]
+
+    gain_crossover = np.take_along_axis(np.broadcast_to(w0 + t_gain * (w1 - w0), t_gain.shape), gain_idx, axis=-1)
+    phase_crossover = np.take_along_axis(np.broadcast_to(phase_w0 + t_phase * (phase_w1 - phase_w0), t_phase.shape),
+                                         phase_idx, axis=-1)
+    gain_crossover = np.where(np.isfinite(phase_margin), gain_crossover[..., 0], np.nan)
+    phase_crossover = np.where(np.isfinite(gain_margin), phase_crossover[..., 0], np.nan)
+
+    return StabilityMargins(gain_margin, phase_margin, phase_crossover, gain_crossover)
+
+
+def analyze_candidates(A, B, C, K, L, dt, omegas=None):
+    """ Computes closed-loop poles, loop frequency responses and margins for stacks of candidate designs.
+        Any of A, B, C, K and L may be shared between candidates (no leading axis) or stacked (leading axis).
+        Margins are only computed for loops with a single input (controller) or a single sensor (observer)."""
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    C = np.asarray(C, dtype=float)
+    K = np.asarray(K, dtype=float)
+    L = np.asarray(L, dtype=float)
+
+    if omegas is None:
+        omegas = frequency_grid(dt)
+
+    controller_poles = closed_loop_poles(A, B, K)
+    estimator_poles = observer_poles(A, C, L)
+
+    controller_loop = loop_frequency_response(A, B, K, omegas, dt)
+    # The observer loop C(zI - A)^-1 L is the dual of the controller loop, so the same routine works on the transposes
+    observer_loop = loop_frequency_response(np.swapaxes(A, -1, -2), np.swapaxes(C, -1, -2),
+                                            np.swapaxes(L, -1, -2), omegas, dt)
+
+    controller_margins = stability_margins(controller_loop, omegas) if B.shape[-1] == 1 else None
+    observer_margins = stability_margins(observer_loop, omegas) if C.shape[-2] == 1 else None
+
+    return StabilityReport(controller_poles, estimator_poles,
+                           is_stable(controller_poles) & is_stable(estimator_poles), omegas,
+                           controller_loop, observer_loop, controller_margins, observer_margins)
+
+
+def analyze_gains(gains, omegas=None):
+    """ Runs analyze_candidates on every set of gains in a GainsList"""
+
+    A, B, C, K, L, dt = stack_gains(gains)
+    return analyze_candidates(A, B, C, K, L, dt, omegas)
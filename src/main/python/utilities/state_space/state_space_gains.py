@@ -1,42 +1,172 @@
+import functools
+import hashlib
 import numpy as np
 from utilities.state_space.state_space_utils import check_validity, observability, controllability
 
 
-class Gains(object):
-    """ Base class for the two gains variants"""
-    pass
+# The matrices of a set of gains in the order they're packed into its buffer, with their shapes in terms of n, p and q
+GAINS_LAYOUT = (('A', 'n', 'n'), ('B', 'n', 'p'), ('C', 'q', 'n'), ('D', 'q', 'p'), ('Q_noise', 'n', 'n'),
+                ('R_noise', 'q', 'q'), ('K', 'p', 'n'), ('L', 'n', 'q'), ('Kff', 'p', 'n'), ('u_min', 'p', 1),
+                ('u_max', 'p', 1))
 
 
-class StateSpaceGains(Gains):
+@functools.lru_cache(maxsize=None)
+def gains_layout(n, p, q):
+    """ Returns (field, offset, shape) for every matrix in a packed gains buffer, and the buffer's total length"""
 
-    def __init__(self, name, A, B, C, D, Q_noise, R_noise, K, L, Kff, u_min, u_max, dt):
-        self.A = np.asmatrix(A)
-        self.B = np.asmatrix(B)
-        self.C = np.asmatrix(C)
-        self.D = np.asmatrix(D)
+    sizes = {'n': n, 'p': p, 'q': q, 1: 1}
+    fields = []
+    offset = 0
+    for field, rows, columns in GAINS_LAYOUT:
+        shape = (sizes[rows], sizes[columns])
+        fields.append((field, offset, shape))
+        offset += shape[0] * shape[1]
+    return tuple(fields), offset
 
-        self.Q_noise = np.asmatrix(Q_noise)
-        self.R_noise = np.asmatrix(R_noise)
 
-        self.K = np.asmatrix(K)
-        self.L = np.asmatrix(L)
-        self.Kff = np.asmatrix(Kff)
+def _rebuild_gains(name, dt, n, p, q, data, is_controllable, is_observable):
+    # frombuffer on bytes is already read-only, so the unpickled gains don't copy the data again
+    return StateSpaceGains.from_buffer(name, dt, n, p, q, np.frombuffer(data), is_controllable, is_observable)
 
-        self.u_min = u_min
-        self.u_max = u_max
 
-        self.dt = dt
+def _matrix_property(index, field):
+    def getter(self):
+        views = self._views
+        if views is None:
+            views = self._make_views()
+        return views[index]
+    return property(getter, doc='%s, a read-only np.matrix view of the buffer' % field)
 
-        self.n = self.A.shape[0]
-        self.p = self.B.shape[1]
-        self.q = self.C.shape[0]
 
-        self.name = name
+class Gains(object):
+    """ Base class for the two gains variants"""
+    __slots__ = ()
+
+
+class StateSpaceGains(Gains):
+    """
+    Read-only gains, with every matrix packed into one contiguous float64 buffer in GAINS_LAYOUT order. The matrices
+    are np.matrix views of the buffer, made the first time one of them is used, so a set of gains that's only being
+    held or shipped somewhere is just the buffer and a handful of scalars. Pickling only sends the buffer, and the
+    controllability and observability already worked out, so nothing is re-checked on the other end.
 
-        self.is_controllable = self.check_controllability()
-        self.is_observable = self.check_observability()
+    Gains compare and hash by content, so they can be used as cache keys. To change some of the matrices, make new
+    gains with replace.
+    """
+
+    __slots__ = ('name', 'dt', 'n', 'p', 'q', 'buffer', 'is_controllable', 'is_observable', '_views', '_hash')
 
-        self.check_system_validity()
+    A = _matrix_property(0, 'A')
+    B = _matrix_property(1, 'B')
+    C = _matrix_property(2, 'C')
+    D = _matrix_property(3, 'D')
+    Q_noise = _matrix_property(4, 'Q_noise')
+    R_noise = _matrix_property(5, 'R_noise')
+    K = _matrix_property(6, 'K')
+    L = _matrix_property(7, 'L')
+    Kff = _matrix_property(8, 'Kff')
+    u_min = _matrix_property(9, 'u_min')
+    u_max = _matrix_property(10, 'u_max')
+
+    def __init__(self, name, A, B, C, D, Q_noise, R_noise, K, L, Kff, u_min, u_max, dt):
+        check_validity(A, B, C, D, Q_noise, R_noise, K, L, Kff)
+        n = np.shape(A)[0]
+        p = np.shape(B)[1]
+        q = np.shape(C)[0]
+        assert np.size(u_min) == p and np.size(u_max) == p, 'u_min and u_max must have one entry per input'
+
+        fields, size = gains_layout(n, p, q)
+        values = {'A': A, 'B': B, 'C': C, 'D': D, 'Q_noise': Q_noise, 'R_noise': R_noise, 'K': K, 'L': L, 'Kff': Kff,
+                  'u_min': u_min, 'u_max': u_max}
+        buffer = np.empty(size)
+        for field, offset, shape in fields:
+            buffer[offset:offset + shape[0] * shape[1]] = np.asarray(values[field], dtype=float).ravel()
+        buffer.flags.writeable = False
+
+        self._initialize(name, dt, n, p, q, buffer)
+        # Checked on the arguments, so the views aren't made until something actually uses them
+        A = np.asmatrix(A)
+        object.__setattr__(self, 'is_controllable', np.linalg.matrix_rank(controllability(A, np.asmatrix(B))) == n)
+        object.__setattr__(self, 'is_observable', np.linalg.matrix_rank(observability(A, np.asmatrix(C))) == n)
+
+    @classmethod
+    def from_buffer(cls, name, dt, n, p, q, buffer, is_controllable=None, is_observable=None):
+        """ Gains on top of an already packed buffer, which isn't copied if it's already a contiguous float64 array
+            (e.g. a slice of shared memory). The rank checks are only redone if the results aren't passed in"""
+
+        gains = cls.__new__(cls)
+        gains._initialize(name, dt, n, p, q, buffer)
+        object.__setattr__(gains, 'is_controllable',
+                           gains.check_controllability() if is_controllable is None else is_controllable)
+        object.__setattr__(gains, 'is_observable',
+                           gains.check_observability() if is_observable is None else is_observable)
+        return gains
+
+    def _initialize(self, name, dt, n, p, q, buffer):
+        buffer = np.ascontiguousarray(buffer, dtype=np.float64).ravel()
+        assert len(buffer) == gains_layout(n, p, q)[1], 'Buffer is the wrong length for these dimensions'
+        if buffer.flags.writeable:
+            # A read-only view, so whoever owns the memory can still write to it, but not through the gains
+            buffer = buffer.view()
+            buffer.flags.writeable = False
+
+        for field, value in (('name', name), ('dt', dt), ('n', n), ('p', p), ('q', q), ('buffer', buffer),
+                             ('_views', None), ('_hash', None)):
+            object.__setattr__(self, field, value)
+
+    def _make_views(self):
+        fields, _ = gains_layout(self.n, self.p, self.q)
+        views = tuple(self.buffer[offset:offset + shape[0] * shape[1]].reshape(shape).view(np.matrix)
+                      for _, offset, shape in fields)
+        object.__setattr__(self, '_views', views)
+        return views
+
+    def __setattr__(self, name, value):
+        raise AttributeError('StateSpaceGains are read-only, use replace to make changed gains')
+
+    def __delattr__(self, name):
+        raise AttributeError('StateSpaceGains are read-only')
+
+    def replace(self, **changes):
+        """ New gains with some of the matrices, the name or dt swapped out"""
+
+        values = {field: getattr(self, field) for field, _, _ in GAINS_LAYOUT}
+        values['name'] = self.name
+        values['dt'] = self.dt
+        values.update(changes)
+        return StateSpaceGains(**values)
+
+    @property
+    def content_hash(self):
+        """ A sha256 hex digest of the name, dt, dimensions and every matrix, stable between runs and processes"""
+
+        if self._hash is None:
+            digest = hashlib.sha256(repr((self.name, float(self.dt), self.n, self.p, self.q)).encode())
+            # + 0. turns -0. into 0., which __eq__ already treats as equal (NaNs are never equal anyway)
+            digest.update((self.buffer + 0.).tobytes())
+            object.__setattr__(self, '_hash', digest.hexdigest())
+        return self._hash
+
+    def __hash__(self):
+        return int(self.content_hash[:16], 16)
+
+    def __eq__(self, other):
+        if not isinstance(other, StateSpaceGains):
+            return NotImplemented
+        if self is other:
+            return True
+        return ((self.name, self.dt, self.n, self.p, self.q) == (other.name, other.dt, other.n, other.p, other.q)
+                and np.array_equal(self.buffer, other.buffer))
+
+    def __reduce__(self):
+        return _rebuild_gains, (self.name, self.dt, self.n, self.p, self.q, self.buffer.tobytes(),
+                                self.is_controllable, self.is_observable)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def check_controllability(self):
         return np.linalg.matrix_rank(controllability(self.A, self.B)) == self.A.shape[0]
@@ -90,6 +220,8 @@ class GainsList(object):
     A wrapper around a list of gains. This should really extend list or something, but I'm a bit too lazy to be smart.
     """
 
+    __slots__ = ('gains_list',)
+
     def __init__(self, gains):
 
         assert isinstance(gains, list) and isinstance(gains[0], Gains)              \
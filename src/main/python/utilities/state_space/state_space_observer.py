@@ -1,3 +1,4 @@
+import numpy as np
 from utilities.state_space.state_space_gains import GainsList
 
 
@@ -20,3 +21,184 @@ class StateSpaceObserver(object):
         self.x_hat = (gains.A - (gains.L * gains.C)) * self.x_hat + gains.B * u + gains.L * y
 
         return self.x_hat
+
+
+def psd_sqrt(M):
+    """ Returns a square root S of a symmetric positive semi-definite matrix (or stack of them) such that S * S.T = M.
+        Unlike a Cholesky factor this still works when M is singular, e.g. a zero process noise covariance"""
+
+    M = np.asarray(M, dtype=float)
+    w, V = np.linalg.eigh(0.5 * (M + np.swapaxes(M, -1, -2)))
+    return V * np.sqrt(np.maximum(w, 0.))[..., None, :]
+
+
+def sensor_noise_sqrt(R):
+    """ A square root of the sensor noise covariance with one row per sensor, so a sensor's row can be swapped out
+        without touching the others' noise. That's the diagonal square root when R is diagonal (even a singular one),
+        otherwise the lower-triangular Cholesky factor, and only psd_sqrt if R isn't positive definite either"""
+
+    R = np.asarray(R, dtype=float)
+    diagonal = np.diag(R)
+    if np.array_equal(R, np.diag(diagonal)):
+        return np.diag(np.sqrt(np.maximum(diagonal, 0.)))
+    try:
+        return np.linalg.cholesky(0.5 * (R + R.T))
+    except np.linalg.LinAlgError:
+        return psd_sqrt(R)
+
+
+class SquareRootKalmanObserver(StateSpaceObserver):
+    """
+    A time-varying Kalman filter that propagates the square root S of the error covariance (P = S * S.T) every step,
+    instead of using the fixed steady-state gain L. The covariance never has to be formed or kept symmetric by hand,
+    because both the time update and the measurement update are done with QR decompositions of pre-arrays.
+
+    Q_noise and R_noise of the current gains are used as the discrete process and sensor noise covariances, the same as
+    discrete_kalman treats them. Missing measurements can be passed as None (skip the correction entirely) or as NaN
+    entries in y (skip just those sensors). Skipping individual sensors is exact when sensors are independent, i.e.
+    R_noise is diagonal, which check_missing_sensors checks against the textbook update.
+
+    If x_hat_initial is an (n, 1) matrix the observer acts as a drop-in replacement for StateSpaceObserver. If it's a
+    (batch, n) array, that many independent filters are run at once, with u as (batch, p) and y as (batch, q).
+    """
+
+    def __init__(self, gains, x_hat_initial, P_initial=None):
+        super().__init__(gains, x_hat_initial)
+
+        x_hat_initial = np.asarray(x_hat_initial, dtype=float)
+        n = self.current_gains.n
+        if x_hat_initial.shape == (n, 1):
+            self.batch_size = None
+            self._x = x_hat_initial.reshape(1, n)
+        else:
+            assert x_hat_initial.ndim == 2 and x_hat_initial.shape[1] == n, \
+                'Batched initial estimates must have shape (batch, n)'
+            self.batch_size = x_hat_initial.shape[0]
+            self._x = x_hat_initial.copy()
+
+        if P_initial is None:
+            P_initial = np.eye(n)
+        self.S = np.broadcast_to(psd_sqrt(P_initial), (self._x.shape[0], n, n)).copy()
+
+        self._noise_sqrts = {}
+        self.set_index(self.gains_index)
+
+    def set_index(self, index):
+        super().set_index(index)
+
+        # Square roots of the noise covariances only need to be computed once per set of gains
+        if index not in self._noise_sqrts:
+            self._noise_sqrts[index] = (psd_sqrt(self.current_gains.Q_noise),
+                                        sensor_noise_sqrt(self.current_gains.R_noise))
+        self.S_Q, self.S_R = self._noise_sqrts[index]
+
+    @property
+    def P(self):
+        """ The current error covariance, formed from its square root"""
+        P = self.S @ np.swapaxes(self.S, -1, -2)
+        return P[0] if self.batch_size is None else P
+
+    def _as_batch(self, value, size):
+        value = np.asarray(value, dtype=float)
+        return np.broadcast_to(value.reshape(-1, size) if self.batch_size is None else value,
+                               (self._x.shape[0], size))
+
+    def _output(self):
+        if self.batch_size is None:
+            self.x_hat = np.asmatrix(self._x.T.copy())
+        else:
+            self.x_hat = self._x
+        return self.x_hat
+
+    def predict(self, u):
+        """ Time update: x_hat = A * x_hat + B * u, P = A * P * A.T + Q"""
+
+        gains = self.current_gains
+        A = np.asarray(gains.A)
+        B = np.asarray(gains.B)
+        n = gains.n
+
+        self._x = self._x @ A.T + self._as_batch(u, gains.p) @ B.T
+
+        # [S.T * A.T; S_Q.T] = Q_r * R, so A * P * A.T + Q = R.T * R
+        pre_array = np.concatenate([np.swapaxes(A @ self.S, -1, -2),
+                                    np.broadcast_to(self.S_Q.T, (self.S.shape[0], n, n))], axis=-2)
+        self.S = np.swapaxes(np.linalg.qr(pre_array, mode='r'), -1, -2)
+
+        return self._output()
+
+    def correct(self, y):
+        """ Measurement update using y, the sensor reading of the state after the latest prediction"""
+
+        if y is None:
+            return self._output()
+
+        gains = self.current_gains
+        C = np.asarray(gains.C)
+        n = gains.n
+        q = gains.q
+        batch = self._x.shape[0]
+
+        y = self._as_batch(y, q)
+        missing = np.isnan(y)
+        if missing.all():
+            return self._output()
+
+        # Missing sensors get a zeroed row of C and an identity row in the noise square root. Their column of the gain
+        # comes out as zero, so they don't change the estimate or the covariance
+        C_k = np.where(missing[:, :, None], 0., C)
+        S_R = np.where(missing[:, :, None], np.eye(q), self.S_R)
+
+        # Pre-array [[S_R, C * S], [0, S]] triangularizes to [[X, 0], [Y, Z]], where
+        # X * X.T = C * P * C.T + R, Y = P * C.T * X^-T and Z * Z.T is the updated covariance
+        pre_array = np.zeros((batch, q + n, q + n))
+        pre_array[:, :q, :q] = S_R
+        pre_array[:, :q, q:] = C_k @ self.S
+        pre_array[:, q:, q:] = self.S
+        post_array = np.swapaxes(np.linalg.qr(np.swapaxes(pre_array, -1, -2), mode='r'), -1, -2)
+
+        X = post_array[:, :q, :q]
+        Y = post_array[:, q:, :q]
+        self.S = post_array[:, q:, q:].copy()
+
+        # Kalman gain K = Y * X^-1, found as the solution of X.T * K.T = Y.T
+        K = np.swapaxes(np.linalg.solve(np.swapaxes(X, -1, -2), np.swapaxes(Y, -1, -2)), -1, -2)
+
+        innovation = np.where(missing, 0., y - self._x @ C.T)
+        self._x = self._x + (K @ innovation[:, :, None])[:, :, 0]
+
+        return self._output()
+
+    def update(self, u, y):
+        """ Predicts using the input that was just applied, then corrects with the measurement taken after it.
+            This is the order StateSpaceControlSim calls its observer in"""
+
+        self.predict(u)
+        return self.correct(y)
+
+
+def check_missing_sensors(gains, x_hat, P, u, y):
+    """ Largest difference in x_hat and P between one SquareRootKalmanObserver update with the NaN entries of y skipped
+        and the conventional Kalman update with just the sensors that are there. x_hat, u and y are columns"""
+
+    A = np.asarray(gains.A, dtype=float)
+    B = np.asarray(gains.B, dtype=float)
+    C = np.asarray(gains.C, dtype=float)
+    Q = np.asarray(gains.Q_noise, dtype=float)
+    R = np.asarray(gains.R_noise, dtype=float)
+    x_hat = np.asarray(x_hat, dtype=float)
+    P = np.asarray(P, dtype=float)
+    y = np.asarray(y, dtype=float).ravel()
+
+    x_predicted = A @ x_hat + B @ np.asarray(u, dtype=float)
+    P_predicted = A @ P @ A.T + Q
+    present = ~np.isnan(y)
+    C_k = C[present]
+    innovation_covariance = C_k @ P_predicted @ C_k.T + R[np.ix_(present, present)]
+    K = np.linalg.solve(innovation_covariance, C_k @ P_predicted).T
+    x_expected = x_predicted + K @ (y[present, None] - C_k @ x_predicted)
+    P_expected = (np.eye(gains.n) - K @ C_k) @ P_predicted
+
+    observer = SquareRootKalmanObserver(GainsList(gains), np.asmatrix(x_hat), P)
+    x_actual = np.asarray(observer.update(np.asmatrix(u), np.asmatrix(y).T))
+    return max(np.max(np.abs(x_actual - x_expected)), np.max(np.abs(observer.P - P_expected)))
@@ -16,13 +16,23 @@ class StateSpacePlant(object):
         self.gains_index = index
         self.current_gains = self.gains.get_gains(index)
     
-    def update(self, u):
+    def generate_noise(self):
         gains = self.current_gains
 
         process_noise = gains.Q_noise * np.random.randn(gains.A.shape[0], 1)
         sensor_noise = gains.R_noise * np.random.randn(gains.C.shape[0], 1)
-        
+
+        return process_noise, sensor_noise
+
+    def step(self, u, process_noise, sensor_noise):
+        gains = self.current_gains
+
         self.x = gains.A * self.x + gains.B * u + process_noise
         self.y = gains.C * self.x + gains.D * u + sensor_noise
 
         return self.y
+
+    def update(self, u):
+        # Noise generation and stepping are split up so they can be timed (and fed) separately
+        process_noise, sensor_noise = self.generate_noise()
+        return self.step(u, process_noise, sensor_noise)
@@ -1,6 +1,5 @@
 import numpy as np
-import scipy
-import scipy.signal
+import scipy.linalg
 
 """ 
 A bunch of helper functions for dealing with state space stuffs 
@@ -103,6 +102,8 @@ def place_poles(A, B, poles):
                     'Poles must be complex conjugate pairs or floats'
 
     assert len(poles) == A.shape[0], 'The number of poles must equal the number of states'
+    # scipy.signal takes a long time to import and this is the only thing that needs it
+    import scipy.signal
     result = scipy.signal.place_poles(A, B, poles)
 
     for requested, computed in zip(result.requested_poles, result.computed_poles):
@@ -277,50 +278,65 @@ def feedforward_gains(B, Q=None, R=None):
     else:
         return np.linalg.inv((B.T * Q * B) + R) * B.T * Q
 
-def augment_simo_sys(A, B, C, K, Q_noise, R_noise, Q_weight, R_weight):
+def augment_input_error(A_d, B_d, C, Q_d, R_d, K, Kff, dt, input_error_noise=0.1):
     """
-    Takes in a set of continuous time gains and returns the augmented form of the gains in discrete time.
-    Augmented gains have integral control (u_error method) added on to them
+    Adds integral control (the u_error method) to already discretized gains, for any number of inputs.
+    The state is augmented with an estimate of the error on every input, modeled as a random walk that adds to u:
+        x[k+1] = A_d * x[k] + B_d * (u[k] + u_error[k])
+        u_error[k+1] = u_error[k]
+    Since u_error is held over the step just like u, the augmented discrete system is exactly [[A_d, B_d], [0, I]]
+    built from the base blocks, so no bigger expm is needed. The controller cancels the estimated error with
+    K_u = [K, I], and since the error states can't be driven Kff_u is just Kff padded with zeros.
+
+    input_error_noise is the continuous random walk intensity of each input's error (a scalar or one per input), and
+    is discretized as input_error_noise * dt. How much of that walk leaks into x within a single step is left out,
+    which is second order in dt. The Kalman gain is the only thing actually re-solved, using the discrete noise.
+    Returns A_u, B_u, C_u, Q_u, K_u, L_u, Kff_u
     """
 
-    n = A.shape[0]
-    p = B.shape[1]
+    A_d = np.asmatrix(A_d)
+    B_d = np.asmatrix(B_d)
+    C = np.asmatrix(C)
+    Q_d = np.asmatrix(Q_d)
+    K = np.asmatrix(K)
+    Kff = np.asmatrix(Kff)
+    check_validity(A=A_d, B=B_d, C=C, Q_noise=Q_d, R_noise=R_d, K=K, Kff=Kff)
+
+    n = A_d.shape[0]
+    p = B_d.shape[1]
     q = C.shape[0]
-    
-    assert p == 1, 'A system must be a single-input system to be augmented for integral control'
-    A_c = np.block([
-        [A, B],
-        [np.zeros((1, n)), 0]
-    ])
-
-    B_c = np.block([
-        [B],
-        [0]
-    ])
-
-    C = np.block([
-        [C, np.zeros((q, 1))]
-    ])
-
-    K_u = np.block([
-        [K, 1]
-    ])
-
-    Q_aug = np.block([
-        [Q_noise, np.zeros((n, 1))],
-        [np.zeros((1, n)), .1]
-    ])
-
-    A_d, B_d, Q_aug_d = c2d(A_c, B_c, 0.02, Q_aug)
-
-    Q_w_aug = np.block([
-        [Q_weight, np.zeros((n, 1))],
-        [np.zeros((1, n)), (1/0.1)**2]
-    ])
-
-    L = discrete_kalman(A_d, C, Q_aug, R_noise)
-    Kff = feedforward_gains(B_d, Q_w_aug, R_weight)
-    return A_d, B_d, C, Q_aug, K_u, L, Kff
+
+    input_error_noise = np.broadcast_to(np.asarray(input_error_noise, dtype=float), (p,))
+
+    A_u = np.asmatrix(np.block([
+        [A_d, B_d],
+        [np.zeros((p, n)), np.eye(p)]
+    ]))
+
+    B_u = np.asmatrix(np.block([
+        [B_d],
+        [np.zeros((p, p))]
+    ]))
+
+    C_u = np.asmatrix(np.block([
+        [C, np.zeros((q, p))]
+    ]))
+
+    Q_u = np.asmatrix(np.block([
+        [Q_d, np.zeros((n, p))],
+        [np.zeros((p, n)), np.diag(input_error_noise * dt)]
+    ]))
+
+    K_u = np.asmatrix(np.block([
+        [K, np.eye(p)]
+    ]))
+
+    Kff_u = np.asmatrix(np.block([
+        [Kff, np.zeros((p, p))]
+    ]))
+
+    L_u = discrete_kalman(A_u, C_u, Q_u, R_d)
+    return A_u, B_u, C_u, Q_u, K_u, L_u, Kff_u
 
 
 
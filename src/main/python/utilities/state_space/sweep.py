@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import numpy as np
+from collections import namedtuple
+
+"""
+Resumable parameter sweeps, for overnight runs over dlqr/discrete_kalman candidates that shouldn't lose everything when
+they get interrupted.
+
+Every result is appended to a JSON lines file as soon as it exists, and flushed to disk. Each line is keyed by a
+sha256 of the inputs that went into synthesizing the gains (rather than of the sweep point's position), so resuming
+skips every point that's already done, and a later sweep over an overlapping grid reuses the results it shares with
+earlier ones. A long evaluation can also checkpoint partial metrics along with the state of its random generator, and
+gets both back if it's resumed.
+
+Since the store is only ever appended to, the worst an interruption can do is cut off the last line, which is dropped
+when the store is opened again.
+"""
+
+SweepRecord = namedtuple('SweepRecord', ['key', 'point', 'metrics', 'rng_state', 'complete'])
+
+
+def _to_json(value):
+    """ Converts numpy values (and anything nested in lists, tuples and dicts) to plain JSON types"""
+
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _canonical(value):
+    """ An exact, order-independent form of the synthesis inputs for hashing. Floats go through float.hex so the key
+        changes whenever any bit of an input does, and arrays keep their shape"""
+
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        array = np.asarray(value)
+        if array.ndim == 0:
+            return _canonical(array.item())
+        return {'shape': list(array.shape),
+                'data': [_canonical(item) for item in np.asarray(array, dtype=float).ravel().tolist()]}
+    if isinstance(value, float):
+        return float(value).hex()
+    return value
+
+
+def synthesis_key(inputs):
+    """ sha256 hex digest of the synthesis inputs, e.g. a dict of the A, B, C, Q and R matrices and weights"""
+
+    encoded = json.dumps(_canonical(inputs), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class SweepStore(object):
+    """ An append-only JSON lines store of sweep results, keyed by synthesis_key"""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        good_length = 0
+        with open(self.path, 'rb') as store_file:
+            for line in store_file:
+                if not line.endswith(b'\n'):
+                    # Cut off part way through a write
+                    break
+                try:
+                    record = SweepRecord(**json.loads(line.decode('utf-8')))
+                except ValueError:
+                    break
+                good_length += len(line)
+                # Later lines supersede earlier ones, e.g. a complete result replaces its partial checkpoints
+                self.records[record.key] = record
+
+        # Drop the damaged tail, so new records don't get appended onto the end of half a line
+        if good_length != os.path.getsize(self.path):
+            with open(self.path, 'rb+') as store_file:
+                store_file.truncate(good_length)
+
+    def __contains__(self, key):
+        record = self.records.get(key)
+        return record is not None and record.complete
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def append(self, record):
+        line = json.dumps(_to_json(record._asdict()), sort_keys=True) + '\n'
+        with open(self.path, 'a') as store_file:
+            store_file.write(line)
+            store_file.flush()
+            os.fsync(store_file.fileno())
+        self.records[record.key] = record
+
+    def __len__(self):
+        return sum(1 for record in self.records.values() if record.complete)
+
+
+class SweepContext(object):
+    """
+    What an evaluation gets for one point: a random generator, the partial metrics it last checkpointed (if it's being
+    resumed) and a checkpoint function to save progress. The generator is restored to the state it was in at that
+    checkpoint, so a resumed evaluation draws the same numbers an uninterrupted one would have.
+    """
+
+    def __init__(self, store, key, point, rng, partial):
+        self.store = store
+        self.key = key
+        self.point = point
+        self.rng = rng
+        self.partial = partial
+
+    def checkpoint(self, metrics):
+        self.partial = metrics
+        self.store.append(SweepRecord(self.key, _to_json(self.point), _to_json(metrics),
+                                      self.rng.bit_generator.state, False))
+
+
+def run_sweep(points, evaluate, store_path, synthesis_inputs=None, seed=0, verbose=False):
+    """ Evaluates every point of a sweep, skipping the ones already in the store at store_path.
+
+        evaluate(point, context) returns a dict of metrics for one point, and may call context.checkpoint(metrics)
+        part way through. synthesis_inputs(point) returns what the gains for that point are synthesized from, which
+        is what identifies it in the store, along with seed. It defaults to the point itself.
+
+        Each point's generator is seeded from seed and its key, so results don't depend on the order of the sweep.
+        Returns a list of (point, metrics) in the order of points"""
+
+    if synthesis_inputs is None:
+        synthesis_inputs = lambda point: point
+
+    store = SweepStore(store_path)
+    results = []
+    for point in points:
+        # The seed changes every random draw, so it's part of what identifies a result
+        key = synthesis_key({'inputs': synthesis_inputs(point), 'seed': seed})
+        if key in store:
+            if verbose:
+                print('Reusing', key[:12], point)
+            results.append((point, store.get(key).metrics))
+            continue
+
+        rng = np.random.default_rng([seed, int(key[:16], 16)])
+        partial = None
+        record = store.get(key)
+        if record is not None:
+            # Resuming from a partial checkpoint
+            rng.bit_generator.state = record.rng_state
+            partial = record.metrics
+            if verbose:
+                print('Resuming', key[:12], point)
+        elif verbose:
+            print('Evaluating', key[:12], point)
+
+        context = SweepContext(store, key, point, rng, partial)
+        metrics = evaluate(point, context)
+        store.append(SweepRecord(key, _to_json(point), _to_json(metrics), rng.bit_generator.state, True))
+        results.append((point, _to_json(metrics)))
+
+    return results
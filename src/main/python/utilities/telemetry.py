@@ -0,0 +1,271 @@
+import asyncio
+import socket
+import numpy as np
+import scipy.linalg
+
+"""
+Live telemetry from the robot over UDP, with the state space model running alongside it to catch model mismatch.
+
+Every sample is one packed little-endian record: a uint32 sequence number, a float64 timestamp in seconds, then one
+float64 per channel. A datagram can hold any number of whole records, so a sender can batch several samples into one
+packet. For the TestMotor subsystem the channels are the applied voltage and the encoder position and velocity in
+ticks, which are exactly the model's u and y.
+
+The receiver runs in an asyncio datagram endpoint and decodes whole datagrams with np.frombuffer straight into
+preallocated ring buffers, so there's no per-sample Python object churn. Gaps in the sequence numbers are counted as
+drops, and the socket's receive buffer is enlarged so bursts don't overflow it.
+
+replay_telemetry sends recorded (or simulated) samples to a local port at the original rate, which stands in for the
+robot.
+"""
+
+TEST_MOTOR_CHANNELS = ('voltage', 'position_ticks', 'velocity_ticks')
+
+
+def record_dtype(num_channels):
+    """ The packed layout of one telemetry record"""
+    return np.dtype([('sequence', '<u4'), ('timestamp', '<f8'), ('values', '<f8', (num_channels,))])
+
+
+def encode_records(sequence, timestamps, values):
+    """ Packs samples into bytes. sequence and timestamps are (k,) and values is (k, num_channels)"""
+
+    values = np.asarray(values, dtype=float).reshape(len(timestamps), -1)
+    records = np.empty(len(timestamps), dtype=record_dtype(values.shape[1]))
+    records['sequence'] = sequence
+    records['timestamp'] = timestamps
+    records['values'] = values
+    return records.tobytes()
+
+
+class RingBuffer(object):
+    """ A fixed-size buffer of rows that overwrites the oldest ones once it's full"""
+
+    def __init__(self, capacity, width, dtype=float):
+        self.data = np.zeros((capacity, width), dtype=dtype)
+        self.capacity = capacity
+        # Total number of rows ever written, so the write position is total % capacity
+        self.total = 0
+
+    def extend(self, rows):
+        rows = np.asarray(rows).reshape(-1, self.data.shape[1])
+        count = len(rows)
+        if count >= self.capacity:
+            rows = rows[-self.capacity:]
+            start = (self.total + count - self.capacity) % self.capacity
+            count_kept = self.capacity
+        else:
+            start = self.total % self.capacity
+            count_kept = count
+
+        first = min(count_kept, self.capacity - start)
+        self.data[start:start + first] = rows[:first]
+        self.data[:count_kept - first] = rows[first:]
+        self.total += count
+
+    def append(self, row):
+        self.extend(np.asarray(row)[None])
+
+    def latest(self, count=None):
+        """ The most recent count rows (all of the buffered ones by default), oldest first, as a copy"""
+
+        available = min(self.total, self.capacity)
+        count = available if count is None else min(count, available)
+        end = self.total % self.capacity
+        indices = (np.arange(end - count, end)) % self.capacity
+        return self.data[indices]
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+
+class OnlineEstimator(object):
+    """
+    Runs a Kalman filter on the incoming samples and checks each measurement against the model's prediction of it.
+
+    Each sample is the measurement y and the input u that was applied over the step leading up to it. The prediction
+    is x_pred = A * x_hat + B * u, and the innovation e = y - C * x_pred - D * u. StateSpaceObserver corrects against
+    C * x_hat from before the step, which makes its residual depend on the motion too, so this uses the predict and
+    correct form with the steady-state gain instead. The noise covariances default to Q_noise and R_noise, the same
+    as discrete_kalman treats them. With P the steady-state predicted error covariance, e has covariance
+    S = C * P * C.T + R, so the normalized innovation squared e.T * S^-1 * e averages q (the number of sensors) while
+    the model is right. When its average over the last window samples is more than threshold times q, the model is
+    flagged as mismatched.
+    """
+
+    def __init__(self, gains, x_hat_initial, input_channels, output_channels, window=100, threshold=3.,
+                 capacity=100000, process_noise_covariance=None, sensor_noise_covariance=None):
+        self.gains = gains
+        self.input_channels = list(input_channels)
+        self.output_channels = list(output_channels)
+        self.window = window
+        self.threshold = threshold
+
+        self.A = np.asarray(gains.A, dtype=float)
+        self.B = np.asarray(gains.B, dtype=float)
+        self.C = np.asarray(gains.C, dtype=float)
+        self.D = np.asarray(gains.D, dtype=float)
+        Q = np.asarray(gains.Q_noise if process_noise_covariance is None else process_noise_covariance, dtype=float)
+        R = np.asarray(gains.R_noise if sensor_noise_covariance is None else sensor_noise_covariance, dtype=float)
+        P = scipy.linalg.solve_discrete_are(self.A.T, self.C.T, Q, R)
+        S = self.C @ P @ self.C.T + R
+        self.S_inverse = np.linalg.inv(S)
+        self.kalman_gain = P @ self.C.T @ self.S_inverse
+
+        self.x_hat = np.asarray(x_hat_initial, dtype=float).ravel()
+
+        # timestamp, x_hat, innovation, normalized innovation squared
+        self.history = RingBuffer(capacity, 1 + gains.n + gains.q + 1)
+        self.recent_nis = RingBuffer(window, 1)
+        self.mismatch = False
+        self.mismatch_count = 0
+
+    def update(self, timestamps, values):
+        """ Processes a block of samples, (k,) timestamps and (k, num_channels) values"""
+
+        rows = np.empty((len(timestamps), self.history.data.shape[1]))
+        rows[:, 0] = timestamps
+        for k in range(len(timestamps)):
+            u = values[k, self.input_channels]
+            y = values[k, self.output_channels]
+
+            x_predicted = self.A @ self.x_hat + self.B @ u
+            innovation = y - self.C @ x_predicted - self.D @ u
+            self.x_hat = x_predicted + self.kalman_gain @ innovation
+
+            rows[k, 1:] = np.concatenate([self.x_hat, innovation, [innovation @ self.S_inverse @ innovation]])
+
+        self.recent_nis.extend(rows[:, -1])
+        self.history.extend(rows)
+        if len(self.recent_nis) >= self.window:
+            mismatch = np.mean(self.recent_nis.latest()) > self.threshold * self.gains.q
+            if mismatch and not self.mismatch:
+                self.mismatch_count += 1
+            self.mismatch = mismatch
+
+
+class TelemetryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, address):
+        self.receiver.receive(data)
+
+    def error_received(self, exception):
+        self.receiver.errors += 1
+
+
+class TelemetryReceiver(object):
+    """ Receives telemetry records into a ring buffer, and optionally feeds them to an OnlineEstimator.
+        Buffered columns are the timestamp and then the channels. Records that arrive behind the newest sequence number
+        seen so far are counted in out_of_order and left out of both, so the buffer and the estimator stay in order"""
+
+    def __init__(self, channels=TEST_MOTOR_CHANNELS, capacity=100000, estimator=None):
+        self.channels = list(channels)
+        self.dtype = record_dtype(len(self.channels))
+        self.buffer = RingBuffer(capacity, 1 + len(self.channels))
+        self.estimator = estimator
+
+        self.received = 0
+        self.dropped = 0
+        self.out_of_order = 0
+        self.malformed = 0
+        self.errors = 0
+        self.next_sequence = None
+        self.transport = None
+
+    def receive(self, data):
+        if len(data) % self.dtype.itemsize != 0:
+            self.malformed += 1
+            return
+        records = np.frombuffer(data, dtype=self.dtype)
+        if len(records) == 0:
+            return
+
+        sequence = records['sequence'].astype(np.int64)
+        self.received += len(records)
+        if self.next_sequence is not None:
+            # Anything behind the high-water mark was already counted as dropped when the gap went past, and it's older
+            # than what's been buffered and estimated, so it's only counted as out of order
+            late = sequence < self.next_sequence
+            if np.any(late):
+                self.out_of_order += 1
+                records = records[~late]
+                sequence = sequence[~late]
+                if len(records) == 0:
+                    return
+            self.dropped += int(sequence[0] - self.next_sequence)
+        self.dropped += int(np.sum(np.maximum(np.diff(sequence) - 1, 0)))
+        self.next_sequence = int(sequence[-1]) + 1
+
+        timestamps = records['timestamp']
+        values = records['values']
+        self.buffer.extend(np.column_stack([timestamps, values]))
+        if self.estimator is not None:
+            self.estimator.update(timestamps, values)
+
+    async def start(self, host='0.0.0.0', port=5800, receive_buffer_bytes=4 * 1024 * 1024):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A bigger kernel buffer rides out bursts while the event loop is busy
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_bytes)
+        sock.bind((host, port))
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: TelemetryProtocol(self), sock=sock)
+        return self.transport.get_extra_info('sockname')
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def latest(self, count=None):
+        """ The most recent samples as a dict of timestamp and channel arrays"""
+
+        rows = self.buffer.latest(count)
+        columns = {'timestamp': rows[:, 0]}
+        for i, channel in enumerate(self.channels):
+            columns[channel] = rows[:, 1 + i]
+        return columns
+
+
+async def replay_telemetry(host, port, timestamps, values, records_per_packet=1, speed=1.):
+    """ Sends samples to host:port paced at their own timestamps (divided by speed), the way the robot would send them.
+        Returns the largest amount any packet was sent late by, in seconds"""
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    timestamps = np.asarray(timestamps, dtype=float)
+    values = np.asarray(values, dtype=float)
+
+    try:
+        start = loop.time()
+        worst_lateness = 0.
+        for first in range(0, len(timestamps), records_per_packet):
+            last = min(first + records_per_packet, len(timestamps))
+            # A batch goes out once its last sample has happened
+            due = start + (timestamps[last - 1] - timestamps[0]) / speed
+            delay = due - loop.time()
+            if delay > 0.:
+                await asyncio.sleep(delay)
+            else:
+                worst_lateness = max(worst_lateness, -delay)
+            transport.sendto(encode_records(np.arange(first, last), timestamps[first:last], values[first:last]))
+        return worst_lateness
+    finally:
+        transport.close()
+
+
+def telemetry_from_sim(sim, duration, reference_calculator):
+    """ Runs a StateSpaceControlSim and returns what the robot would send: timestamps and [voltage, y...] rows,
+        with the voltage being the input applied over each step"""
+
+    dt = sim.current_gains.dt
+    timestamps = np.arange(start=0., stop=duration, step=dt)
+    values = np.empty((len(timestamps), sim.num_inputs + sim.num_sensor_inputs))
+    for k, t in enumerate(timestamps):
+        u = np.asarray(sim.u, dtype=float).ravel()
+        _, _, y, _ = sim.update(reference_calculator(t))
+        values[k, :sim.num_inputs] = u
+        values[k, sim.num_inputs:] = np.asarray(y, dtype=float).ravel()
+    return timestamps, values